@@ -1,20 +1,83 @@
 import os
 import json
-from typing import List, Dict, Any
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
 
 import streamlit as st
 from PIL import Image
 from dotenv import load_dotenv
 
-from src.prompt_factory import build_prompt_bundle
+from src.prompt_factory import attach_few_shots, build_prompt_bundle, split_spec_checks
+from src.fewshot import FewShotStore
 from src.llm_providers import LLMProvider
-from src.vision_eval import run_vision_eval
-from scripts.generate_runtime_app import generate_runtime_app
+from src.vision_eval import learn_background, preprocess_image, run_vision_eval
+from src.eval_cache import VerdictCache, image_digest, spec_version
+from src.result_store import ResultStore
+from src.verdict_schema import PARSE_STATS
+from src.token_budget import apply_token_budget
+from src.budget import BudgetGovernor, BudgetLimits, GovernedProvider, estimate_batch
+from src.scheduler import ScheduledProvider, Scheduler
+from src.eval_jobs import EvalJob, JobCancelled, JobItem, cancellable_provider
+from src.spec_search import search_specs
+from src.calibration import apply_image_setting, calibrate_resolution
+from src.speculation import SpeculativeRunner
+from scripts.generate_runtime_app import KEEP_BUILDS, LATEST_NAME, generate_runtime_app
 
 
 load_dotenv()
 
 
+@st.cache_resource
+def _result_store() -> ResultStore:
+    return ResultStore()
+
+
+def _tuned_bundle(bundle: Dict[str, Any]) -> Dict[str, Any]:
+    """自動設定が有効なら、結果ストアの出力トークン実績から仕様ごとの max_tokens を書き込んだコピーを返す"""
+    if not auto_max_tokens:
+        return bundle
+    tuned = dict(bundle)
+    apply_token_budget(tuned, _result_store().completion_tokens(spec_version(bundle), model))
+    return tuned
+
+
+@st.cache_resource
+def _fewshot_store() -> FewShotStore:
+    return FewShotStore(FEWSHOT_PATH)
+
+
+@st.cache_resource
+def _scheduler(rate_per_s: float) -> Scheduler:
+    # 修正候補（interactive）・サンプル判定（line）・自動探索（bulk）で1つのAPIキーと同時実行枠を分け合う
+    return Scheduler(max_concurrency=SCHEDULER_MAX_CONCURRENCY, rate_per_s=rate_per_s or None)
+
+
+@st.cache_resource
+def _background_executor() -> ThreadPoolExecutor:
+    # 修正候補の生成など、判定ジョブと並行して走らせる問い合わせ用
+    return ThreadPoolExecutor(max_workers=2)
+
+
+# 判定とプロンプト修正候補の並列実行数
+EVAL_MAX_WORKERS = 4
+# API呼び出しの同時実行数（全ジョブ共通）
+SCHEDULER_MAX_CONCURRENCY = 8
+# 先回り判定の同時実行数（一括処理の優先度で流す）
+SPECULATIVE_MAX_WORKERS = 2
+# まとめて修正候補を作る際に1回のリクエストへ含める上限
+SUGGESTION_MAX_SAMPLES = 12
+SUGGESTION_DETAIL_CHARS = 300
+OUTPUT_MODE_LABELS = {"通常（詳細・チェック項目つき）": "json", "ライン（短縮・NG時のみ理由）": "line"}
+SUGGESTION_MODES = ["まとめて1件（推奨）", "サンプルごと"]
+BACKGROUND_PATH = "data/background.png"
+# 判定済みのラベル付きサンプル（似た画像の判定例として添付する）
+FEWSHOT_PATH = "data/few_shots.jsonl"
+FEWSHOT_K = 3
+CPU_WORKERS_HELP = "1以上なら画像の縮小・エンコードを別プロセスで行い、API 呼び出しと重ねます（0 はスレッドのみ）。"
+BUDGET_ACTIONS = {"一時停止（上限を引き上げると再開）": "pause", "停止": "stop"}
+
+
 st.set_page_config(page_title="外観検査アプリ自動生成(MVP)", layout="wide")
 
 st.title("外観検査アプリ **自動生成** (MVP)")
@@ -22,26 +85,58 @@ st.title("外観検査アプリ **自動生成** (MVP)")
 with st.expander("1) 画像サンプルのアップロード", expanded=True):
     uploaded_files = st.file_uploader("検査したい画像を複数選択", type=["png", "jpg", "jpeg"], accept_multiple_files=True)
     sample_images: List[tuple[str, Image.Image]] = []
-    expected_map: Dict[str, str] = st.session_state.get("expected_verdicts", {})
+    # 想定判定は画像の内容で覚えておく（並べ替えても引き継がれる）。サンプルはアップロード順の番号で区別し、
+    # 同じファイル名の画像が1件にまとめられないようにする
+    expected_by_digest: Dict[str, str] = st.session_state.get("expected_by_digest", {})
+    expected_map: Dict[str, str] = {}
     if uploaded_files:
         cols = st.columns(min(3, len(uploaded_files)))
         for i, uf in enumerate(uploaded_files):
             img = Image.open(uf).convert("RGB")
-            sample_images.append((uf.name, img))
+            digest = image_digest(img)
+            sample_key = f"{i + 1}. {uf.name}"
+            sample_images.append((sample_key, img))
             with cols[i % len(cols)]:
-                st.image(img, caption=uf.name, use_column_width=True)
-                default_choice = expected_map.get(uf.name, "OK")
+                st.image(img, caption=sample_key, use_column_width=True)
+                default_choice = expected_by_digest.get(digest, "OK")
                 choice = st.selectbox(
                     "想定判定",
                     ["OK", "NG"],
                     index=0 if default_choice == "OK" else 1,
-                    key=f"expected-{uf.name}-{i}",
+                    key=f"expected-{digest[:16]}-{i}",
                 )
-                expected_map[uf.name] = choice
+                expected_by_digest[digest] = choice
+                expected_map[sample_key] = choice
+        st.session_state["expected_by_digest"] = expected_by_digest
         st.session_state["expected_verdicts"] = expected_map
     else:
         st.session_state.pop("expected_verdicts", None)
 
+with st.expander("前処理: 部品の自動切り出し（任意）", expanded=False):
+    crop_enabled = st.checkbox("判定前に部品を切り出して背景を除く", value=False)
+    crop_margin = st.slider("余白（画像の長辺に対する割合）", 0.0, 0.3, 0.05, 0.01)
+    crop_deskew = st.checkbox("傾き・遠近を補正する", value=False)
+    background_files = st.file_uploader(
+        "背景画像（部品が写っていない画像・任意。指定すると背景差分で切り出します）",
+        type=["png", "jpg", "jpeg"],
+        accept_multiple_files=True,
+    )
+    preprocess: Optional[Dict[str, Any]] = None
+    if crop_enabled:
+        preprocess = {"crop": "threshold", "margin": crop_margin, "deskew": crop_deskew}
+        if background_files:
+            background = learn_background([Image.open(f).convert("RGB") for f in background_files])
+            os.makedirs(os.path.dirname(BACKGROUND_PATH), exist_ok=True)
+            background.save(BACKGROUND_PATH)
+            preprocess.update({"crop": "background", "background_path": BACKGROUND_PATH})
+        if sample_images:
+            name, original = sample_images[0]
+            preview, crop_info = preprocess_image(original, preprocess)
+            caption = f"切り出し例: {name}（{original.width}x{original.height} → {preview.width}x{preview.height}）"
+            if not crop_info["found"]:
+                caption += " ※部品を検出できなかったため元画像のまま"
+            st.image(preview, caption=caption)
+
 with st.expander("3) 検査仕様を日本語で記述", expanded=True):
     spec_text = st.text_area(
         "例) 画像全体でネジが6本すべてシール済みか確認し、どれか外れていればNGと判断する...",
@@ -53,17 +148,89 @@ with st.sidebar:
     provider = st.selectbox("プロバイダ", ["OpenAI", "Gemini"])
     model = st.text_input("モデル名", os.getenv("OPENAI_MODEL" if provider=="OpenAI" else "GEMINI_MODEL", ""))
     temperature = st.slider("temperature", 0.0, 1.5, 0.2, 0.05)
+    suggestion_mode = st.radio("プロンプト修正候補", SUGGESTION_MODES, index=0)
+    request_timeout = st.number_input("API応答の期限（秒）", 5.0, 600.0, 120.0, step=5.0)
+    output_mode_label = st.radio("出力モード", list(OUTPUT_MODE_LABELS), index=0)
+    auto_max_tokens = st.checkbox("max_output_tokens を判定実績から自動設定", value=False)
+    decompose_checks = st.checkbox("検査項目ごとに並列判定（NGが出たら打ち切り）", value=False)
+    api_rate = st.number_input("API呼び出しのレート上限（件/秒、0で無制限）", 0.0, 100.0, 0.0, step=1.0)
+    speculative_enabled = st.checkbox("先回り判定（プロンプト生成後にバックグラウンドで判定）", value=False)
+    fewshot_enabled = st.checkbox(
+        "似たサンプルの判定例を添付（Few-shot）",
+        value=False,
+        help=f"想定判定つきで判定したサンプルを蓄積し、判定する画像ごとに似た例を最大 {FEWSHOT_K} 件（判定と理由のみ）プロンプトに添付します。",
+    )
+    with st.expander("予算（任意）", expanded=False):
+        budget_enabled = st.checkbox("費用・トークンの上限を設ける", value=False)
+        budget_cost = st.number_input("費用の上限（USD、0で無制限）", 0.0, 10000.0, 5.0, step=1.0)
+        budget_tokens = st.number_input("トークンの上限（0で無制限）", 0, 100_000_000, 0, step=100_000)
+        budget_action = st.radio("上限に達したら", list(BUDGET_ACTIONS), index=0)
+        budget_degrade_at = st.slider("節約モードに切り替える使用率", 0.1, 1.0, 0.8, 0.05)
+        budget_cheap_model = st.text_input("節約モードのモデル名（空なら同じモデル）", "")
+        budget_max_side = st.number_input("節約モードの画像の長辺（px、0で縮小しない）", 0, 4096, 768, step=64)
 max_tokens = st.number_input("max_output_tokens", 256, 16384, 4096, step=128)
 st.caption("※ APIキーは環境変数(.env) または ランタイム環境で設定してください。")
 
 st.divider()
 
+check_items: List[str] = []
+if decompose_checks and spec_text:
+    check_text = st.text_area(
+        "検査項目（1行に1項目。仕様から自動で分割しています）",
+        "\n".join(split_spec_checks(spec_text)),
+        height=120,
+    )
+    check_items = [line.strip() for line in check_text.splitlines() if line.strip()]
+    if len(check_items) < 2:
+        st.caption("検査項目が1件のため、仕様全体を1回で判定します。")
+
+if "budget_governor" not in st.session_state:
+    st.session_state["budget_governor"] = BudgetGovernor()
+budget_governor: BudgetGovernor = st.session_state["budget_governor"]
+if budget_enabled:
+    # 実行中のジョブにも反映する（引き上げると一時停止中の判定が再開する）
+    budget_governor.update_limits(
+        BudgetLimits(
+            max_cost_usd=float(budget_cost) or None,
+            max_tokens=int(budget_tokens) or None,
+            degrade_at=float(budget_degrade_at),
+            on_limit=BUDGET_ACTIONS[budget_action],
+        )
+    )
+else:
+    budget_governor.update_limits(BudgetLimits())
+
+
+def _governed(client: LLMProvider, priority: str) -> ScheduledProvider:
+    """共通のスケジューラを通し、予算が有効なら使用量を積算して上限で止めるプロバイダで包む"""
+    if not budget_enabled:
+        return ScheduledProvider(client, _scheduler(float(api_rate)), priority)
+    cheap = LLMProvider(
+        provider_name=client.provider_name,
+        model=budget_cheap_model,
+        temperature=client.temperature,
+        max_tokens=client.max_tokens,
+        timeout=client.timeout,
+    ) if budget_cheap_model else None
+    governed = GovernedProvider(client, budget_governor, degrade_provider=cheap, degrade_max_side=int(budget_max_side) or None)
+    return ScheduledProvider(governed, _scheduler(float(api_rate)), priority)
+
+
 col_a, col_b = st.columns([1,1])
 
+if "verdict_cache" not in st.session_state:
+    st.session_state["verdict_cache"] = VerdictCache()
+verdict_cache: VerdictCache = st.session_state["verdict_cache"]
+
 with col_a:
     if st.button("A) 外観検査プロンプトを生成", disabled=not(spec_text and sample_images)):
         prompt_bundle = build_prompt_bundle(
             spec_text=spec_text,
+            output_mode=OUTPUT_MODE_LABELS[output_mode_label],
+            checks=check_items or None,
+            preprocess=preprocess,
+            # キャリブレーションで採用した送信画像の設定は仕様を作り直しても引き継ぐ
+            image=st.session_state.get("prompt_bundle", {}).get("image"),
         )
         st.session_state["prompt_bundle"] = prompt_bundle
         st.success("プロンプトを生成しました。右側で確認できます。")
@@ -90,50 +257,431 @@ AIが出力した詳細: {decision.get('details', '-')}
     except Exception as exc:
         return f"修正候補の取得に失敗しました: {exc}"
 
+def _generate_consolidated_suggestion(provider: LLMProvider, spec_text: str, mismatches: List[Dict[str, Any]]) -> str:
+    """想定と異なったサンプルをまとめて1回の問い合わせで渡し、矛盾のない修正候補を1件だけ得る"""
+    system_prompt = """あなたは製造業の外観検査プロンプトを改善する専門家です。
+検査仕様はそのまま別のアプリに貼り付けられる完成形の文章で提示してください。"""
+    sample_lines = []
+    for idx, item in enumerate(mismatches[:SUGGESTION_MAX_SAMPLES], start=1):
+        decision = item["decision"]
+        details = str(decision.get("details", "-")).replace("\n", " ")
+        if len(details) > SUGGESTION_DETAIL_CHARS:
+            details = details[:SUGGESTION_DETAIL_CHARS] + "…"
+        sample_lines.append(
+            f"{idx}. サンプル名: {item['image']} / 想定している判定: {item['expected']} / "
+            f"AIの判定結果: {decision.get('verdict', 'UNKNOWN')} / AIが出力した詳細: {details}"
+        )
+    samples_text = "\n".join(sample_lines)
+    user_prompt = f"""
+現在の検査仕様:
+{spec_text}
+
+想定と異なる判定になったサンプル（{len(sample_lines)}件）:
+{samples_text}
+
+上記のすべてのサンプルが想定した判定になるように、矛盾のない1つの検査仕様へ改訂してください。
+想定どおりに判定できている他のサンプルの結果が変わらないよう、判定基準の変更は必要最小限にとどめてください。
+最終的な検査仕様の文章だけを日本語で出力してください。箇条書きや説明文は不要です。
+"""
+    try:
+        suggestion = provider.chat_text(system_prompt, user_prompt)
+        return suggestion.strip() or "修正候補を取得できませんでした。"
+    except Exception as exc:
+        return f"修正候補の取得に失敗しました: {exc}"
+
+
+def _evaluate_sample(provider: ScheduledProvider, prompt_bundle: Dict[str, Any], spec_text: str, name: str, img: Image.Image, expected: Optional[str], per_sample_suggestion: bool, reuse_cached: bool = False, cancel_event: Optional[threading.Event] = None, fewshot_store: Optional[FewShotStore] = None) -> Dict[str, Any]:
+    if cancel_event is not None:
+        # 取り消された項目は、スケジューラの順番が来た時点で API を呼ばずに打ち切る
+        provider = cancellable_provider(provider, cancel_event)
+    img_hash = image_digest(img)
+    version = spec_version(prompt_bundle)
+    if fewshot_store is not None:
+        # 似た例は画像ごとに選ぶ（添付した例もキャッシュのキーに含まれる）
+        prompt_bundle = attach_few_shots(prompt_bundle, fewshot_store, img, k=FEWSHOT_K, image_hash=img_hash)
+    cache_key = verdict_cache.key_for(provider, prompt_bundle, img_hash)
+    # 先回り判定が有効なら、同じ仕様・モデル設定で判定済みの結果をそのまま使う
+    decision = verdict_cache.get(cache_key) if reuse_cached else None
+    if decision is None:
+        decision = run_vision_eval(provider, prompt_bundle, img)
+        if cancel_event is not None and cancel_event.is_set():
+            # 項目別の判定が途中で打ち切られた結果は記録しない
+            raise JobCancelled("取り消されました。")
+        # 自動探索で同じ (仕様, 画像) を再評価しないよう結果を残しておく
+        verdict_cache.put(cache_key, decision)
+    # 節約モードでは安いモデルが応答するため、実際に応答したモデルで記録する
+    _result_store().record(img_hash, version, provider.provider_name, decision.get("model") or provider.model, decision, expected, source="brushup")
+    if fewshot_store is not None and expected and str(decision.get("verdict", "")).upper() != "ERROR":
+        # 想定判定を正解として蓄積し、以降に判定する似た画像の例にする
+        fewshot_store.add_example(img, _labelled_example(prompt_bundle["user"]["spec_text"], expected, decision), image_hash=img_hash)
+    suggestion = ""
+    if per_sample_suggestion and _is_mismatch(expected, decision):
+        suggestion = _generate_prompt_suggestion(provider.with_priority("interactive"), spec_text, name, expected, decision)
+    return {"image": name, "decision": decision, "expected": expected, "suggestion": suggestion}
+
+
+def _labelled_example(spec_text: str, expected: str, decision: Dict[str, Any]) -> Dict[str, Any]:
+    details = str(decision.get("details", ""))
+    verdict = str(decision.get("verdict", "")).upper()
+    feedback = details if verdict == expected.upper() else f"想定判定は{expected}（AIは{verdict}と判定: {details}）"
+    return {
+        "spec_text": spec_text,
+        "verdict": expected,
+        "model_decision": {"verdict": verdict, "details": details},
+        "human_feedback": feedback,
+        "tags": ["brushup"],
+    }
+
+
+def _is_mismatch(expected: Optional[str], decision: Dict[str, Any]) -> bool:
+    # 判定不能（ERROR）は仕様の問題ではないため修正候補の対象にしない
+    verdict = str(decision.get("verdict", "")).upper()
+    return bool(expected) and verdict != "ERROR" and expected.upper() != verdict
+
+
+if "speculative_runner" not in st.session_state:
+    st.session_state["speculative_runner"] = SpeculativeRunner(verdict_cache, max_workers=SPECULATIVE_MAX_WORKERS)
+speculative_runner: SpeculativeRunner = st.session_state["speculative_runner"]
+_active_job: Optional[EvalJob] = st.session_state.get("eval_job")
+if speculative_enabled and "prompt_bundle" in st.session_state and sample_images and not (_active_job is not None and _active_job.active):
+    # 仕様・モデル設定・サンプルが変わっていれば古い先回り判定を取り消してやり直す（B の実行中は B に譲る）
+    speculative_runner.sync(
+        _governed(LLMProvider(
+            provider_name=provider, model=model, temperature=temperature, max_tokens=int(max_tokens), timeout=float(request_timeout)
+        ), "bulk"),
+        _tuned_bundle(st.session_state["prompt_bundle"]),
+        sample_images,
+        budget_governor if budget_enabled else None,
+        fewshot_store=_fewshot_store() if fewshot_enabled else None,
+        fewshot_k=FEWSHOT_K,
+    )
+else:
+    speculative_runner.cancel()
+
 with col_b:
+    if speculative_enabled and speculative_runner.job is not None:
+        speculative_status = speculative_runner.status()
+        st.caption(
+            f"先回り判定: 完了 {speculative_status['done']} / 判定中 {speculative_status['running']}"
+            f" / 待機 {speculative_status['queued']} / 見送り {speculative_status['error']}"
+        )
+    if budget_enabled and sample_images and "prompt_bundle" in st.session_state:
+        _estimate_bundle = _tuned_bundle(st.session_state["prompt_bundle"])
+        estimate = estimate_batch(
+            LLMProvider(provider_name=provider, model=model),
+            _estimate_bundle,
+            [img for _, img in sample_images],
+            _result_store().completion_tokens(spec_version(_estimate_bundle), model),
+        )
+        st.caption(
+            f"見積もり: {estimate['calls']} 回 / 入力 約{estimate['prompt_tokens']:,} tokens / 出力 約{estimate['completion_tokens']:,} tokens"
+            f" / 約 ${estimate['cost_usd']:.4f}（出力は{'判定実績' if estimate['completion_basis'] == 'history' else '既定値'}から）"
+        )
+    if budget_enabled:
+        budget_status = budget_governor.status()
+        budget_labels = {"ok": "通常", "degraded": "節約モード", "paused": "一時停止中", "stopped": "停止"}
+        st.caption(
+            f"予算: {budget_labels[budget_status['state']]} / 使用 ${budget_status['spent_usd']:.4f}"
+            f" / {budget_status['tokens']:,} tokens / {budget_status['calls']} 回（使用率 {budget_status['usage_ratio']:.0%}）"
+        )
+        if budget_status["unpriced_models"]:
+            st.caption(
+                "※ 料金表に無いモデル（" + ", ".join(name or "(未指定)" for name in budget_status["unpriced_models"])
+                + "）は既定の料金（高めの目安）で積算しています。"
+            )
+        budget_cols = st.columns(2)
+        if budget_status["state"] == "paused" and budget_cols[0].button("停止する", key="budget-stop"):
+            budget_governor.stop()
+        if budget_cols[1].button("使用量をリセット", key="budget-reset"):
+            budget_governor.reset()
     if st.button("B) サンプルで検査", disabled="prompt_bundle" not in st.session_state):
-        provider_client = LLMProvider(provider_name=provider, model=model, temperature=temperature, max_tokens=int(max_tokens))
-        results = []
-        expected_map = st.session_state.get("expected_verdicts", {})
-        with st.spinner("VLMで判定中..."):
-            for name, img in sample_images:
-                decision = run_vision_eval(provider_client, st.session_state["prompt_bundle"], img)
-                expected = expected_map.get(name)
-                suggestion = ""
-                if expected and expected.upper() != decision.get("verdict", "").upper():
-                    suggestion = _generate_prompt_suggestion(provider_client, spec_text, name, expected, decision)
-                results.append({"image": name, "decision": decision, "expected": expected, "suggestion": suggestion})
-        st.session_state["eval_results"] = results
-        st.success("判定完了。下の結果と修正候補をご確認ください。")
+        previous_job: Optional[EvalJob] = st.session_state.get("eval_job")
+        if previous_job is not None:
+            previous_job.cancel_all()
+        provider_client = _governed(LLMProvider(
+            provider_name=provider, model=model, temperature=temperature, max_tokens=int(max_tokens), timeout=float(request_timeout)
+        ), "line")
+        bundle = _tuned_bundle(st.session_state["prompt_bundle"])
+        consolidated = suggestion_mode == SUGGESTION_MODES[0]
+        job_spec_text = spec_text
+        reuse_cached = speculative_enabled
+        job_fewshot_store = _fewshot_store() if fewshot_enabled else None
+        # 残りは B の優先度で判定する（先回り済みの結果はキャッシュから返る）
+        speculative_runner.cancel()
+        job = EvalJob(
+            lambda name, img, expected, cancel_event: _evaluate_sample(
+                provider_client, bundle, job_spec_text, name, img, expected, not consolidated, reuse_cached, cancel_event, job_fewshot_store
+            ),
+            sample_images,
+            st.session_state.get("expected_verdicts", {}),
+            max_workers=EVAL_MAX_WORKERS,
+        )
+        st.session_state["eval_job"] = job.start()
+        st.session_state["eval_job_context"] = {
+            "provider": provider_client,
+            "spec_text": job_spec_text,
+            "consolidated": consolidated,
+            "suggestion_future": None,
+            "suggestion_basis": None,
+            "suggestion_previous": None,
+        }
+        st.session_state.pop("eval_results", None)
+
+with st.expander("B+) ラベル付きサンプルで検査仕様を自動探索", expanded=False):
+    st.caption("仕様の候補を自動生成し、想定判定つきのサンプルで並列評価して最も良い候補を選びます。評価済みの組み合わせは再利用されます。")
+    search_cols = st.columns(4)
+    n_candidates = search_cols[0].number_input("候補数", 1, 10, 4)
+    max_calls = search_cols[1].number_input("API呼び出し上限（判定）", 1, 1000, 40)
+    search_workers = search_cols[2].number_input("並列数", 1, 16, EVAL_MAX_WORKERS)
+    search_cpu_workers = search_cols[3].number_input("前処理プロセス数", 0, 8, 0, help=CPU_WORKERS_HELP)
+    if st.button("自動探索を実行", disabled="prompt_bundle" not in st.session_state or not sample_images):
+        provider_client = _governed(LLMProvider(
+            provider_name=provider, model=model, temperature=temperature, max_tokens=int(max_tokens), timeout=float(request_timeout)
+        ), "bulk")
+        try:
+            with st.spinner("仕様の候補を評価中..."):
+                # 現在のバンドル（前処理・出力モード・送信画像などの設定）の仕様だけを差し替えて比べる
+                search_result = search_specs(
+                    provider_client,
+                    _tuned_bundle(st.session_state["prompt_bundle"]),
+                    sample_images,
+                    st.session_state.get("expected_verdicts", {}),
+                    n_candidates=int(n_candidates),
+                    max_calls=int(max_calls),
+                    max_workers=int(search_workers),
+                    cache=verdict_cache,
+                    feedback=st.session_state.get("eval_results", []),
+                    cpu_workers=int(search_cpu_workers),
+                )
+        except Exception as exc:
+            st.error(f"自動探索に失敗しました: {exc}")
+        else:
+            st.session_state["spec_search"] = search_result
+    search_result = st.session_state.get("spec_search")
+    if search_result:
+        reasons = {"perfect": "全問正解の候補が見つかりました", "budget": "予算に達したため打ち切りました", "exhausted": "すべての候補を評価しました"}
+        st.write(
+            f"{reasons.get(search_result.stopped_reason, search_result.stopped_reason)}"
+            f"（API呼び出し {search_result.api_calls} 回 / キャッシュ利用 {search_result.cache_hits} 件）"
+        )
+        for rank, score in enumerate(search_result.candidates, start=1):
+            st.markdown(
+                f"**{rank}位** 精度 {score.accuracy:.0%}（{score.correct}/{score.total}, 評価済み {score.evaluated}）"
+                f" / 平均 {score.mean_latency_ms:.0f} ms / 平均 {score.mean_tokens:.0f} tokens"
+            )
+            st.code(score.spec_text)
+        if st.button("最良の候補を採用する"):
+            st.session_state["prompt_bundle"] = search_result.best_bundle
+            st.success("最良の候補をプロンプトとして採用しました。C) でそのままビルドできます。")
+
+with st.expander("B++) 送信画像の解像度・形式をキャリブレーション", expanded=False):
+    st.caption(
+        "想定判定つきのサンプルを長辺・形式（PNG / JPEG / WEBP）を変えて並列評価し、精度と転送量・画像トークン・レイテンシを比べます。"
+        "元の送り方と同じ精度を保つ最も小さい設定を採用すると、C) の最終アプリにも固定されます。"
+    )
+    calibration_cols = st.columns(4)
+    calibration_tolerance = calibration_cols[0].number_input("許容する精度の低下", 0.0, 0.5, 0.0, step=0.05)
+    calibration_max_calls = calibration_cols[1].number_input("API呼び出し上限（判定）", 1, 1000, 60, key="calibration-max-calls")
+    calibration_workers = calibration_cols[2].number_input("並列数", 1, 16, EVAL_MAX_WORKERS, key="calibration-workers")
+    calibration_cpu_workers = calibration_cols[3].number_input("前処理プロセス数", 0, 8, 2, key="calibration-cpu-workers", help=CPU_WORKERS_HELP)
+    if st.button("キャリブレーションを実行", disabled="prompt_bundle" not in st.session_state or not sample_images):
+        provider_client = _governed(LLMProvider(
+            provider_name=provider, model=model, temperature=temperature, max_tokens=int(max_tokens), timeout=float(request_timeout)
+        ), "bulk")
+        try:
+            with st.spinner("解像度・形式ごとに評価中..."):
+                calibration = calibrate_resolution(
+                    provider_client,
+                    _tuned_bundle(st.session_state["prompt_bundle"]),
+                    sample_images,
+                    st.session_state.get("expected_verdicts", {}),
+                    max_workers=int(calibration_workers),
+                    cache=verdict_cache,
+                    tolerance=float(calibration_tolerance),
+                    cpu_workers=int(calibration_cpu_workers),
+                    max_calls=int(calibration_max_calls),
+                )
+        except Exception as exc:
+            st.error(f"キャリブレーションに失敗しました: {exc}")
+        else:
+            st.session_state["calibration"] = calibration
+    calibration = st.session_state.get("calibration")
+    if calibration:
+        st.write(f"API呼び出し {calibration.api_calls} 回 / キャッシュ利用 {calibration.cache_hits} 件。最良: **{calibration.best.label}**")
+        st.table(calibration.table())
+        if calibration.skipped:
+            st.caption(f"※ API呼び出しの上限に達したため {len(calibration.skipped)} 件の設定は評価していません（上限を上げるか、評価済みの設定はキャッシュから再利用されます）。")
+        if st.button("最良の設定を採用する", disabled="prompt_bundle" not in st.session_state):
+            st.session_state["prompt_bundle"] = apply_image_setting(st.session_state["prompt_bundle"], calibration.best.setting)
+            st.success("送信画像の設定をプロンプトに固定しました。C) でそのままビルドできます。")
 
 st.divider()
 
 if "prompt_bundle" in st.session_state:
     st.subheader("生成されたプロンプト（System / User）")
     st.code(json.dumps(st.session_state["prompt_bundle"], ensure_ascii=False, indent=2))
+    if auto_max_tokens:
+        tuned = _tuned_bundle(st.session_state["prompt_bundle"]).get("max_tokens")
+        st.caption(
+            f"この仕様の max_output_tokens: {tuned}（出力トークン実績の p99 + 30%）"
+            if tuned
+            else "判定実績が10件未満のため、サイドバーの max_output_tokens を使います。"
+        )
+
+STATUS_LABELS = {"queued": "待機中", "running": "判定中", "done": "完了", "error": "エラー", "cancelled": "中止"}
+
 
-if "eval_results" in st.session_state:
+def _maybe_start_consolidated_suggestion(job: EvalJob, context: Dict[str, Any], items: List[JobItem]) -> None:
+    """最初の不一致サンプルが出た時点でまとめた修正候補の問い合わせを始め、不一致が増えたら出し直す
+
+    問い合わせ中に不一致が増えた場合は、その問い合わせが終わってから最新の不一致（上限 SUGGESTION_MAX_SAMPLES 件）で出し直す。
+    """
+    if not context["consolidated"]:
+        return
+    mismatches = [
+        item.result for item in items
+        if item.status == "done" and item.result and _is_mismatch(item.expected, item.result["decision"])
+    ]
+    if not mismatches:
+        return
+    basis = tuple((m["image"], m["decision"].get("verdict")) for m in mismatches[:SUGGESTION_MAX_SAMPLES])
+    if basis == context["suggestion_basis"]:
+        return
+    future = context["suggestion_future"]
+    if future is not None and not future.done():
+        return
+    if future is not None:
+        # 出し直しの間も直前の修正候補を表示しておく
+        context["suggestion_previous"] = (context["suggestion_basis"], future.result())
+    context["suggestion_basis"] = basis
+    context["suggestion_omitted"] = max(0, len(mismatches) - SUGGESTION_MAX_SAMPLES)
+    context["suggestion_future"] = _background_executor().submit(
+        # 利用者が結果を待っているため、判定や自動探索の待ち行列を追い越す
+        _generate_consolidated_suggestion, context["provider"].with_priority("interactive"), context["spec_text"], mismatches[:SUGGESTION_MAX_SAMPLES]
+    )
+
+
+def _render_eval_job(polling: bool) -> None:
+    job: EvalJob = st.session_state["eval_job"]
+    context = st.session_state["eval_job_context"]
+    items = job.snapshot()
+    finished, total = job.progress()
     st.subheader("判定結果")
-    for item in st.session_state["eval_results"]:
-        st.markdown(f"**サンプル画像**: {item['image']}")
-        decision = item["decision"]
-        st.write(f"- 判定: {decision.get('verdict', 'UNKNOWN')} / 理由: {decision.get('details', '-')}")
-        expected = item.get("expected")
-        if expected:
-            st.write(f"- 想定判定: {expected}")
-        if item["suggestion"]:
-            st.markdown("**プロンプト修正候補:**")
-            st.code(item["suggestion"])
-        st.divider()
+    st.progress(finished / total if total else 1.0, text=f"判定済み {finished} / {total} 件")
+    if job.active and st.button("すべて中止", key="eval-cancel-all"):
+        job.cancel_all()
+        st.rerun()
+    for idx, item in enumerate(items):
+        info_col, action_col = st.columns([5, 1])
+        with info_col:
+            header = f"**サンプル画像**: {item.name} — {STATUS_LABELS.get(item.status, item.status)}"
+            if item.elapsed_s is not None:
+                header += f"（{item.elapsed_s:.1f} 秒）"
+            st.markdown(header)
+            if item.status == "done" and item.result:
+                decision = item.result["decision"]
+                if decision.get("verdict") == "ERROR":
+                    st.warning(f"判定不能（ERROR）: {decision.get('details', '-')}")
+                else:
+                    st.write(f"- 判定: {decision.get('verdict', 'UNKNOWN')} / 理由: {decision.get('details', '-')}")
+                if item.expected:
+                    st.write(f"- 想定判定: {item.expected}")
+                if item.result["suggestion"]:
+                    st.markdown("**プロンプト修正候補:**")
+                    st.code(item.result["suggestion"])
+            elif item.status == "error":
+                st.write(f"- エラー: {item.error}")
+        with action_col:
+            if item.status in {"queued", "running"}:
+                if st.button("中止", key=f"eval-cancel-{idx}"):
+                    job.cancel(item.name)
+                    st.rerun()
+            elif st.button("再実行", key=f"eval-retry-{idx}"):
+                job.retry(item.name)
+                st.rerun()
+    st.session_state["eval_results"] = [item.result for item in items if item.status == "done" and item.result]
+
+    _maybe_start_consolidated_suggestion(job, context, items)
+    future: Optional[Future] = context["suggestion_future"]
+    if future is not None:
+        st.markdown("**プロンプト修正候補（不一致サンプルをまとめて反映）:**")
+        previous = context.get("suggestion_previous")
+        basis = context["suggestion_basis"] if future.done() or previous is None else previous[0]
+        st.caption("対象: " + ", ".join(name for name, _ in basis))
+        if context.get("suggestion_omitted"):
+            st.caption(f"※ 上限を超えた {context['suggestion_omitted']} 件は修正候補の入力に含めていません。")
+        if future.done():
+            st.code(future.result())
+        elif previous is not None:
+            st.code(previous[1])
+            st.caption("不一致サンプルが増えたため修正候補を更新中...")
+        else:
+            st.caption("修正候補を生成中...")
+        if job.active:
+            st.caption("※ 判定中のため暫定の修正候補です。不一致サンプルが増えると更新されます。")
+    # 判定と修正候補の生成がすべて終わったら自動更新を止める
+    pending = job.active or (future is not None and not future.done())
+    if polling and not pending:
+        st.rerun()
+
+
+if "eval_job" in st.session_state:
+    _job: EvalJob = st.session_state["eval_job"]
+    _future = st.session_state["eval_job_context"]["suggestion_future"]
+    _polling = _job.active or (_future is not None and not _future.done())
+    st.fragment(run_every=1.0 if _polling else None)(_render_eval_job)(_polling)
+
+with st.expander("判定履歴の集計（ブラッシュアップ / 最終アプリ共通）", expanded=False):
+    store = _result_store()
+    st.caption(f"保存先: `{store.path}`")
+    rows = store.summary()
+    if not rows:
+        st.write("まだ判定結果がありません。")
+    for row in rows[:10]:
+        percentiles = store.latency_percentiles(row["spec_version"], row["model"], (50, 95))
+        accuracy = "-" if row["accuracy"] is None else f"{row['accuracy']:.0%}（{row['labeled']}件）"
+        p50 = "-" if percentiles[50] is None else f"{percentiles[50]:.0f}"
+        p95 = "-" if percentiles[95] is None else f"{percentiles[95]:.0f}"
+        st.markdown(
+            f"**仕様 {row['spec_version']} / {row['model'] or '(既定モデル)'}**: {row['count']}件（判定不能 {row['errors']}件）/ 正解率 {accuracy}"
+            f" / レイテンシ p50 {p50} ms・p95 {p95} ms"
+        )
+        matrix = store.confusion_matrix(row["spec_version"], row["model"])
+        if matrix:
+            st.caption(
+                "混同行列（想定→AI）: "
+                + ", ".join(f"{exp}→{ver}: {n}" for exp, verdicts in sorted(matrix.items()) for ver, n in sorted(verdicts.items()))
+            )
+    parse_stats = PARSE_STATS.snapshot()
+    st.caption(
+        f"応答JSONの検証（このプロセス）: そのまま {parse_stats['parsed']} / 修復 {parse_stats['repaired']}"
+        f" / 再問い合わせ {parse_stats['retried']} / 失敗 {parse_stats['failed']}"
+    )
+    for row in _scheduler(float(api_rate)).report():
+        if not (row["completed"] or row["queued"] or row["in_flight"]):
+            continue
+        slo = "-" if row["slo_met"] is None else f"{row['slo_met']:.0%}（目標 {row['slo_ms'] / 1000:.0f} 秒）"
+        st.caption(
+            f"{row['class']}: 待ち {row['queued']} / 実行中 {row['in_flight']} / 完了 {row['completed']}"
+            f" / 待ち時間 p95 {row['wait_p95_ms'] or 0:.0f} ms / 応答 p95 {row['latency_p95_ms'] or 0:.0f} ms / SLO達成 {slo}"
+        )
 
 st.subheader("C) 生成されたプロンプトから **最終アプリ** を組み立てる")
 out_dir = st.text_input("出力先ディレクトリ", "prod_app")
 if st.button("ビルド（/prod_app に生成）", disabled="prompt_bundle" not in st.session_state):
     try:
-        abs_path, rel_path = generate_runtime_app(st.session_state["prompt_bundle"], out_dir=out_dir)
+        abs_path, rel_path = generate_runtime_app(_tuned_bundle(st.session_state["prompt_bundle"]), out_dir=out_dir)
     except Exception as exc:
         st.error(f"生成に失敗しました: {exc}")
     else:
         st.success(f"生成しました → `{abs_path}` を `streamlit run` で実行できます。")
-        st.caption(f"※ 同じフォルダに既存ファイルがある場合は自動でリネームされます（例: {rel_path}）。")
+        st.caption(
+            f"※ ファイル名は内容のハッシュです（{rel_path}）。内容が同じなら再生成せず既存のビルドを使い、"
+            f"`{os.path.join(out_dir, LATEST_NAME)}` は常に最新のビルドを指します。古いビルドは {KEEP_BUILDS} 件を超えると削除されます。"
+        )
+        stem = os.path.splitext(rel_path)[0]
+        st.caption(
+            f"配布用: `{stem}.pyz` と `{stem.replace('runtime_app_', 'requirements_')}.txt`（このビルドで実際に使うパッケージのみ）を"
+            f"検査PCにコピーし、`pip install -r` の後 `python {stem}.pyz` で起動できます（`.pyz` に依存パッケージは含まれません）。"
+        )
 # moved _generate_prompt_suggestion earlier in the file
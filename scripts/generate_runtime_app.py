@@ -1,11 +1,42 @@
+import ast
+import hashlib
+import importlib.metadata
+import io
 import json
 import os
-import shutil
+import re
+import sys
+import time
+import zipfile
 from pathlib import Path
 from textwrap import dedent
 
+from src.eval_cache import spec_version
+
 LLM_SRC_PATH = Path("src/llm_providers.py")
 VISION_SRC_PATH = Path("src/vision_eval.py")
+# 最終アプリにそのまま埋め込む補助モジュール（相対import以外でパッケージ内モジュールに依存しないこと）
+SUPPORT_SRC_PATHS = [
+    Path("src/verdict_schema.py"),
+    Path("src/eval_cache.py"),
+    Path("src/result_store.py"),
+    Path("src/hedging.py"),
+    Path("src/failover.py"),
+]
+
+
+BACKGROUND_NAME = "background_{digest}.png"  # 内容のハッシュで名前を付け、ビルドごとの背景が混ざらないようにする
+EXTRA_FILES = [".env.example"]
+# ビルドごとに書き出す（共有の requirements.txt だと、古いビルドを配布するときに別のビルドの依存が渡ってしまう）
+REQUIREMENTS_NAME = "requirements_{digest}.txt"
+REQUIREMENTS_PATH = Path("requirements.txt")
+# 関数内で遅延importするモジュールのうち、バンドルの設定で使われるもの（キーが有効なときだけ requirements に入れる）
+OPTIONAL_IMPORTS = {"cv2": "preprocess", "numpy": "preprocess"}
+# import名と配布名が異なるもの（インストールされていない環境での対応表）
+IMPORT_TO_DIST = {"PIL": "pillow", "cv2": "opencv-python-headless", "dotenv": "python-dotenv"}
+MANIFEST_NAME = "manifest.json"
+LATEST_NAME = "runtime_app_latest.py"
+KEEP_BUILDS = 5  # 残すビルドの数（古いものから削除。最新は常に残る）
 
 
 def _sanitize_prompt_bundle(bundle: dict) -> dict:
@@ -19,16 +50,29 @@ def _sanitize_prompt_bundle(bundle: dict) -> dict:
     return clean
 
 
-def generate_runtime_app(prompt_bundle: dict, out_dir: str = "prod_app"):
+def generate_runtime_app(prompt_bundle: dict, out_dir: str = "prod_app", keep: int = KEEP_BUILDS):
+    """最終アプリを `runtime_app_<ハッシュ>.py` として出力し、(絶対パス, out_dir からの相対パス) を返す
+
+    ハッシュはアプリのコード（バンドルと埋め込むソース）と同梱ファイルの内容から計算する。
+    同じ内容のビルドが manifest.json にあれば何も書き込まない。`runtime_app_latest.py` は常に最新のビルドと同じ内容で、
+    `keep` 件を超えた古いビルドは削除する。依存パッケージはビルドごとに `requirements_<ハッシュ>.txt` へ書き出し、
+    manifest.json から参照する（古いビルドと一緒に削除する）。処理量は既存のビルド数に依存しない。
+    """
     os.makedirs(out_dir, exist_ok=True)
-    app_path = os.path.join(out_dir, "runtime_app.py")
-    app_path = _ensure_unique_path(app_path)
-    rel_app_path = os.path.relpath(app_path, out_dir)
 
     prompt_bundle = _sanitize_prompt_bundle(prompt_bundle)
-
-    llm_source = _augment_llm_module_source(_load_llm_module_source())
+    assets = {}
+    preprocess = prompt_bundle.get("preprocess") or {}
+    if preprocess.get("background_path"):
+        # 背景差分用の背景画像はアプリと同じフォルダに同梱し、実行時にアプリの場所から解決する
+        background = Path(preprocess["background_path"]).read_bytes()
+        name = BACKGROUND_NAME.format(digest=hashlib.sha256(background).hexdigest()[:12])
+        preprocess["background_path"] = name
+        assets[name] = background
+
+    llm_source = _strip_relative_imports(_load_llm_module_source())
     vision_source = _rewrite_run_vision_eval(_load_vision_module_source())
+    support_sources = [(path, _load_support_module_source(path)) for path in SUPPORT_SRC_PATHS]
 
     header_code = dedent(
         """\
@@ -88,6 +132,9 @@ def generate_runtime_app(prompt_bundle: dict, out_dir: str = "prod_app"):
 
     ui_code = f"""
 PROMPT_BUNDLE = {prompt_json}
+SPEC_VERSION = spec_version(PROMPT_BUNDLE)
+if PROMPT_BUNDLE.get("preprocess", {{}}).get("background_path"):
+    PROMPT_BUNDLE["preprocess"]["background_path"] = str(APP_DIR / PROMPT_BUNDLE["preprocess"]["background_path"])
 
 with st.sidebar:
     st.header("APIキー設定")
@@ -106,15 +153,98 @@ provider = st.selectbox("プロバイダ", ["OpenAI", "Gemini"])
 model = st.text_input("モデル名", os.getenv("OPENAI_MODEL" if provider == "OpenAI" else "GEMINI_MODEL", ""))
 temperature = st.slider("temperature", 0.0, 1.5, 0.2, 0.05)
 max_tokens = st.number_input("max_output_tokens", 256, 16384, 4096, step=128)
+if PROMPT_BUNDLE.get("max_tokens"):
+    st.caption(f"この仕様では判定実績から決めた max_output_tokens={{PROMPT_BUNDLE['max_tokens']}} を使います（打ち切り時は自動で引き上げ）。")
+
+with st.sidebar:
+    st.header("レイテンシ予算")
+    deadline_s = st.number_input("1回の検査の期限（秒）", 2.0, 300.0, float(os.getenv("AVI_DEADLINE_S", "30")), step=1.0)
+    use_hedging = st.checkbox("遅い応答に重複リクエストを送る（ヘッジ）", value=True)
+    fallback_verdict = st.selectbox("期限切れ時の判定", ["NG", "OK"], index=0)
+    st.header("フェイルオーバー")
+    failover_provider = st.selectbox("障害時の切り替え先", ["なし", "Gemini" if provider == "OpenAI" else "OpenAI"])
+    failover_model = st.text_input(
+        "切り替え先のモデル名", os.getenv("GEMINI_MODEL" if failover_provider == "Gemini" else "OPENAI_MODEL", "")
+    )
+
+
+@st.cache_resource
+def _result_store():
+    return ResultStore(os.getenv("AVI_RESULT_DB") or str(APP_DIR / "eval_results.sqlite"))
+
+
+@st.cache_resource
+def _client(provider_name: str, model_name: str, temp: float, tokens: int, deadline: float, fallback: str, hedging: bool, failover: str, failover_model_name: str):
+    # レイテンシ統計・ブレーカーの状態を再実行をまたいで保持するため、設定ごとに1つだけ作る
+    client = LLMProvider(provider_name=provider_name, model=model_name, temperature=temp, max_tokens=tokens, timeout=deadline)
+    if failover != "なし":
+        backup = LLMProvider(provider_name=failover, model=failover_model_name, temperature=temp, max_tokens=tokens, timeout=deadline)
+        client = FailoverProvider([client, backup])
+    if hedging:
+        client = HedgedProvider(client, HedgePolicy(deadline_s=deadline, fallback_verdict=fallback))
+    return client
+
+
+def _current_client():
+    return _client(
+        provider, model, float(temperature), int(max_tokens), float(deadline_s), fallback_verdict,
+        use_hedging, failover_provider, failover_model,
+    )
+
 
 up = st.file_uploader("画像をアップロード", type=["png", "jpg", "jpeg"])
 if up:
     img = Image.open(up).convert("RGB")
     st.image(img, caption=up.name)
+    expected = st.selectbox("想定判定（任意・正解率の集計用）", ["未指定", "OK", "NG"])
     if st.button("判定する"):
-        client = LLMProvider(provider_name=provider, model=model, temperature=temperature, max_tokens=int(max_tokens))
+        client = _current_client()
         decision = run_vision_eval(client, PROMPT_BUNDLE, img)
-        st.write(f"判定: {{decision.get('verdict', 'UNKNOWN')}} / 理由: {{decision.get('details', '-')}}")
+        answered = getattr(client, "last_used", None) or client
+        if decision.get("timed_out"):
+            st.warning(f"期限（{{deadline_s:.0f}} 秒）内に応答がなかったため、既定の判定を返しました。")
+        if decision.get("verdict") == "ERROR":
+            st.error(f"判定不能（ERROR）: {{decision.get('details', '-')}}")
+        else:
+            st.write(f"判定: {{decision.get('verdict', 'UNKNOWN')}} / 理由: {{decision.get('details', '-')}}")
+        if PROMPT_BUNDLE.get("checks"):
+            texts = {{check["id"]: check["text"] for check in PROMPT_BUNDLE["checks"]}}
+            for check in decision.get("checks", []):
+                st.write(f"- {{texts.get(check.get('id'), check.get('id', '-'))}}: {{check.get('result')}}")
+            if decision.get("skipped_checks"):
+                st.caption(f"NG が確定したため {{len(decision['skipped_checks'])}} 項目の判定を省略しました。")
+        if answered.provider_name != provider:
+            st.caption(f"{{provider}} が応答しないため {{answered.provider_name}}（{{answered.model or '既定モデル'}}）で判定しました。")
+        _result_store().record(
+            image_digest(img), SPEC_VERSION, answered.provider_name, answered.model, decision,
+            expected=None if expected == "未指定" else expected, source="runtime",
+        )
+
+with st.expander("判定履歴", expanded=False):
+    store = _result_store()
+    accuracy = store.accuracy(SPEC_VERSION)
+    percentiles = store.latency_percentiles(SPEC_VERSION, percentiles=(50, 95))
+    st.write(
+        f"この仕様での判定 {{store.count(SPEC_VERSION)}} 件 / 正解率 "
+        + ("-" if accuracy["accuracy"] is None else f"{{accuracy['accuracy']:.0%}}（{{accuracy['total']}}件）")
+        + f" / p50 {{percentiles[50] or 0:.0f}} ms・p95 {{percentiles[95] or 0:.0f}} ms"
+    )
+    if use_hedging:
+        hedge = _current_client().metrics()
+        st.write(
+            f"ヘッジ率 {{hedge['hedge_rate']:.0%}} / 期限切れ {{hedge['timeout_rate']:.0%}}（{{hedge['calls']}} 回中）"
+            + ("" if hedge["tail_saved_ms_mean"] is None else f" / ヘッジによる短縮 平均 {{hedge['tail_saved_ms_mean']:.0f}} ms")
+        )
+    parse_stats = PARSE_STATS.snapshot()
+    st.caption(
+        f"応答JSONの検証: そのまま {{parse_stats['parsed']}} / 修復 {{parse_stats['repaired']}}"
+        f" / 再問い合わせ {{parse_stats['retried']}} / 失敗 {{parse_stats['failed']}}"
+    )
+    if failover_provider != "なし":
+        for backend in _current_client().status():
+            st.write(f"- {{backend['backend']}}: {{backend['state']}} / 失敗率 {{backend['error_rate']:.0%}}（直近 {{backend['calls']}} 件）")
+    for row in store.recent(20, SPEC_VERSION):
+        st.write(f"- {{'判定不能' if row['verdict'] == 'ERROR' else row['verdict']}}（想定: {{row['expected'] or '-'}}） / {{row['latency_ms'] or 0:.0f}} ms / {{row['model'] or '-'}}")
 """.strip()
 
     app_code_parts = [
@@ -123,21 +253,217 @@ if up:
         llm_source,
         "# === Embedded from src/vision_eval.py ===",
         vision_source,
-        ui_code,
     ]
+    for path, source in support_sources:
+        app_code_parts.extend([f"# === Embedded from {path.as_posix()} ===", source])
+    app_code_parts.append(ui_code)
 
     app_code = "\n\n".join(app_code_parts) + "\n"
 
-    with open(app_path, "w", encoding="utf-8") as f:
-        f.write(app_code)
-
-    for extra in ["requirements.txt", ".env.example"]:
-        if os.path.exists(extra):
-            shutil.copy(extra, os.path.join(out_dir, extra))
+    # 配布先で構文エラーに気付くのではなく、ビルド時に失敗させる
+    compile(app_code, "runtime_app.py", "exec")
+    extras = {name: Path(name).read_bytes() for name in EXTRA_FILES if os.path.exists(name)}
+    requirements = ("\n".join(runtime_requirements(app_code, prompt_bundle)) + "\n").encode("utf-8")
+    digest = hashlib.sha256(app_code.encode("utf-8"))
+    for name, content in sorted({**extras, "requirements.txt": requirements}.items()):
+        digest.update(name.encode("utf-8") + b"\0" + content)
+    build_hash = digest.hexdigest()
+    rel_app_path = f"runtime_app_{build_hash[:12]}.py"
+    app_path = os.path.join(out_dir, rel_app_path)
+    zipapp_name = f"runtime_app_{build_hash[:12]}.pyz"
+    requirements_name = REQUIREMENTS_NAME.format(digest=build_hash[:12])
+
+    manifest = _read_manifest(out_dir)
+    builds = [build for build in manifest["builds"] if build.get("hash") != build_hash]
+    unchanged = (
+        manifest.get("latest") == rel_app_path
+        and os.path.exists(app_path)
+        and os.path.exists(os.path.join(out_dir, LATEST_NAME))
+        and os.path.exists(os.path.join(out_dir, requirements_name))
+    )
+    if not unchanged:
+        _write_if_changed(app_path, app_code.encode("utf-8"))
+        _write_if_changed(os.path.join(out_dir, LATEST_NAME), app_code.encode("utf-8"))
+        for name, content in {**assets, **extras}.items():
+            _write_if_changed(os.path.join(out_dir, name), content)
+        _write_if_changed(os.path.join(out_dir, requirements_name), requirements)
+        zipapp = _build_zipapp(rel_app_path, app_code, assets, requirements_name, requirements)
+        _write_if_changed(os.path.join(out_dir, zipapp_name), zipapp)
+        builds.append(
+            {
+                "file": rel_app_path,
+                "hash": build_hash,
+                "spec_version": spec_version(prompt_bundle),
+                "zipapp": zipapp_name,
+                "requirements": requirements_name,
+                "assets": sorted(assets),
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+        )
+        builds = _prune_builds(out_dir, builds, keep)
+        _write_manifest(out_dir, {"latest": rel_app_path, "builds": builds})
 
     return os.path.abspath(app_path), rel_app_path
 
 
+def runtime_requirements(app_code: str, prompt_bundle: dict) -> list:
+    """生成したアプリが実際にimportするサードパーティの配布だけを、バージョンを固定して返す
+
+    モジュール直下の import は必須、関数内の遅延 import は OPTIONAL_IMPORTS でバンドルの設定が有効なものだけを含める。
+    バージョンはリポジトリの requirements.txt の指定を満たすインストール済みのものに固定し、
+    満たさない（または未インストールの）場合は requirements.txt の指定をそのまま使う。
+    """
+    modules = set()
+    for node in ast.walk(ast.parse(app_code)):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and not node.level and node.module:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            root = name.split(".")[0]
+            if root in sys.stdlib_module_names:
+                continue
+            if node.col_offset == 0 or prompt_bundle.get(OPTIONAL_IMPORTS.get(root, "")):
+                modules.add(root)
+
+    declared = {}
+    if REQUIREMENTS_PATH.exists():
+        for line in REQUIREMENTS_PATH.read_text(encoding="utf-8").splitlines():
+            line = line.split("#", 1)[0].strip()
+            if line:
+                declared[_canonical(re.split(r"[<>=!~;\[ ]", line, maxsplit=1)[0])] = line
+
+    distributions = importlib.metadata.packages_distributions()
+    requirements = set()
+    for module in modules:
+        dist = (distributions.get(module) or [IMPORT_TO_DIST.get(module, module)])[0]
+        requirements.add(_pin(dist, declared.get(_canonical(dist), dist)))
+    return sorted(requirements, key=str.lower)
+
+
+def _canonical(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _pin(dist: str, declared: str) -> str:
+    try:
+        installed = importlib.metadata.version(dist)
+    except importlib.metadata.PackageNotFoundError:
+        return declared
+    try:
+        from packaging.requirements import Requirement
+    except ImportError:
+        return declared if declared != dist else f"{dist}=={installed}"
+    requirement = Requirement(declared)
+    if requirement.specifier and not requirement.specifier.contains(installed, prereleases=True):
+        return declared
+    return f"{requirement.name}=={installed}"
+
+
+ZIPAPP_MAIN = dedent(
+    """\
+    # 同梱したアプリと背景画像を .pyz と同じフォルダに展開し、streamlit run で起動する
+    # （依存パッケージは同梱しないため、先に requirements を pip install しておく）
+    import sys
+    import zipfile
+    from pathlib import Path
+
+    APP_NAME = {app_name!r}
+    FILES = {files!r}
+    REQUIREMENTS = {requirements_name!r}
+
+
+    def main() -> None:
+        try:
+            from streamlit.web import cli
+        except ImportError:
+            sys.exit(f"streamlit がインストールされていません。先に pip install -r {{REQUIREMENTS}} を実行してください。")
+        archive = Path(sys.argv[0]).resolve()
+        with zipfile.ZipFile(archive) as zf:
+            for name in FILES:
+                data = zf.read(name)
+                path = archive.parent / name
+                if not path.exists() or path.read_bytes() != data:
+                    path.write_bytes(data)
+
+        sys.argv = ["streamlit", "run", str(archive.parent / APP_NAME), *sys.argv[1:]]
+        sys.exit(cli.main())
+
+
+    main()
+    """
+)
+
+
+def _build_zipapp(app_name: str, app_code: str, assets: dict, requirements_name: str, requirements: bytes) -> bytes:
+    """`python runtime_app_<ハッシュ>.pyz` で起動できる zipapp（アプリ・背景画像・requirements を同梱）
+
+    バンドルはアプリのコードに埋め込み済み。依存パッケージは同梱しないため、配布先で requirements を pip install する。
+    """
+    main = ZIPAPP_MAIN.format(app_name=app_name, files=[app_name, *sorted(assets)], requirements_name=requirements_name)
+    members = {
+        "__main__.py": main.encode("utf-8"),
+        app_name: app_code.encode("utf-8"),
+        "requirements.txt": requirements,
+        **assets,
+    }
+    buffer = io.BytesIO()
+    buffer.write(b"#!/usr/bin/env python3\n")
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, content in members.items():
+            # 時刻を固定し、同じ内容なら同じバイト列になるようにする
+            zf.writestr(zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0)), content, compress_type=zipfile.ZIP_DEFLATED)
+    return buffer.getvalue()
+
+
+def _read_manifest(out_dir: str) -> dict:
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {"latest": None, "builds": []}
+    manifest.setdefault("builds", [])
+    return manifest
+
+
+def _write_manifest(out_dir: str, manifest: dict) -> None:
+    _write_if_changed(os.path.join(out_dir, MANIFEST_NAME), json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+
+
+def _prune_builds(out_dir: str, builds: list, keep: int) -> list:
+    # 古いビルドから削除する。残したビルドが参照する同梱ファイル（背景画像）は消さない
+    kept, dropped = builds[-max(1, keep):], builds[:-max(1, keep)]
+    in_use = {asset for build in kept for asset in build.get("assets", [])}
+    for build in dropped:
+        for name in [build["file"], build.get("zipapp"), build.get("requirements"), *build.get("assets", [])]:
+            if not name:
+                continue
+            if name in in_use:
+                continue
+            try:
+                os.remove(os.path.join(out_dir, name))
+            except FileNotFoundError:
+                pass
+    return kept
+
+
+def _write_if_changed(path: str, content: bytes) -> None:
+    # 一時ファイルに書いてから置き換える（実行中のアプリが書きかけのファイルを読まないように）
+    try:
+        with open(path, "rb") as f:
+            if f.read() == content:
+                return
+    except FileNotFoundError:
+        pass
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
 def _load_llm_module_source() -> str:
     if not LLM_SRC_PATH.exists():
         raise FileNotFoundError(f"LLM provider module not found: {LLM_SRC_PATH}")
@@ -150,308 +476,16 @@ def _load_vision_module_source() -> str:
     return VISION_SRC_PATH.read_text(encoding="utf-8").strip()
 
 
-def _augment_llm_module_source(source: str) -> str:
-    augmentation = dedent(
-        """\
-        # --- Runtime augmentation for LLMProvider (inject real API calls) ---
-        import json as _runtime_json
-        import re as _runtime_re
-        from typing import Any as _runtime_Any, Dict as _runtime_Dict, List as _runtime_List, Optional as _runtime_Optional, Tuple as _runtime_Tuple
-        import requests as _runtime_requests
-
-
-        def _runtime_split_messages(messages: _runtime_List[_runtime_Dict[str, _runtime_Any]]) -> _runtime_Tuple[str, str, _runtime_Optional[str], _runtime_Optional[_runtime_Tuple[str, str]]]:
-            system_text = ""
-            user_text = ""
-            image_uri = None
-            inline_data = None
-            for message in messages:
-                role = message.get("role")
-                if role == "system":
-                    system_text = str(message.get("content", ""))
-                elif role == "user":
-                    content = message.get("content", {})
-                    if isinstance(content, dict):
-                        user_text = str(content.get("text", ""))
-                        image_uri = content.get("image_url")
-                        if isinstance(image_uri, str) and image_uri.startswith("data:"):
-                            header, encoded = image_uri.split(",", 1)
-                            mime = "image/png"
-                            if ";" in header:
-                                meta = header[5:]
-                                mime = meta.split(";")[0] or mime
-                            inline_data = (mime, encoded)
-                    else:
-                        user_text = str(content)
-            return system_text, user_text, image_uri, inline_data
-
-
-        def _runtime_parse_json_response(text: str, fallback_reason: _runtime_Optional[str] = None) -> _runtime_Dict[str, _runtime_Any]:
-            if not text:
-                details = fallback_reason or "empty response"
-                return {"verdict": "NG", "details": details, "checks": []}
-            try:
-                return _runtime_json.loads(text)
-            except _runtime_json.JSONDecodeError:
-                match = _runtime_re.search(r"\\{.*\\}", text, _runtime_re.DOTALL)
-                if match:
-                    try:
-                        return _runtime_json.loads(match.group(0))
-                    except _runtime_json.JSONDecodeError:
-                        pass
-            details = fallback_reason or text
-            return {"verdict": "NG", "details": details, "checks": []}
-
-
-        def _extract_error_details(response: _runtime_requests.Response) -> str:
-            try:
-                payload = response.json()
-                if isinstance(payload, dict):
-                    err = payload.get("error")
-                    if isinstance(err, dict):
-                        message = err.get("message")
-                        if message:
-                            return message
-                    return str(payload)
-            except ValueError:
-                pass
-            return response.text or f"HTTP {response.status_code}"
-
-
-        def _runtime_openai_chat(self, messages: _runtime_List[_runtime_Dict[str, _runtime_Any]]) -> _runtime_Dict[str, _runtime_Any]:
-            openai_api_key = os.getenv("OPENAI_API_KEY", "").strip()
-            if not openai_api_key:
-                raise RuntimeError("OPENAI_API_KEYが設定されていません。")
-            system_text, user_text, image_uri, _ = _runtime_split_messages(messages)
-            model = self.model or os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-            content: _runtime_List[_runtime_Dict[str, _runtime_Any]] = []
-            if user_text:
-                content.append({"type": "text", "text": user_text})
-            if image_uri:
-                content.append({"type": "image_url", "image_url": {"url": image_uri}})
-            if not content:
-                content.append({"type": "text", "text": ""})
-
-            payload = {
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": system_text},
-                    {"role": "user", "content": content},
-                ],
-                "response_format": {"type": "json_object"},
-            }
-            if self.temperature not in (None, 1):
-                payload["temperature"] = self.temperature
-            if self.max_tokens:
-                payload["max_completion_tokens"] = self.max_tokens
-            request_kwargs = {
-                "url": "https://api.openai.com/v1/chat/completions",
-                "headers": {
-                    "Authorization": f"Bearer {openai_api_key}",
-                    "Content-Type": "application/json",
-                },
-                "json": payload,
-                "timeout": 120,
-            }
-            if os.getenv("AVI_DEBUG") in {"1", "true", "True"}:
-                printable_messages = []
-                for _msg in messages:
-                    msg_copy = dict(_msg)
-                    content = msg_copy.get("content")
-                    if isinstance(content, dict) and "image_url" in content:
-                        msg_copy["content"] = dict(content)
-                        msg_copy["content"]["image_url"] = "<image omitted>"
-                    printable_messages.append(msg_copy)
-                print("=== OpenAI メッセージ ===")
-                print(json.dumps(printable_messages, ensure_ascii=False, indent=2))
-            response = _runtime_requests.post(**request_kwargs)
-            try:
-                response.raise_for_status()
-            except _runtime_requests.HTTPError:
-                details = _extract_error_details(response)
-                if "maximum context length" in details or "maximum output length" in details or "finish_reason" in details:
-                    result = {
-                        "verdict": "ERROR",
-                        "details": "出力が途中で打ち切られました。max_output_tokens を増やして再実行してください。",
-                        "checks": [],
-                        "note": details,
-                    }
-                    return {"output_text": details, "json": result}
-                if "temperature" in details and "default (1)" in details:
-                    payload.pop("temperature", None)
-                    request_kwargs["json"] = payload
-                    response = _runtime_requests.post(**request_kwargs)
-                    try:
-                        response.raise_for_status()
-                    except _runtime_requests.HTTPError:
-                        details = _extract_error_details(response)
-                        return {"output_text": details, "json": {"verdict": "ERROR", "details": details, "checks": []}}
-                else:
-                    return {"output_text": details, "json": {"verdict": "ERROR", "details": details, "checks": []}}
-            data = response.json()
-            if os.getenv("AVI_DEBUG") in {"1", "true", "True"}:
-                print("=== OpenAI レスポンス ===")
-                print(json.dumps(data, ensure_ascii=False, indent=2))
-            choices = data.get("choices") or []
-            if not choices:
-                raise RuntimeError("OpenAIレスポンスにchoicesが含まれていません。")
-            message_content = choices[0].get("message", {}).get("content", "")
-            if isinstance(message_content, list):
-                text = "\\n".join(
-                    part.get("text", "") for part in message_content if part.get("type") == "text"
-                ).strip()
-            else:
-                text = str(message_content).strip()
-            fallback_reason = None
-            if data.get("choices"):
-                finish_reason = data["choices"][0].get("finish_reason")
-                if finish_reason == "length":
-                    fallback_reason = "出力が途中で打ち切られました。max_output_tokens を増やして再実行してください。"
-            parsed = _runtime_parse_json_response(text, fallback_reason)
-            return {"output_text": text, "json": parsed}
-
-
-        def _runtime_gemini_chat(self, messages: _runtime_List[_runtime_Dict[str, _runtime_Any]]) -> _runtime_Dict[str, _runtime_Any]:
-            gemini_api_key = os.getenv("GEMINI_API_KEY", "").strip()
-            if not gemini_api_key:
-                raise RuntimeError("GEMINI_API_KEYが設定されていません。")
-            system_text, user_text, _, inline_data = _runtime_split_messages(messages)
-            model = self.model or os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
-            prompt_text = "\\n\\n".join(filter(None, [system_text, user_text]))
-            parts: _runtime_List[_runtime_Dict[str, _runtime_Any]] = []
-            if prompt_text:
-                parts.append({"text": prompt_text})
-            if inline_data:
-                mime, data_b64 = inline_data
-                parts.append({"inlineData": {"mimeType": mime, "data": data_b64}})
-            generation_config = {}
-            if self.temperature not in (None, 1):
-                generation_config["temperature"] = self.temperature
-            if self.max_tokens:
-                generation_config["maxOutputTokens"] = self.max_tokens
-            payload = {
-                "contents": [
-                    {
-                        "role": "user",
-                        "parts": parts or [{"text": prompt_text}],
-                    }
-                ],
-                "generationConfig": generation_config,
-                "responseMimeType": "application/json",
-            }
-            url = (
-                f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
-                f"?key={gemini_api_key}"
-            )
-            request_kwargs = {
-                "url": url,
-                "headers": {"Content-Type": "application/json"},
-                "json": payload,
-                "timeout": 120,
-            }
-            print("=== Gemini メッセージ ===")
-            print(json.dumps(messages, ensure_ascii=False, indent=2))
-            if os.getenv("AVI_DEBUG") in {"1", "true", "True"}:
-                printable_messages = []
-                for _msg in messages:
-                    msg_copy = dict(_msg)
-                    content = msg_copy.get("content")
-                    if isinstance(content, dict) and "image_url" in content:
-                        msg_copy["content"] = dict(content)
-                        msg_copy["content"]["image_url"] = "<image omitted>"
-                    printable_messages.append(msg_copy)
-                print("=== Gemini メッセージ ===")
-                print(json.dumps(printable_messages, ensure_ascii=False, indent=2))
-            response = _runtime_requests.post(**request_kwargs)
-            try:
-                response.raise_for_status()
-            except _runtime_requests.HTTPError:
-                details = _extract_error_details(response)
-                if "maximum" in details and "tokens" in details:
-                    result = {
-                        "verdict": "ERROR",
-                        "details": "出力が途中で打ち切られました。max_output_tokens を増やして再実行してください。",
-                        "checks": [],
-                        "note": details,
-                    }
-                    return {"output_text": details, "json": result}
-                if "temperature" in details and "default (1)" in details:
-                    payload["generationConfig"].pop("temperature", None)
-                    request_kwargs["json"] = payload
-                    response = _runtime_requests.post(**request_kwargs)
-                    try:
-                        response.raise_for_status()
-                    except _runtime_requests.HTTPError:
-                        details = _extract_error_details(response)
-                        return {"output_text": details, "json": {"verdict": "ERROR", "details": details, "checks": []}}
-                else:
-                    return {"output_text": details, "json": {"verdict": "ERROR", "details": details, "checks": []}}
-            data = response.json()
-            if os.getenv("AVI_DEBUG") in {"1", "true", "True"}:
-                print("=== Gemini レスポンス ===")
-                print(json.dumps(data, ensure_ascii=False, indent=2))
-            candidates = data.get("candidates") or []
-            text = ""
-            if candidates:
-                parts = candidates[0].get("content", {}).get("parts", [])
-                text = "".join(part.get("text", "") for part in parts if "text" in part).strip()
-            fallback_reason = None
-            if candidates:
-                finish_reason = candidates[0].get("finishReason")
-                if finish_reason == "MAX_TOKENS":
-                    fallback_reason = "出力が途中で打ち切られました。max_output_tokens を増やして再実行してください。"
-            parsed = _runtime_parse_json_response(text, fallback_reason)
-            return {"output_text": text, "json": parsed}
-
-
-        LLMProvider._openai_chat = _runtime_openai_chat  # type: ignore[attr-defined]
-        LLMProvider._gemini_chat = _runtime_gemini_chat  # type: ignore[attr-defined]
-        """
-    ).strip()
-    return f"{source}\n\n{augmentation}"
+def _load_support_module_source(path: Path) -> str:
+    if not path.exists():
+        raise FileNotFoundError(f"Support module not found: {path}")
+    return path.read_text(encoding="utf-8").strip()
 
 
-def _rewrite_run_vision_eval(source: str) -> str:
-    rewritten = dedent(
-        """\
-        import json
-        from typing import Dict, Any
-        from PIL import Image
+def _strip_relative_imports(source: str) -> str:
+    # 単一ファイルに埋め込むため、パッケージ内の相対importを取り除く（参照先は同じファイル内に埋め込まれる）
+    return "\n".join(line for line in source.splitlines() if not line.startswith("from .")).strip()
 
-        def run_vision_eval(provider: LLMProvider, prompt_bundle: Dict[str, Any], img: Image.Image) -> Dict[str, Any]:
-            system = prompt_bundle["system"]
-            width, height = img.size
-            user = {
-                "spec_text": prompt_bundle["user"]["spec_text"],
-                "instruction": "画像全体が仕様に合致するか検証し、OK/NGと理由をJSONで一貫して回答してください。",
-                "image_size": {"width": width, "height": height},
-            }
-            datauri = provider.pil_to_datauri(img)
-            messages = [
-                {"role": "system", "content": system},
-                {"role": "user", "content": {"text": json.dumps(user, ensure_ascii=False), "image_url": datauri}},
-            ]
-            resp = provider.chat_vision(messages)
-            result = resp.get("json", {})
-            verdict = str(result.get("verdict", "")).upper()
-            if verdict not in {"OK", "NG"}:
-                result["verdict"] = "NG"
-                result["details"] = result.get("details") or "モデルから有効な判定が返らなかったためNGとします。"
-            result.setdefault("details", "")
-            return result
-        """
-    ).strip()
-    return rewritten
-
-
-def _ensure_unique_path(initial_path: str) -> str:
-    if not os.path.exists(initial_path):
-        return initial_path
-    base = Path(initial_path)
-    stem, suffix = base.stem, base.suffix
-    counter = 1
-    while True:
-        candidate = base.with_name(f"{stem}_{counter}{suffix}")
-        if not candidate.exists():
-            return str(candidate)
-        counter += 1
+
+def _rewrite_run_vision_eval(source: str) -> str:
+    return _strip_relative_imports(source)
@@ -0,0 +1,361 @@
+import base64
+import io
+import json
+import math
+import threading
+import warnings
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from .llm_providers import LLMProvider
+from .vision_eval import prepare_request
+
+
+# モデル名の接頭辞ごとの料金（USD / 100万トークン、(入力, 出力)）。最も長く一致した接頭辞を使う
+# 公開価格からの目安のため、契約に合わせて BudgetGovernor(prices=...) で上書きする
+PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+    "gemini-1.5-flash": (0.075, 0.30),
+    "gemini-1.5-pro": (1.25, 5.00),
+    "gemini-2.0-flash": (0.10, 0.40),
+}
+DEFAULT_PRICE = (2.50, 10.00)  # 未知のモデルは高めに見積もる
+DEFAULT_COMPLETION_TOKENS = {"json": 300, "line": 40}  # 実績がないときの1回あたりの出力トークン数
+
+
+class BudgetExceeded(RuntimeError):
+    """予算の上限に達して呼び出しを止めたときに送出する"""
+
+
+def known_price(model: str, prices: Optional[Dict[str, Tuple[float, float]]] = None) -> Optional[Tuple[float, float]]:
+    """料金表にあるモデルの料金（無ければ None）"""
+    table = prices or PRICES
+    matches = [prefix for prefix in table if (model or "").lower().startswith(prefix)]
+    return table[max(matches, key=len)] if matches else None
+
+
+def price_for(model: str, prices: Optional[Dict[str, Tuple[float, float]]] = None) -> Tuple[float, float]:
+    return known_price(model, prices) or DEFAULT_PRICE
+
+
+def _billed_model(provider: Any) -> str:
+    """料金の計算に使うモデル名（model が空なら実際に呼び出す既定のモデル）"""
+    resolve = getattr(provider, "resolved_model", None)
+    return str(resolve() if callable(resolve) else getattr(provider, "model", "") or "")
+
+
+def estimate_text_tokens(text: str) -> int:
+    """文字数からの概算（ASCII は4文字で1トークン、日本語などは1文字1トークン）"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+def estimate_image_tokens(provider_name: str, model: str, width: int, height: int) -> int:
+    """送信する画像サイズからの画像トークン数（各社が公開しているタイル計算の概算）"""
+    if provider_name.lower() == "gemini":
+        if width <= 384 and height <= 384:
+            return 258
+        return 258 * math.ceil(width / 768) * math.ceil(height / 768)
+    # OpenAI: 2048 四方に収めてから短辺を 768 に縮め、512 四方のタイル数で数える
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    base, per_tile = (2833, 5667) if "mini" in (model or "").lower() else (85, 170)
+    return base + per_tile * tiles
+
+
+def cost_usd(model: str, prompt_tokens: int, completion_tokens: int, prices: Optional[Dict[str, Tuple[float, float]]] = None) -> float:
+    price_in, price_out = price_for(model, prices)
+    return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+
+def estimate_batch(
+    provider: Any,
+    prompt_bundle: Dict[str, Any],
+    images: Iterable[Image.Image],
+    completion_tokens: Sequence[int] = (),
+    prices: Optional[Dict[str, Tuple[float, float]]] = None,
+) -> Dict[str, Any]:
+    """バッチを流す前の呼び出し回数・トークン数・費用の見積もり
+
+    画像は前処理（切り出し）後の送信サイズ、プロンプトはバンドルのテキスト長、出力はこの仕様の出力トークン実績の平均
+    （実績がなければ DEFAULT_COMPLETION_TOKENS）から見積もる。検査項目ごとの判定では項目数ぶん呼ぶ前提の上限になる。
+    """
+    provider_name = getattr(provider, "provider_name", "OpenAI")
+    model = getattr(provider, "model", "")
+    checks = prompt_bundle.get("checks") or []
+    calls_per_image = len(checks) if len(checks) >= 2 else 1
+    system = prompt_bundle.get("check_system") if calls_per_image > 1 else prompt_bundle.get("system")
+    samples = [int(n) for n in completion_tokens if n]
+    mode = "line" if prompt_bundle.get("output_mode") == "line" or calls_per_image > 1 else "json"
+    per_call_completion = sum(samples) / len(samples) if samples else DEFAULT_COMPLETION_TOKENS[mode]
+
+    images_count = 0
+    prompt_tokens = 0
+    for img in images:
+        # エンコードせずに送信サイズとユーザープロンプトだけを組み立てる
+        prepared = prepare_request(prompt_bundle, img, encode=lambda *_, **__: "")
+        size = prepared["user"]["image_size"]
+        text_tokens = estimate_text_tokens(str(system or "")) + estimate_text_tokens(json.dumps(prepared["user"], ensure_ascii=False))
+        prompt_tokens += (text_tokens + estimate_image_tokens(provider_name, model, size["width"], size["height"])) * calls_per_image
+        images_count += 1
+    completion = math.ceil(per_call_completion * calls_per_image * images_count)
+    return {
+        "images": images_count,
+        "calls": images_count * calls_per_image,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion,
+        "cost_usd": cost_usd(model, prompt_tokens, completion, prices),
+        "completion_basis": "history" if samples else "default",
+    }
+
+
+@dataclass
+class BudgetLimits:
+    max_cost_usd: Optional[float] = None  # 費用の上限（None で無制限）
+    max_tokens: Optional[int] = None      # 合計トークン数の上限（None で無制限）
+    degrade_at: float = 0.8               # 上限に対するこの割合を超えたら節約モード（安いモデル・低解像度）に切り替える
+    on_limit: str = "pause"               # 上限に達したら "pause"（上限の引き上げか stop を待つ）/ "stop"（BudgetExceeded）
+
+
+class BudgetGovernor:
+    """応答の usage から費用とトークン数をリアルタイムに積算し、上限に応じて呼び出しを絞る
+
+    呼び出しの直前に `acquire()` で予算を確認し、応答後に `record()` で実際の使用量を加算する。
+    実行中の呼び出しは1回あたりの平均費用で見込んでおき、並列実行での上限超過を抑える。
+    料金表に無いモデルは DEFAULT_PRICE で積算し、モデルごとに1回警告して `status()["unpriced_models"]` に残す。
+    """
+
+    def __init__(self, limits: Optional[BudgetLimits] = None, prices: Optional[Dict[str, Tuple[float, float]]] = None) -> None:
+        self.limits = limits or BudgetLimits()
+        self.prices = prices
+        self._cond = threading.Condition()
+        self._spent_usd = 0.0
+        self._tokens = 0
+        self._calls = 0
+        self._in_flight = 0
+        self._stopped = False
+        self._paused = False
+        self._unpriced: Dict[str, int] = {}
+
+    def update_limits(self, limits: BudgetLimits) -> None:
+        """上限を差し替える（引き上げると一時停止中の呼び出しが再開する）"""
+        with self._cond:
+            self.limits = limits
+            self._cond.notify_all()
+
+    def stop(self) -> None:
+        """一時停止中・以降の呼び出しをすべて BudgetExceeded にする"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def reset(self) -> None:
+        with self._cond:
+            self._spent_usd = 0.0
+            self._tokens = 0
+            self._calls = 0
+            self._stopped = False
+            self._unpriced = {}
+            self._cond.notify_all()
+
+    # 上限に対する使用率（実行中の呼び出しの見込みを含む）。上限がなければ 0
+    def _usage_ratio_locked(self) -> float:
+        ratios = [0.0]
+        average = self._spent_usd / self._calls if self._calls else 0.0
+        tokens_average = self._tokens / self._calls if self._calls else 0.0
+        if self.limits.max_cost_usd is not None:
+            projected = self._spent_usd + average * self._in_flight
+            ratios.append(projected / self.limits.max_cost_usd if self.limits.max_cost_usd > 0 else math.inf)
+        if self.limits.max_tokens is not None:
+            projected = self._tokens + tokens_average * self._in_flight
+            ratios.append(projected / self.limits.max_tokens if self.limits.max_tokens > 0 else math.inf)
+        return max(ratios)
+
+    def acquire(self) -> bool:
+        """呼び出し1回分の予算を確保し、節約モードで呼ぶべきかを返す。上限到達時は待つか BudgetExceeded を送出する"""
+        with self._cond:
+            while True:
+                if self._stopped:
+                    raise BudgetExceeded(self._exceeded_message())
+                ratio = self._usage_ratio_locked()
+                if ratio < 1.0:
+                    break
+                if self.limits.on_limit == "stop":
+                    self._stopped = True
+                    continue
+                self._paused = True
+                self._cond.wait()
+            self._paused = False
+            self._in_flight += 1
+            return ratio >= self.limits.degrade_at
+
+    def release(self) -> None:
+        """acquire() で確保したまま呼び出さなかった分を戻す（使用量は加算しない）"""
+        with self._cond:
+            self._in_flight = max(0, self._in_flight - 1)
+            self._cond.notify_all()
+
+    def record(self, model: str, usage: Optional[Dict[str, Any]]) -> float:
+        """acquire() と対になる。応答の usage から費用を加算し、その呼び出しの費用を返す"""
+        usage = usage or {}
+        prompt_tokens = int(usage.get("prompt_tokens") or 0)
+        completion_tokens = int(usage.get("completion_tokens") or 0)
+        total = int(usage.get("total_tokens") or 0) or prompt_tokens + completion_tokens
+        cost = cost_usd(model, prompt_tokens, completion_tokens, self.prices)
+        unpriced = known_price(model, self.prices) is None
+        with self._cond:
+            first_unpriced = unpriced and model not in self._unpriced
+            if unpriced:
+                self._unpriced[model] = self._unpriced.get(model, 0) + 1
+            self._in_flight = max(0, self._in_flight - 1)
+            self._spent_usd += cost
+            self._tokens += total
+            self._calls += 1
+            self._cond.notify_all()
+        if first_unpriced:
+            warnings.warn(
+                f"モデル {model or '(未指定)'} の料金が料金表に無いため、既定の料金（入力 ${DEFAULT_PRICE[0]} / 出力 ${DEFAULT_PRICE[1]}、"
+                "100万トークンあたり）で積算します。BudgetGovernor(prices=...) で指定してください。"
+            )
+        return cost
+
+    @property
+    def degraded(self) -> bool:
+        with self._cond:
+            return self._usage_ratio_locked() >= self.limits.degrade_at
+
+    def _exceeded_message(self) -> str:
+        return f"予算の上限に達したため停止しました（費用 ${self._spent_usd:.4f} / トークン {self._tokens}）。"
+
+    def status(self) -> Dict[str, Any]:
+        with self._cond:
+            ratio = self._usage_ratio_locked()
+            if self._stopped:
+                state = "stopped"
+            elif self._paused:
+                state = "paused"
+            elif ratio >= self.limits.degrade_at:
+                state = "degraded"
+            else:
+                state = "ok"
+            return {
+                "state": state,
+                "spent_usd": self._spent_usd,
+                "tokens": self._tokens,
+                "calls": self._calls,
+                "in_flight": self._in_flight,
+                "usage_ratio": ratio,
+                "unpriced_models": dict(self._unpriced),
+            }
+
+
+class GovernedProvider:
+    """BudgetGovernor で呼び出しごとに予算を確認・積算するプロバイダ
+
+    run_vision_eval にそのまま渡せる。節約モードでは `degrade_provider`（安いモデル）で呼び、
+    `degrade_max_side` を指定すれば送信画像の長辺をその値まで縮める。応答には実際に応答したモデル（model）と、
+    節約モードなら degraded と送信サイズ（image_size）を付ける。
+    chat_text は usage を返さないため、プロンプトと応答の文字数から概算して積算する。
+    ScheduledProvider の内側に置くと、予算の確保（一時停止中の待ち）は `admission()` でスケジューラの枠を取る前に行う。
+    """
+
+    def __init__(self, provider: Any, governor: BudgetGovernor, degrade_provider: Any = None, degrade_max_side: Optional[int] = None) -> None:
+        self.provider = provider
+        self.governor = governor
+        self.degrade_provider = degrade_provider
+        self.degrade_max_side = degrade_max_side
+        self._admitted = threading.local()
+
+    def __getattr__(self, name: str) -> Any:
+        # provider_name / model / temperature などは元のプロバイダに委譲する（非同期API は予算を通らないため委譲しない）
+        if name in {"provider", "governor", "degrade_provider", "degrade_max_side", "_admitted"} or name.startswith("achat_"):
+            raise AttributeError(name)
+        return getattr(self.provider, name)
+
+    @contextmanager
+    def admission(self) -> Iterator[None]:
+        """このスレッドの次の呼び出し1回分の予算を先に確保する（呼ばれずに抜けたら確保を戻す）"""
+        self._admitted.degraded = self.governor.acquire()
+        try:
+            yield
+        finally:
+            if getattr(self._admitted, "degraded", None) is not None:
+                self._admitted.degraded = None
+                self.governor.release()
+
+    def _acquire(self) -> bool:
+        degraded = getattr(self._admitted, "degraded", None)
+        if degraded is None:
+            return self.governor.acquire()
+        self._admitted.degraded = None
+        return degraded
+
+    def _target(self, degraded: bool) -> Any:
+        return self.degrade_provider if degraded and self.degrade_provider is not None else self.provider
+
+    def _downscale(self, messages: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, int]]]:
+        """送信画像の長辺を degrade_max_side まで縮め、プロンプトの image_size も実際の送信サイズに合わせる"""
+        size: Optional[Dict[str, int]] = None
+        rewritten = []
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, dict) and str(content.get("image_url", "")).startswith("data:image/"):
+                header, data = content["image_url"].split(",", 1)
+                img = Image.open(io.BytesIO(base64.b64decode(data)))
+                img.load()
+                if max(img.size) > self.degrade_max_side:  # type: ignore[operator]
+                    img.thumbnail((self.degrade_max_side, self.degrade_max_side), Image.LANCZOS)  # type: ignore[arg-type]
+                    fmt = header[len("data:image/"):].split(";", 1)[0].upper()
+                    content = dict(content, image_url=LLMProvider.pil_to_datauri(img, format=fmt))
+                size = {"width": img.size[0], "height": img.size[1]}
+                try:
+                    user = json.loads(content.get("text") or "")
+                except ValueError:
+                    user = None
+                if isinstance(user, dict) and "image_size" in user:
+                    content = dict(content, text=json.dumps(dict(user, image_size=size), ensure_ascii=False))
+                message = dict(message, content=content)
+            rewritten.append(message)
+        return rewritten, size
+
+    def chat_vision(self, messages: List[Dict[str, Any]], **kwargs: Any) -> Dict[str, Any]:
+        degraded = self._acquire()
+        target = self._target(degraded)
+        usage: Dict[str, Any] = {}
+        try:
+            size = None
+            if degraded and self.degrade_max_side:
+                messages, size = self._downscale(messages)
+            resp = dict(target.chat_vision(messages, **kwargs))
+            usage = resp.get("usage") or {}
+            # 実際に応答したモデルと送信サイズを残す（節約モードの結果を通常の結果としてキャッシュ・記録しないため）
+            resp["model"] = getattr(target, "model", "")
+            if degraded:
+                resp["degraded"] = True
+                if size is not None:
+                    resp["image_size"] = size
+            return resp
+        finally:
+            self.governor.record(_billed_model(target), usage)
+
+    def chat_text(self, system_prompt: str, user_prompt: str) -> str:
+        target = self._target(self._acquire())
+        usage: Dict[str, Any] = {}
+        try:
+            text = target.chat_text(system_prompt, user_prompt)
+            usage = {
+                "prompt_tokens": estimate_text_tokens(system_prompt) + estimate_text_tokens(user_prompt),
+                "completion_tokens": estimate_text_tokens(text),
+            }
+            return text
+        finally:
+            self.governor.record(_billed_model(target), usage)
@@ -0,0 +1,246 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from .budget import estimate_image_tokens
+from .eval_cache import VerdictCache, image_digest
+from .pipeline import batch_pipeline
+from .vision_eval import run_vision_eval
+
+
+# 掃引する長辺（None は縮小なし）と (形式, 品質) の組み合わせ
+DEFAULT_MAX_SIDES: Tuple[Optional[int], ...] = (None, 1536, 1024, 768, 512, 384)
+DEFAULT_FORMATS: Tuple[Tuple[str, Optional[int]], ...] = (("PNG", None), ("JPEG", 90), ("JPEG", 75), ("WEBP", 80))
+
+
+def resolution_sweep(
+    max_sides: Sequence[Optional[int]] = DEFAULT_MAX_SIDES,
+    formats: Sequence[Tuple[str, Optional[int]]] = DEFAULT_FORMATS,
+) -> List[Dict[str, Any]]:
+    """長辺 × 形式の組み合わせ（バンドルの image にそのまま入れられる形）"""
+    settings = []
+    for max_side in max_sides:
+        for fmt, quality in formats:
+            setting: Dict[str, Any] = {"format": fmt}
+            if max_side:
+                setting["max_side"] = int(max_side)
+            if quality:
+                setting["quality"] = int(quality)
+            settings.append(setting)
+    return settings
+
+
+def _setting_key(setting: Dict[str, Any], longest_side: int) -> Tuple[Optional[int], str, Optional[int]]:
+    """実際に送られる画像が同じになる設定を同じキーにまとめる（長辺・形式・品質）
+
+    長辺がサンプルの最大の長辺以上なら縮小されず、PNG の品質は使われない。
+    """
+    fmt = str(setting.get("format") or "PNG").upper()
+    fmt = "JPEG" if fmt == "JPG" else fmt
+    quality = int(setting["quality"]) if fmt in {"JPEG", "WEBP"} and setting.get("quality") else None
+    max_side = int(setting.get("max_side") or 0)
+    return (max_side if 0 < max_side < longest_side else None, fmt, quality)
+
+
+def apply_image_setting(bundle: Dict[str, Any], setting: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """送信画像の設定を差し替えたバンドル（空の設定なら image を外した元の送り方）"""
+    updated = {key: value for key, value in bundle.items() if key != "image"}
+    if setting:
+        updated["image"] = dict(setting)
+    return updated
+
+
+@dataclass
+class CalibrationPoint:
+    setting: Dict[str, Any]
+    total: int
+    correct: int = 0
+    cache_hits: int = 0
+    payload_bytes: List[int] = field(default_factory=list)
+    image_tokens: List[int] = field(default_factory=list)
+    latencies_ms: List[float] = field(default_factory=list)
+    decisions: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+
+    @property
+    def accuracy(self) -> float:
+        return self.correct / self.total if self.total else 0.0
+
+    @property
+    def mean_bytes(self) -> float:
+        return sum(self.payload_bytes) / len(self.payload_bytes) if self.payload_bytes else 0.0
+
+    @property
+    def mean_image_tokens(self) -> float:
+        return sum(self.image_tokens) / len(self.image_tokens) if self.image_tokens else 0.0
+
+    @property
+    def mean_latency_ms(self) -> float:
+        return sum(self.latencies_ms) / len(self.latencies_ms) if self.latencies_ms else 0.0
+
+    @property
+    def label(self) -> str:
+        if not self.setting:
+            return "元の送り方"
+        side = f"長辺{self.setting['max_side']}px" if self.setting.get("max_side") else "縮小なし"
+        quality = f" q{self.setting['quality']}" if self.setting.get("quality") else ""
+        return f"{side} / {self.setting.get('format', 'PNG')}{quality}"
+
+
+@dataclass
+class CalibrationResult:
+    points: List[CalibrationPoint]  # 先頭が基準（元の送り方）
+    bundle: Dict[str, Any]
+    api_calls: int
+    cache_hits: int
+    tolerance: float
+    # 予算（max_calls）に収まらず評価しなかった設定
+    skipped: List[Dict[str, Any]] = field(default_factory=list)
+    stopped_reason: str = "exhausted"  # "exhausted" | "budget"
+
+    @property
+    def baseline(self) -> CalibrationPoint:
+        return self.points[0]
+
+    @property
+    def best(self) -> CalibrationPoint:
+        """基準の精度（から tolerance 以内）を保つ中で、画像トークン・転送量が最も小さい設定"""
+        floor = self.baseline.accuracy - self.tolerance
+        accurate = [point for point in self.points if point.accuracy >= floor - 1e-9]
+        return min(accurate, key=lambda point: (point.mean_image_tokens, point.mean_bytes, point.mean_latency_ms))
+
+    @property
+    def best_bundle(self) -> Dict[str, Any]:
+        """そのまま generate_runtime_app に渡せるプロンプトバンドル（最良の送信画像設定を固定）"""
+        return apply_image_setting(self.bundle, self.best.setting)
+
+    def table(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "設定": point.label,
+                "精度": round(point.accuracy, 3),
+                "平均バイト数": round(point.mean_bytes),
+                "平均画像トークン": round(point.mean_image_tokens),
+                "平均レイテンシ(ms)": round(point.mean_latency_ms),
+                "キャッシュ利用": point.cache_hits,
+            }
+            for point in self.points
+        ]
+
+
+def calibrate_resolution(
+    provider: Any,
+    bundle: Dict[str, Any],
+    samples: List[Tuple[str, Image.Image]],
+    expected: Dict[str, str],
+    settings: Optional[List[Dict[str, Any]]] = None,
+    max_workers: int = 4,
+    cache: Optional[VerdictCache] = None,
+    tolerance: float = 0.0,
+    cpu_workers: int = 0,
+    cpu_kind: str = "process",
+    max_calls: Optional[int] = None,
+) -> CalibrationResult:
+    """送信画像の解像度・形式を掃引してラベル付きサンプルを並列評価し、精度と転送量・画像トークン・レイテンシを比べる
+
+    基準はバンドルの image を外した元の送り方。基準や先の設定と同じ画像を送ることになる設定（縮小なしの PNG、
+    サンプルより大きい長辺など）は評価しない。評価済みの (設定, 画像) はキャッシュを再利用し、API を呼ばない。
+    max_calls を指定すると、掃引の順に API 呼び出しがその回数に収まる設定だけを評価し、残りは skipped に入れる
+    （途中まで評価した設定で比べないよう、設定単位で見送る）。
+    判定に失敗したサンプル（fallback_verdict）は不正解として数える。
+    cpu_workers が1以上なら、縮小・エンコードを batch_pipeline の前処理ステージ（既定はプロセスプール）で行い、API 呼び出しと重ねる。
+    """
+    labeled = [(name, img) for name, img in samples if expected.get(name) in {"OK", "NG"}]
+    if not labeled:
+        raise ValueError("想定判定(OK/NG)が設定されたサンプルがありません。")
+    cache = cache if cache is not None else VerdictCache()
+    base = apply_image_setting(bundle, None)
+    longest_side = max(max(img.size) for _, img in labeled)
+    seen = {_setting_key({}, longest_side)}
+    sweep = []
+    for setting in settings if settings is not None else resolution_sweep():
+        key = _setting_key(setting, longest_side)
+        if key not in seen:
+            seen.add(key)
+            sweep.append(dict(setting))
+    hashes = {name: image_digest(img) for name, img in labeled}
+    points: List[CalibrationPoint] = []
+    skipped: List[Dict[str, Any]] = []
+    budget = max_calls
+    for setting in [{}] + sweep:
+        point_bundle = apply_image_setting(base, setting)
+        cost = sum(1 for name, _ in labeled if cache.peek(cache.key_for(provider, point_bundle, hashes[name])) is None)
+        if budget is not None and cost > budget:
+            if not setting:
+                raise ValueError(f"API呼び出しの上限（{max_calls} 回）では元の送り方の評価（{cost} 回）が終わりません。")
+            skipped.append(setting)
+            continue
+        if budget is not None:
+            budget -= cost
+        points.append(CalibrationPoint(setting=setting, total=len(labeled)))
+    bundles = [apply_image_setting(base, point.setting) for point in points]
+    provider_name = str(getattr(provider, "provider_name", "OpenAI"))
+    model = str(getattr(provider, "model", ""))
+
+    def failed(exc: BaseException) -> Dict[str, Any]:
+        return {"verdict": "ERROR", "details": str(exc), "checks": [], "fallback_verdict": True}
+
+    def evaluate(pi: int, img: Image.Image) -> Dict[str, Any]:
+        try:
+            return run_vision_eval(provider, bundles[pi], img)
+        except Exception as exc:
+            return failed(exc)
+
+    jobs = [(pi, name, img) for pi in range(len(points)) for name, img in labeled]
+    outcomes: List[Tuple[Dict[str, Any], bool]] = [({}, False)] * len(jobs)
+    misses = []
+    for index, (pi, name, _) in enumerate(jobs):
+        cached = cache.get(cache.key_for(provider, bundles[pi], hashes[name]))
+        if cached is not None:
+            outcomes[index] = (cached, True)
+        else:
+            misses.append(index)
+    if cpu_workers > 0:
+        with batch_pipeline(provider, cpu_workers=cpu_workers, net_workers=max_workers, queue_size=max_workers, cpu_kind=cpu_kind) as pipeline:
+            pairs = ((bundles[jobs[index][0]], jobs[index][2]) for index in misses)
+            decisions = [
+                failed(result) if isinstance(result, BaseException) else result
+                for result in pipeline.map(pairs, return_exceptions=True)
+            ]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            decisions = list(executor.map(lambda index: evaluate(jobs[index][0], jobs[index][2]), misses))
+    for index, decision in zip(misses, decisions):
+        pi, name, _ = jobs[index]
+        cache.put(cache.key_for(provider, bundles[pi], hashes[name]), decision)
+        outcomes[index] = (decision, False)
+
+    api_calls = 0
+    cache_hits = 0
+    for (pi, name, _), (decision, from_cache) in zip(jobs, outcomes):
+        point = points[pi]
+        point.decisions[name] = decision
+        if from_cache:
+            point.cache_hits += 1
+            cache_hits += 1
+        else:
+            api_calls += 1
+        if not decision.get("fallback_verdict") and str(decision.get("verdict", "")).upper() == expected[name]:
+            point.correct += 1
+        if "payload_bytes" in decision:
+            point.payload_bytes.append(int(decision["payload_bytes"]))
+        size = decision.get("image_size")
+        if size:
+            point.image_tokens.append(estimate_image_tokens(provider_name, model, int(size["width"]), int(size["height"])))
+        if "latency_ms" in decision:
+            point.latencies_ms.append(float(decision["latency_ms"]))
+    return CalibrationResult(
+        points=points,
+        bundle=base,
+        api_calls=api_calls,
+        cache_hits=cache_hits,
+        tolerance=tolerance,
+        skipped=skipped,
+        stopped_reason="budget" if skipped else "exhausted",
+    )
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import threading
+from typing import Dict, Any, Optional, Tuple
+
+from PIL import Image
+
+
+def image_digest(img: Image.Image) -> str:
+    """画素データから画像のハッシュを求める（ファイル名や圧縮形式に依存しない）"""
+    h = hashlib.sha256()
+    h.update(f"{img.mode}:{img.size[0]}x{img.size[1]}:".encode("utf-8"))
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+# 判定内容に影響しない調整値。変えても仕様バージョン・キャッシュキーは変わらない
+TUNING_KEYS = {"max_tokens"}
+
+
+def bundle_digest(bundle: Dict[str, Any]) -> str:
+    """プロンプトバンドルの内容ハッシュ（キー順に依存しない）"""
+    content = {key: value for key, value in bundle.items() if key not in TUNING_KEYS}
+    payload = json.dumps(content, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def spec_version(bundle: Dict[str, Any]) -> str:
+    """結果の集計に使う短い仕様バージョン（バンドル内容のハッシュ先頭12桁）"""
+    return bundle_digest(bundle)[:12]
+
+
+CacheKey = Tuple[str, str, str, str, str]
+
+
+class VerdictCache:
+    """(仕様, 画像, モデル設定) ごとの判定結果を保持するスレッドセーフなキャッシュ"""
+
+    def __init__(self) -> None:
+        self._items: Dict[CacheKey, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for(provider: Any, bundle: Dict[str, Any], img_hash: str) -> CacheKey:
+        settings = f"{getattr(provider, 'temperature', '')}:{getattr(provider, 'max_tokens', '')}"
+        return (
+            bundle_digest(bundle),
+            img_hash,
+            str(getattr(provider, "provider_name", "")).lower(),
+            str(getattr(provider, "model", "")),
+            settings,
+        )
+
+    def get(self, key: CacheKey) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            decision = self._items.get(key)
+            if decision is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(decision)
+
+    def peek(self, key: CacheKey) -> Optional[Dict[str, Any]]:
+        """ヒット数・ミス数に数えずに引く（先回り判定の確認用）"""
+        with self._lock:
+            decision = self._items.get(key)
+            return dict(decision) if decision is not None else None
+
+    def put(self, key: CacheKey, decision: Dict[str, Any]) -> None:
+        # API エラーや期限切れなど一時的な失敗と、予算の節約モード（安いモデル・縮小画像）の結果はキャッシュしない
+        if decision.get("fallback_verdict") or decision.get("timed_out") or decision.get("degraded") or str(decision.get("verdict", "")).upper() not in {"OK", "NG"}:
+            return
+        with self._lock:
+            self._items[key] = dict(decision)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
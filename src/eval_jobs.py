@@ -0,0 +1,231 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from PIL import Image
+
+from .llm_providers import RequestCancelled, cancel_scope
+from .scheduler import ScheduledProvider
+
+
+# 項目の状態: queued → running → done / error / cancelled（retry で queued に戻る）
+FINISHED_STATES = {"done", "error", "cancelled"}
+
+
+class JobCancelled(RuntimeError):
+    """取り消された項目の呼び出しを打ち切るときに送出する"""
+
+
+class CancellableProvider:
+    """取り消しに従うラッパー（取り消し済みなら API を呼ばずに JobCancelled を送出する）
+
+    呼び出しは `cancel_scope` の範囲内で行うため、実行中の HTTP リクエストも取り消した時点で中断する。
+    """
+
+    def __init__(self, provider: Any, cancel_event: threading.Event) -> None:
+        self.provider = provider
+        self.cancel_event = cancel_event
+
+    def __getattr__(self, name: str) -> Any:
+        # 非同期API は取り消しを確かめないため委譲しない
+        if name in {"provider", "cancel_event"} or name.startswith("achat_"):
+            raise AttributeError(name)
+        return getattr(self.provider, name)
+
+    def _check(self) -> None:
+        if self.cancel_event.is_set():
+            raise JobCancelled("取り消されました。")
+
+    def _call(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        self._check()
+        try:
+            with cancel_scope(self.cancel_event):
+                return fn(*args, **kwargs)
+        except RequestCancelled as exc:
+            raise JobCancelled("取り消されました。") from exc
+
+    def chat_vision(self, messages: List[Dict[str, Any]], **kwargs: Any) -> Dict[str, Any]:
+        return self._call(self.provider.chat_vision, messages, **kwargs)
+
+    def chat_text(self, system_prompt: str, user_prompt: str) -> str:
+        return self._call(self.provider.chat_text, system_prompt, user_prompt)
+
+
+def cancellable_provider(provider: Any, cancel_event: threading.Event) -> Any:
+    """取り消しに従うプロバイダ。ScheduledProvider ならスケジューラの内側に入れ、順番が来た時点で取り消しを確かめる
+
+    スケジューラの待ち行列にいる間に取り消された呼び出しは、API を呼ばずにすぐ枠を返す。
+    """
+    if isinstance(provider, ScheduledProvider):
+        return ScheduledProvider(CancellableProvider(provider.provider, cancel_event), provider.scheduler, provider.priority)
+    return CancellableProvider(provider, cancel_event)
+
+
+@dataclass
+class JobItem:
+    name: str
+    image: Image.Image
+    expected: Optional[str]
+    status: str = "queued"
+    result: Optional[Dict[str, Any]] = None
+    error: str = ""
+    attempt: int = 0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    cancel_event: threading.Event = field(default_factory=threading.Event)  # 試行ごとの取り消しトークン
+
+    @property
+    def elapsed_s(self) -> Optional[float]:
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.time()) - self.started_at
+
+
+class EvalJob:
+    """サンプル判定をバックグラウンドで進め、1件ごとの結果を逐次参照できるジョブ
+
+    Streamlit の再実行をまたいで session_state に保持し、UI は `snapshot()` を定期的に描画する。
+    項目は max_workers 件の ThreadPoolExecutor で判定する。task は (名前, 画像, 想定判定, 取り消しトークン) を受け取り、
+    プロバイダを `cancellable_provider` で包めば取り消し後の呼び出しも実行中の HTTP リクエストも打ち切れる。
+    実行中の項目を取り消すと結果は破棄されるが、呼び出しが実際に戻るまでは並列枠を占有する
+    （取り消しのたびに同時実行数が max_workers を超えないように）。
+    """
+
+    def __init__(
+        self,
+        task: Callable[[str, Image.Image, Optional[str], threading.Event], Dict[str, Any]],
+        samples: List[Tuple[str, Image.Image]],
+        expected: Dict[str, Optional[str]],
+        max_workers: int = 4,
+    ) -> None:
+        self._task = task
+        self.max_workers = max(1, max_workers)
+        self.items: Dict[str, JobItem] = {
+            name: JobItem(name=name, image=img, expected=expected.get(name)) for name, img in samples
+        }
+        self.order = [name for name, _ in samples]
+        self.cancelled = False
+        self.created_at = time.time()
+        self._running = 0  # 実際に実行中の呼び出し数（取り消した項目も戻るまで数える）
+        self._started = False
+        self._cond = threading.Condition()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    # --- 制御 -------------------------------------------------------------
+
+    def start(self) -> "EvalJob":
+        with self._cond:
+            if not self._started:
+                self._started = True
+                for name in self.order:
+                    if self.items[name].status == "queued":
+                        self._submit_locked(self.items[name])
+        return self
+
+    def cancel(self, name: str) -> None:
+        with self._cond:
+            self._cancel_locked(self.items[name])
+            self._cond.notify_all()
+
+    def cancel_all(self) -> None:
+        with self._cond:
+            self.cancelled = True
+            for item in self.items.values():
+                self._cancel_locked(item)
+            self._cond.notify_all()
+
+    def retry(self, name: str) -> None:
+        with self._cond:
+            item = self.items[name]
+            if item.status not in FINISHED_STATES:
+                return
+            item.status = "queued"
+            item.result = None
+            item.error = ""
+            item.attempt += 1
+            item.cancel_event = threading.Event()
+            item.started_at = item.finished_at = None
+            self.cancelled = False
+            self._started = True
+            self._submit_locked(item)
+
+    def _cancel_locked(self, item: JobItem) -> None:
+        if item.status in {"queued", "running"}:
+            # 実行中の呼び出しは戻ってきても attempt が一致しないため破棄される（枠は戻るまで占有したまま）
+            item.status = "cancelled"
+            item.attempt += 1
+            item.finished_at = time.time()
+            item.cancel_event.set()
+
+    # --- 実行 -------------------------------------------------------------
+
+    def _submit_locked(self, item: JobItem) -> None:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="eval-job")
+        self._executor.submit(self._run_item, item, item.attempt)
+
+    def _run_item(self, item: JobItem, attempt: int) -> None:
+        with self._cond:
+            if item.attempt != attempt or item.status != "queued":
+                # 待機中に取り消された（または再実行で積み直された）項目
+                self._shutdown_if_idle_locked()
+                return
+            item.status = "running"
+            item.started_at = time.time()
+            self._running += 1
+            cancel_event = item.cancel_event
+        result: Optional[Dict[str, Any]] = None
+        error = ""
+        try:
+            result = self._task(item.name, item.image, item.expected, cancel_event)
+        except Exception as exc:
+            error = str(exc) or exc.__class__.__name__
+        with self._cond:
+            self._running -= 1
+            if item.attempt == attempt and item.status == "running":
+                item.finished_at = time.time()
+                item.result = result
+                item.error = error
+                item.status = "error" if error else "done"
+            self._shutdown_if_idle_locked()
+            self._cond.notify_all()
+
+    def _shutdown_if_idle_locked(self) -> None:
+        # 待機中・実行中の項目がなくなったらスレッドを返す（retry で積まれたら作り直す）
+        if self._executor is None or self._running or any(item.status == "queued" for item in self.items.values()):
+            return
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    # --- 参照 -------------------------------------------------------------
+
+    def snapshot(self) -> List[JobItem]:
+        """描画用に各項目のコピーを返す"""
+        with self._cond:
+            return [JobItem(**vars(self.items[name])) for name in self.order]
+
+    def progress(self) -> Tuple[int, int]:
+        with self._cond:
+            finished = sum(1 for item in self.items.values() if item.status in FINISHED_STATES)
+            return finished, len(self.items)
+
+    @property
+    def active(self) -> bool:
+        with self._cond:
+            return any(item.status in {"queued", "running"} for item in self.items.values())
+
+    def results(self) -> List[Dict[str, Any]]:
+        """完了した項目の結果（サンプル順）"""
+        return [item.result for item in self.snapshot() if item.status == "done" and item.result is not None]
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while any(item.status in {"queued", "running"} for item in self.items.values()):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
@@ -0,0 +1,197 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+from .llm_providers import RequestCancelled
+
+
+@dataclass
+class BreakerPolicy:
+    window_s: float = 30.0              # 直近この秒数の呼び出しで判定する
+    min_calls: int = 4
+    error_rate: float = 0.5             # これ以上の失敗率で遮断
+    consecutive_failures: int = 3       # 連続失敗はウィンドウを待たずに遮断
+    latency_threshold_s: Optional[float] = None  # 直近の p95 がこれを超えたら遮断（None で無効）
+    cooldown_s: float = 10.0            # 遮断してから復旧確認（1件だけ通す）までの時間
+
+
+class CircuitBreaker:
+    """バックエンド1つ分の失敗率・レイテンシを追跡するサーキットブレーカー
+
+    closed（通常）→ open（遮断）→ cooldown 経過後 half_open（確認用に1件だけ通す）→ 成功で closed / 失敗で open。
+    """
+
+    def __init__(self, policy: Optional[BreakerPolicy] = None) -> None:
+        self.policy = policy or BreakerPolicy()
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.trips = 0
+        self._calls: deque = deque()  # (時刻, 成功か, レイテンシ秒)
+        self._consecutive = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float) -> None:
+        while self._calls and now - self._calls[0][0] > self.policy.window_s:
+            self._calls.popleft()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.policy.cooldown_s:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, ok: bool, latency_s: float) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._calls.append((now, ok, latency_s))
+            self._prune(now)
+            self._consecutive = 0 if ok else self._consecutive + 1
+            if self.state == "half_open":
+                if ok and not self._too_slow():
+                    self.state = "closed"
+                    self._calls.clear()
+                    self._consecutive = 0
+                else:
+                    self._trip(now)
+                return
+            if self.state == "closed" and self._should_trip():
+                self._trip(now)
+
+    def _too_slow(self) -> bool:
+        threshold = self.policy.latency_threshold_s
+        if threshold is None or not self._calls:
+            return False
+        latencies = sorted(latency for _, _, latency in self._calls)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] > threshold
+
+    def _should_trip(self) -> bool:
+        if self._consecutive >= self.policy.consecutive_failures:
+            return True
+        if len(self._calls) < self.policy.min_calls:
+            return False
+        failures = sum(1 for _, ok, _ in self._calls if not ok)
+        return failures / len(self._calls) >= self.policy.error_rate or self._too_slow()
+
+    def _trip(self, now: float) -> None:
+        self.state = "open"
+        self.opened_at = now
+        self._probing = False
+        self.trips += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._prune(time.monotonic())
+            calls = list(self._calls)
+            state = self.state
+        latencies = sorted(latency for _, _, latency in calls)
+        return {
+            "state": state,
+            "calls": len(calls),
+            "error_rate": (sum(1 for _, ok, _ in calls if not ok) / len(calls)) if calls else 0.0,
+            "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000.0, 1) if latencies else None,
+            "trips": self.trips,
+        }
+
+
+NO_BACKEND_DETAILS = "利用可能なバックエンドがありません（すべて遮断中）。しばらくしてから再実行してください。"
+
+
+class FailoverProvider:
+    """(プロバイダ, モデル) の優先順リストを持ち、障害中のバックエンドを避けて呼び出すプロバイダ
+
+    バックエンドごとにサーキットブレーカーを持ち、例外・HTTPエラー（parse_error のない verdict=ERROR）・遅延が続くと
+    数秒で次のバックエンドへ切り替え、cooldown 後に1件だけ流して復旧を確認する。
+    どのバックエンドが応答しても戻り値の形（output_text / json / usage / finish_reason）は同じ。
+    """
+
+    def __init__(self, backends: List[Any], policy: Optional[BreakerPolicy] = None) -> None:
+        if not backends:
+            raise ValueError("バックエンドを1つ以上指定してください。")
+        self.backends = list(backends)
+        self.breakers = [CircuitBreaker(policy) for _ in self.backends]
+        self.last_used: Optional[Any] = None  # 直近に応答したバックエンド
+
+    def __getattr__(self, name: str) -> Any:
+        # provider_name / model / temperature / pil_to_datauri などは最優先のバックエンドに委譲する
+        # （非同期API はブレーカーを通らないため委譲しない）
+        if name in {"backends", "breakers", "last_used"} or name.startswith("achat_"):
+            raise AttributeError(name)
+        return getattr(self.backends[0], name)
+
+    @staticmethod
+    def label(backend: Any) -> str:
+        return f"{getattr(backend, 'provider_name', '?')}:{getattr(backend, 'model', '') or '-'}"
+
+    @property
+    def last_backend(self) -> Optional[str]:
+        return self.label(self.last_used) if self.last_used is not None else None
+
+    def _candidates(self) -> Iterator[Tuple[Any, CircuitBreaker]]:
+        # 実際に呼ぶ直前に allow() を問い合わせる（手前で成功したら後続の復旧確認枠を消費しない）
+        for backend, breaker in zip(self.backends, self.breakers):
+            if breaker.allow():
+                yield backend, breaker
+
+    @staticmethod
+    def _normalize(resp: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "output_text": resp.get("output_text", ""),
+            "json": resp.get("json", {}),
+            "usage": resp.get("usage") or {},
+            "finish_reason": resp.get("finish_reason", "stop"),
+        }
+
+    def chat_vision(self, messages: List[Dict[str, Any]], **kwargs: Any) -> Dict[str, Any]:
+        last: Optional[Dict[str, Any]] = None
+        last_error: Optional[BaseException] = None
+        for backend, breaker in self._candidates():
+            started = time.monotonic()
+            try:
+                resp = backend.chat_vision(messages, **kwargs)
+            except RequestCancelled:
+                raise  # 取り消しはバックエンドの障害ではない
+            except Exception as exc:
+                breaker.record(False, time.monotonic() - started)
+                last_error = exc
+                continue
+            answer = resp.get("json") or {}
+            # 判定JSONの解釈失敗はモデルの出力の問題で、バックエンドの障害ではない（遮断も再送もせずそのまま返す）
+            ok = str(answer.get("verdict", "")).upper() != "ERROR" or bool(answer.get("parse_error"))
+            breaker.record(ok, time.monotonic() - started)
+            if ok:
+                self.last_used = backend
+                return self._normalize(resp)
+            last = resp
+        if last is not None:
+            return self._normalize(last)
+        details = str(last_error) if last_error is not None else NO_BACKEND_DETAILS
+        return {"output_text": details, "json": {"verdict": "ERROR", "details": details, "checks": []}, "usage": {}, "finish_reason": "stop"}
+
+    def chat_text(self, system_prompt: str, user_prompt: str) -> str:
+        last_error: Optional[BaseException] = None
+        for backend, breaker in self._candidates():
+            started = time.monotonic()
+            try:
+                text = backend.chat_text(system_prompt, user_prompt)
+            except RequestCancelled:
+                raise  # 取り消しはバックエンドの障害ではない
+            except Exception as exc:
+                breaker.record(False, time.monotonic() - started)
+                last_error = exc
+                continue
+            breaker.record(True, time.monotonic() - started)
+            self.last_used = backend
+            return text
+        raise RuntimeError(str(last_error) if last_error is not None else NO_BACKEND_DETAILS)
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [{"backend": self.label(backend), **breaker.stats()} for backend, breaker in zip(self.backends, self.breakers)]
@@ -1,31 +1,550 @@
-import json, os
-from typing import Dict, Any, List, Optional
+import json, os, hashlib, sqlite3, threading, warnings, base64, time
+from typing import Dict, Any, List, Optional, Iterable, Iterator, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from .eval_cache import image_digest
+
+# インデックスのスキーマを変えた場合は番号を上げる（古いインデックスは再構築される）
+INDEX_SCHEMA_VERSION = 3
+# チャネル別8段階の色ヒストグラム(24) + 6x6 縮小グレースケール(36)
+# 10万件でも全件の内積が数ミリ秒に収まるよう次元を抑えている
+FEATURE_DIM = 60
+
+
+def image_features(img: Image.Image) -> np.ndarray:
+    """類似検索用の小さな特徴ベクトル（L2正規化済み, float32）"""
+    rgb = img if img.mode == "RGB" else img.convert("RGB")
+    # 大きな画像は先に整数倍で間引いてから縮小する（検索1回あたりの時間の大半がここにかかる）
+    small_img = rgb.resize((32, 32), Image.BILINEAR, reducing_gap=2.0)
+    small = np.asarray(small_img, dtype=np.uint8).reshape(-1, 3)
+    bins = (small >> 5).astype(np.int32) + np.array([0, 8, 16], dtype=np.int32)
+    hist = np.bincount(bins.ravel(), minlength=24).astype(np.float32)
+    hist /= np.linalg.norm(hist) or 1.0
+    thumb = np.asarray(small_img.convert("L").resize((6, 6), Image.BILINEAR), dtype=np.float32).ravel()
+    thumb -= thumb.mean()
+    thumb /= np.linalg.norm(thumb) or 1.0
+    vec = np.concatenate([hist, thumb])
+    vec /= np.linalg.norm(vec) or 1.0
+    return vec.astype(np.float32)
+
+
+def _encode_features(vec: np.ndarray) -> str:
+    return base64.b64encode(np.asarray(vec, dtype=np.float16).tobytes()).decode("ascii")
+
+
+def _features_blob(record: Dict[str, Any]) -> Optional[bytes]:
+    encoded = record.get("features")
+    if not isinstance(encoded, str):
+        return None
+    try:
+        blob = base64.b64decode(encoded)
+    except ValueError:
+        return None
+    return blob if len(blob) == FEATURE_DIM * 2 else None
+
+
+def _record_digest(record: Dict[str, Any]) -> str:
+    payload = json.dumps(record, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def spec_digest(spec_text: str) -> str:
+    return hashlib.sha256(spec_text.strip().encode("utf-8")).hexdigest()
+
+
+def _record_tags(record: Dict[str, Any]) -> List[str]:
+    tags = record.get("tags") or []
+    if isinstance(tags, str):
+        tags = [tags]
+    return sorted({str(tag) for tag in tags if str(tag)})
+
 
 class FewShotStore:
-    def __init__(self, path: str = "data/few_shots.jsonl") -> None:
+    """JSONL を追記ログとして保持し、SQLite のオフセットインデックスで高速に参照する Few-shot ストア
+
+    - レコードIDは追記順の連番で、コンパクション後も変わらない
+    - `get` / タグ・仕様での絞り込みはインデックス経由（ファイル全体を読まない）
+    - 壊れた行は読み飛ばさず `corruption_report` に記録する
+    """
+
+    def __init__(self, path: str = "data/few_shots.jsonl", index_path: Optional[str] = None) -> None:
         self.path = path
-        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.index_path = index_path or f"{path}.idx.sqlite"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
         if not os.path.exists(self.path):
             with open(self.path, "w", encoding="utf-8") as f:
                 pass
+        self._lock = threading.RLock()
+        self._compaction: Optional[threading.Thread] = None
+        self._writer = None
+        self._reader = None
+        self._conn = self._open_index(self.index_path)
+        self._reset_vector_cache()
+        self._sync_index()
+
+    # --- インデックス管理 ---------------------------------------------------
+
+    @staticmethod
+    def _open_index(index_path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(index_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS records (
+                id INTEGER PRIMARY KEY,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                spec TEXT
+            );
+            CREATE INDEX IF NOT EXISTS records_spec ON records(spec);
+            CREATE INDEX IF NOT EXISTS records_digest ON records(digest);
+            CREATE TABLE IF NOT EXISTS record_tags (record_id INTEGER NOT NULL, tag TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS record_tags_tag ON record_tags(tag, record_id);
+            CREATE TABLE IF NOT EXISTS vectors (record_id INTEGER PRIMARY KEY, spec TEXT, image TEXT, vec BLOB NOT NULL);
+            CREATE INDEX IF NOT EXISTS vectors_image ON vectors(image);
+            CREATE TABLE IF NOT EXISTS corrupt (
+                offset INTEGER PRIMARY KEY,
+                line_no INTEGER NOT NULL,
+                error TEXT NOT NULL,
+                preview TEXT NOT NULL
+            );
+            """
+        )
+        return conn
+
+    def _meta(self, key: str, default: str = "") -> str:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, **values: Any) -> None:
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            [(key, str(value)) for key, value in values.items()],
+        )
+
+    def _head_signature(self, indexed_size: int) -> str:
+        # ファイルの差し替え（外部での書き換え）を検出するため、インデックス済み範囲の先頭部分のハッシュを控えておく
+        with open(self.path, "rb") as f:
+            return hashlib.sha256(f.read(min(4096, indexed_size))).hexdigest()
+
+    def _reset_index(self) -> None:
+        self._conn.executescript(
+            "DELETE FROM records; DELETE FROM record_tags; DELETE FROM vectors; DELETE FROM corrupt; DELETE FROM meta;"
+        )
+        self._reset_vector_cache()
+
+    def _sync_index(self) -> None:
+        """インデックス済みの位置以降に追記された行だけを取り込む"""
+        with self._lock:
+            size = os.path.getsize(self.path)
+            indexed = int(self._meta("indexed_size", "0"))
+            head = self._meta("head_signature")
+            stale = (
+                self._meta("schema_version") != str(INDEX_SCHEMA_VERSION)
+                or indexed > size
+                or (indexed > 0 and head != self._head_signature(indexed))
+            )
+            if stale:
+                self._reset_index()
+                indexed = 0
+            if indexed == size and not stale:
+                return
+            line_no = int(self._meta("indexed_lines", "0"))
+            next_id = int(self._meta("next_id", "1"))
+            rows, tags, vectors, corrupt = [], [], [], []
+            with open(self.path, "rb") as f:
+                f.seek(indexed)
+                offset = indexed
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        break  # 書き込み途中の行は次回の同期で取り込む
+                    line_no += 1
+                    length = len(raw)
+                    text = raw.decode("utf-8", errors="replace").strip()
+                    if text:
+                        try:
+                            record = json.loads(text)
+                            if not isinstance(record, dict):
+                                raise ValueError("JSON object expected")
+                        except ValueError as exc:
+                            corrupt.append((offset, line_no, str(exc), text[:120]))
+                        else:
+                            rows.append((next_id, offset, length, _record_digest(record), self._spec_of(record)))
+                            tags.extend((next_id, tag) for tag in _record_tags(record))
+                            self._collect_vector(vectors, next_id, record)
+                            next_id += 1
+                    offset += length
+            self._conn.executemany("INSERT INTO records (id, offset, length, digest, spec) VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.executemany("INSERT INTO record_tags (record_id, tag) VALUES (?, ?)", tags)
+            self._conn.executemany("INSERT INTO vectors (record_id, spec, image, vec) VALUES (?, ?, ?, ?)", vectors)
+            self._conn.executemany("INSERT OR REPLACE INTO corrupt (offset, line_no, error, preview) VALUES (?, ?, ?, ?)", corrupt)
+            self._set_meta(
+                schema_version=INDEX_SCHEMA_VERSION,
+                indexed_size=offset,
+                indexed_lines=line_no,
+                next_id=next_id,
+                head_signature=self._head_signature(offset),
+            )
+            self._conn.commit()
+            if corrupt:
+                warnings.warn(f"{self.path}: 破損した行を {len(corrupt)} 件検出しました（corruption_report で確認できます）。")
+
+    @staticmethod
+    def _spec_of(record: Dict[str, Any]) -> Optional[str]:
+        spec_text = record.get("spec_text")
+        return spec_digest(str(spec_text)) if spec_text else None
+
+    @classmethod
+    def _collect_vector(cls, vectors: List[Tuple[int, Optional[str], Optional[str], bytes]], record_id: int, record: Dict[str, Any]) -> None:
+        blob = _features_blob(record)
+        if blob is not None:
+            vectors.append((record_id, cls._spec_of(record), record.get("image_digest"), blob))
+
+    # --- 書き込み ---------------------------------------------------------
+
+    def _append_handle(self):
+        if self._writer is None or self._writer.closed:
+            self._writer = open(self.path, "ab")
+        return self._writer
 
-    def append(self, record: Dict[str, Any]) -> None:
-        with open(self.path, "a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    def append(self, record: Dict[str, Any]) -> int:
+        return self.extend([record])[0]
+
+    def extend(self, records: Iterable[Dict[str, Any]]) -> List[int]:
+        """複数レコードを1回の書き込み・1トランザクションで追記し、採番したIDを返す"""
+        with self._lock:
+            self._sync_index()
+            f = self._append_handle()
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            if offset != int(self._meta("indexed_size", "0")):
+                # 途中で途切れた行の後ろに続けて書かないよう改行で区切る（その行は破損として報告される）
+                f.write(b"\n")
+                f.flush()
+                self._sync_index()
+                offset = f.tell()
+            next_id = int(self._meta("next_id", "1"))
+            line_no = int(self._meta("indexed_lines", "0"))
+            chunks, rows, tags, vectors = [], [], [], []
+            for record in records:
+                data = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+                chunks.append(data)
+                rows.append((next_id, offset, len(data), _record_digest(record), self._spec_of(record)))
+                tags.extend((next_id, tag) for tag in _record_tags(record))
+                self._collect_vector(vectors, next_id, record)
+                offset += len(data)
+                next_id += 1
+                line_no += 1
+            if not rows:
+                return []
+            f.write(b"".join(chunks))
+            f.flush()
+            self._conn.executemany("INSERT INTO records (id, offset, length, digest, spec) VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.executemany("INSERT INTO record_tags (record_id, tag) VALUES (?, ?)", tags)
+            self._conn.executemany("INSERT INTO vectors (record_id, spec, image, vec) VALUES (?, ?, ?, ?)", vectors)
+            self._set_meta(indexed_size=offset, indexed_lines=line_no, next_id=next_id, head_signature=self._head_signature(offset))
+            self._conn.commit()
+            return [row[0] for row in rows]
+
+    # --- 読み込み ---------------------------------------------------------
+
+    def _read_at(self, offset: int, length: int) -> Dict[str, Any]:
+        if self._reader is None or self._reader.closed:
+            self._reader = open(self.path, "rb")
+        self._reader.seek(offset)
+        return json.loads(self._reader.read(length).decode("utf-8"))
+
+    def get(self, record_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT offset, length FROM records WHERE id = ?", (record_id,)).fetchone()
+            return self._read_at(*row) if row else None
+
+    def _select(self, tag: Optional[str], spec_text: Optional[str], after_id: int, limit: int) -> Tuple[str, List[Any]]:
+        sql = "SELECT r.id, r.offset, r.length FROM records r"
+        where, params = ["r.id > ?"], [after_id]
+        if tag is not None:
+            sql += " JOIN record_tags t ON t.record_id = r.id"
+            where.append("t.tag = ?")
+            params.append(tag)
+        if spec_text is not None:
+            where.append("r.spec = ?")
+            params.append(spec_digest(spec_text))
+        sql += " WHERE " + " AND ".join(where) + " ORDER BY r.id LIMIT ?"
+        params.append(limit)
+        return sql, params
+
+    def iter_records(
+        self,
+        tag: Optional[str] = None,
+        spec_text: Optional[str] = None,
+        limit: Optional[int] = None,
+        batch_size: int = 256,
+    ) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """(id, record) を少しずつ読み出すイテレータ（全件をメモリに載せない）"""
+        self._sync_index()
+        last_id = 0
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = batch_size if remaining is None else min(batch_size, remaining)
+            sql, params = self._select(tag, spec_text, last_id, size)
+            with self._lock:
+                rows = self._conn.execute(sql, params).fetchall()
+                batch = [(record_id, self._read_at(offset, length)) for record_id, offset, length in rows]
+            if not batch:
+                return
+            yield from batch
+            last_id = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(batch)
+
+    def filter(self, tag: Optional[str] = None, spec_text: Optional[str] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return [record for _, record in self.iter_records(tag=tag, spec_text=spec_text, limit=limit)]
 
     def load_all(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
-        out: List[Dict[str, Any]] = []
-        if not os.path.exists(self.path):
-            return out
-        with open(self.path, "r", encoding="utf-8") as f:
-            for i, line in enumerate(f):
-                if limit is not None and i >= limit:
+        return self.filter(limit=limit)
+
+    def __len__(self) -> int:
+        self._sync_index()
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def corruption_report(self) -> List[Dict[str, Any]]:
+        """破損していた行（行番号・バイト位置・エラー内容・先頭部分）の一覧"""
+        self._sync_index()
+        with self._lock:
+            rows = self._conn.execute("SELECT line_no, offset, error, preview FROM corrupt ORDER BY offset").fetchall()
+        return [{"line_no": line_no, "offset": offset, "error": error, "preview": preview} for line_no, offset, error, preview in rows]
+
+    # --- 類似検索 ---------------------------------------------------------
+
+    def add_example(self, img: Image.Image, record: Dict[str, Any], image_hash: Optional[str] = None) -> int:
+        """画像の特徴ベクトルを添えてラベル付きの例を追記する（画像そのものは保存しない）
+
+        同じ画像・仕様・判定の例が既にあれば追記せずにそのIDを返す。
+        """
+        stored = dict(record)
+        stored["image_digest"] = image_hash or image_digest(img)
+        with self._lock:
+            for existing_id in self.example_ids(stored["image_digest"], spec_text=stored.get("spec_text")):
+                existing = self.get(existing_id)
+                if existing is not None and existing.get("verdict") == stored.get("verdict"):
+                    return existing_id
+            stored["features"] = _encode_features(image_features(img))
+            stored.setdefault("timestamp", time.time())
+            return self.append(stored)
+
+    def example_ids(self, image_hash: str, spec_text: Optional[str] = None) -> List[int]:
+        """同じ画像から作った例のID（spec_text を渡すとその仕様の例だけ）"""
+        self._sync_index()
+        sql, params = "SELECT record_id FROM vectors WHERE image = ?", [image_hash]
+        if spec_text is not None:
+            sql += " AND spec = ?"
+            params.append(spec_digest(spec_text))
+        with self._lock:
+            return [row[0] for row in self._conn.execute(sql + " ORDER BY record_id", params).fetchall()]
+
+    def _reset_vector_cache(self) -> None:
+        self._vec_ids = np.empty(0, dtype=np.int64)
+        self._vec_specs = np.empty(0, dtype=np.int32)
+        # 次元 x 件数 で持つ（クエリとの内積が連続したメモリを読む形になり、行ごとの内積より数倍速い）
+        self._vec_matrix = np.empty((FEATURE_DIM, 0), dtype=np.float32)
+        self._vec_count = 0
+        self._spec_codes: Dict[Optional[str], int] = {}
+
+    def _vector_matrix(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """特徴ベクトルを常駐させた行列（FEATURE_DIM x 件数）を返す（前回以降に追加された分だけ読み込む）"""
+        self._sync_index()
+        with self._lock:
+            loaded = int(self._vec_ids[self._vec_count - 1]) if self._vec_count else 0
+            rows = self._conn.execute(
+                "SELECT record_id, spec, vec FROM vectors WHERE record_id > ? ORDER BY record_id", (loaded,)
+            ).fetchall()
+            if rows:
+                needed = self._vec_count + len(rows)
+                if needed > len(self._vec_ids):
+                    capacity = max(needed, 2 * len(self._vec_ids), 1024)
+                    self._vec_ids = np.resize(self._vec_ids, capacity)
+                    self._vec_specs = np.resize(self._vec_specs, capacity)
+                    matrix = np.zeros((FEATURE_DIM, capacity), dtype=np.float32)
+                    matrix[:, : self._vec_count] = self._vec_matrix[:, : self._vec_count]
+                    self._vec_matrix = matrix
+                start, end = self._vec_count, needed
+                self._vec_ids[start:end] = [row[0] for row in rows]
+                self._vec_specs[start:end] = [self._spec_codes.setdefault(row[1], len(self._spec_codes)) for row in rows]
+                self._vec_matrix[:, start:end] = np.frombuffer(b"".join(row[2] for row in rows), dtype=np.float16).reshape(-1, FEATURE_DIM).T
+                self._vec_count = needed
+            n = self._vec_count
+            return self._vec_ids[:n], self._vec_specs[:n], self._vec_matrix[:, :n]
+
+    def nearest(
+        self,
+        query: Union[Image.Image, np.ndarray],
+        k: int = 3,
+        spec_text: Optional[str] = None,
+        exclude_image: Optional[str] = None,
+    ) -> List[Tuple[int, float]]:
+        """コサイン類似度の高い順に (record_id, similarity) を最大 k 件返す
+
+        exclude_image（image_digest）を渡すと、その画像から作った例は候補から外す。
+        """
+        vec = image_features(query) if isinstance(query, Image.Image) else np.asarray(query, dtype=np.float32)
+        excluded = self.example_ids(exclude_image) if exclude_image else []
+        ids, specs, matrix = self._vector_matrix()
+        if k <= 0 or not len(ids):
+            return []
+        scores = vec @ matrix
+        if excluded:
+            # IDは昇順に並んでいるので位置を二分探索で求めて候補から外す
+            excluded_ids = np.asarray(excluded, dtype=np.int64)
+            positions = np.minimum(np.searchsorted(ids, excluded_ids), len(ids) - 1)
+            scores[positions[ids[positions] == excluded_ids]] = -np.inf
+        if spec_text is not None:
+            code = self._spec_codes.get(spec_digest(spec_text))
+            if code is None:
+                return []
+            rows = np.flatnonzero(specs == code)
+            ids, scores = ids[rows], scores[rows]
+        k = min(k, len(scores))
+        if not k:
+            return []
+        top = np.argpartition(scores, len(scores) - k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+    def similar_examples(
+        self,
+        img: Image.Image,
+        k: int = 3,
+        spec_text: Optional[str] = None,
+        exclude_image: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """クエリ画像に似たラベル付きの例を返す（同じ仕様の例が無ければ全体から探す）"""
+        vec = image_features(img)
+        hits = self.nearest(vec, k=k, spec_text=spec_text, exclude_image=exclude_image) if spec_text is not None else []
+        if not hits:
+            hits = self.nearest(vec, k=k, exclude_image=exclude_image)
+        examples = []
+        for record_id, similarity in hits:
+            record = self.get(record_id)
+            if record is not None:
+                record.pop("features", None)
+                record.pop("image_digest", None)
+                record["similarity"] = round(similarity, 4)
+                examples.append(record)
+        return examples
+
+    # --- コンパクション ---------------------------------------------------
+
+    def compact(self) -> Dict[str, int]:
+        """重複レコードと破損行を取り除いたファイルに書き直す（IDは維持される）
+
+        書き出し中も追記・参照は可能で、最後の差し替えの間だけロックを取る。
+        """
+        self._sync_index()
+        with self._lock:
+            snapshot_id = int(self._meta("next_id", "1"))
+        tmp_path = f"{self.path}.compact"
+        tmp_index = f"{self.index_path}.compact"
+        for leftover in (tmp_path, tmp_index):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        new_conn = self._open_index(tmp_index)
+        seen = set()
+        kept = duplicates = 0
+        offset = 0
+        with open(tmp_path, "wb") as out:
+            for record_id, record in self.iter_records():
+                if record_id >= snapshot_id:
                     break
-                line = line.strip()
-                if not line:
+                digest = _record_digest(record)
+                if digest in seen:
+                    duplicates += 1
                     continue
-                try:
-                    out.append(json.loads(line))
-                except Exception:
-                    pass
-        return out
+                seen.add(digest)
+                offset = self._copy_record(out, new_conn, record_id, record, digest, offset)
+                kept += 1
+            with self._lock:
+                # 書き出し中に追記された分を取り込んでから差し替える
+                self._sync_index()
+                for record_id, record in self.iter_records():
+                    if record_id < snapshot_id:
+                        continue
+                    digest = _record_digest(record)
+                    if digest in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(digest)
+                    offset = self._copy_record(out, new_conn, record_id, record, digest, offset)
+                    kept += 1
+                out.flush()
+                os.fsync(out.fileno())
+                corrupt_dropped = len(self.corruption_report())
+                new_conn.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    [
+                        ("schema_version", str(INDEX_SCHEMA_VERSION)),
+                        ("indexed_size", str(offset)),
+                        ("indexed_lines", str(kept)),
+                        ("next_id", self._meta("next_id", "1")),
+                    ],
+                )
+                new_conn.commit()
+                self._close_handles()
+                new_conn.close()
+                os.replace(tmp_path, self.path)
+                os.replace(tmp_index, self.index_path)
+                for suffix in ("-wal", "-shm"):
+                    if os.path.exists(self.index_path + suffix):
+                        os.remove(self.index_path + suffix)
+                self._conn = self._open_index(self.index_path)
+                self._reset_vector_cache()
+                self._set_meta(head_signature=self._head_signature(offset))
+                self._conn.commit()
+        return {"kept": kept, "duplicates": duplicates, "corrupt_dropped": corrupt_dropped}
+
+    def _copy_record(self, out, conn: sqlite3.Connection, record_id: int, record: Dict[str, Any], digest: str, offset: int) -> int:
+        data = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        out.write(data)
+        conn.execute(
+            "INSERT INTO records (id, offset, length, digest, spec) VALUES (?, ?, ?, ?, ?)",
+            (record_id, offset, len(data), digest, self._spec_of(record)),
+        )
+        conn.executemany("INSERT INTO record_tags (record_id, tag) VALUES (?, ?)", [(record_id, tag) for tag in _record_tags(record)])
+        vectors: List[Tuple[int, Optional[str], Optional[str], bytes]] = []
+        self._collect_vector(vectors, record_id, record)
+        conn.executemany("INSERT INTO vectors (record_id, spec, image, vec) VALUES (?, ?, ?, ?)", vectors)
+        return offset + len(data)
+
+    def compact_in_background(self) -> threading.Thread:
+        """別スレッドでコンパクションを実行する（実行中なら既存のスレッドを返す）"""
+        with self._lock:
+            if self._compaction is None or not self._compaction.is_alive():
+                self._compaction = threading.Thread(target=self.compact, name="fewshot-compaction", daemon=True)
+                self._compaction.start()
+            return self._compaction
+
+    def _close_handles(self) -> None:
+        for handle in (self._writer, self._reader):
+            if handle is not None and not handle.closed:
+                handle.close()
+        self._writer = None
+        self._reader = None
+        self._conn.close()
+
+    def close(self) -> None:
+        compaction = self._compaction
+        if compaction is not None and compaction.is_alive() and compaction is not threading.current_thread():
+            compaction.join()
+        with self._lock:
+            self._close_handles()
+
+    def __enter__(self) -> "FewShotStore":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
@@ -0,0 +1,245 @@
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Dict, Any, Iterable, Iterator, Optional, Tuple, Union
+
+from PIL import Image
+
+from .llm_providers import LLMProvider
+from .pipeline import PipelineFull, inspection_pipeline
+
+
+# 到着・静止の判定に使う縮小画像の長辺。ブロック平均で縮めるため、ピントの差は消えて部品の出入りと動きだけが残る
+DIFF_SIDE = 32
+
+
+def _small_gray(frame: Any) -> Any:
+    """ブロック平均で DIFF_SIDE 程度まで縮めたグレースケール（float32）。フレームは BGR の配列"""
+    import numpy as np
+
+    step = max(1, max(frame.shape[:2]) // DIFF_SIDE)
+    # 大きなフレームは先に間引いてからブロック平均を取る（4×4 程度の平均があれば十分）
+    stride = max(1, step // 4)
+    sampled = frame[::stride, ::stride]
+    block = max(1, step // stride)
+    height, width = sampled.shape[0] // block * block, sampled.shape[1] // block * block
+    sampled = sampled[:height, :width].astype(np.float32)
+    if sampled.ndim == 3:
+        sampled = sampled[..., :3] @ np.array([0.114, 0.587, 0.299], dtype=np.float32)
+    return sampled.reshape(height // block, block, width // block, block).mean(axis=(1, 3))
+
+
+def frame_sharpness(frame: Any) -> float:
+    """ラプラシアンの分散（大きいほどピントが合いブレが少ない）。配列のスライスだけで計算する"""
+    import numpy as np
+
+    gray = frame[..., :3].astype(np.float32) @ np.array([0.114, 0.587, 0.299], dtype=np.float32) if frame.ndim == 3 else frame.astype(np.float32)
+    laplacian = gray[1:-1, :-2] + gray[1:-1, 2:] + gray[:-2, 1:-1] + gray[2:, 1:-1] - 4.0 * gray[1:-1, 1:-1]
+    return float(laplacian.var()) if laplacian.size else 0.0
+
+
+@dataclass
+class PartFrame:
+    index: int            # 何個目の部品か（0 始まり）
+    frame_index: int      # 選んだフレームの番号
+    image: Image.Image    # 判定に送るフレーム（RGB）
+    sharpness: float
+    settled_frames: int   # 静止していたフレーム数（この中から最も鮮明なものを選んだ）
+
+
+class PartDetector:
+    """フレーム差分で部品の到着と静止を検出し、静止中で最も鮮明なフレームを部品ごとに1枚返す
+
+    差分は縮小したグレースケール画像で、画素値の差が pixel_threshold（0-255）を超えた画素の割合として求める。
+    背景（既定は最初のフレーム）との差が presence_ratio 以上なら部品あり、直前フレームとの差が motion_ratio 未満の
+    フレームが settle_frames 回続いたら静止とみなす。静止中はフレームの鮮明さを比べ、再び動き出す・部品がいなくなる・
+    max_settled_frames に達した時点で最も鮮明なフレームを確定する。確定後は部品がいなくなる（背景に戻る）まで次の部品を数えない。
+    """
+
+    def __init__(
+        self,
+        pixel_threshold: float = 20.0,
+        motion_ratio: float = 0.01,
+        presence_ratio: float = 0.02,
+        settle_frames: int = 3,
+        max_settled_frames: int = 30,
+        background: Optional[Image.Image] = None,
+        background_rate: float = 0.05,
+    ) -> None:
+        self.pixel_threshold = pixel_threshold
+        self.motion_ratio = motion_ratio
+        self.presence_ratio = presence_ratio
+        self.settle_frames = max(1, settle_frames)
+        self.max_settled_frames = max(1, max_settled_frames)
+        self.background_rate = background_rate
+        self._background_image = background
+        self._background: Any = None
+        self._previous: Any = None
+        self._state = "idle"  # idle → arriving → settled → leaving
+        self._still = 0
+        self._settled = 0
+        self._best: Optional[Tuple[float, int, Any]] = None
+        self._parts = 0
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def update(self, frame: Any, frame_index: int) -> Optional[PartFrame]:
+        """BGR のフレームを1枚渡す。部品1個分のフレームが確定したときだけ PartFrame を返す"""
+        import numpy as np
+
+        small = _small_gray(frame)
+        if self._background is None:
+            if self._background_image is not None:
+                rgb = np.asarray(self._background_image.convert("RGB").resize((frame.shape[1], frame.shape[0])))
+                self._background = _small_gray(rgb[..., ::-1])
+            else:
+                self._background = small.copy()
+        if self._previous is None or self._previous.shape != small.shape:
+            self._previous = small
+        moving = float((np.abs(small - self._previous) > self.pixel_threshold).mean()) >= self.motion_ratio
+        present = float((np.abs(small - self._background) > self.pixel_threshold).mean()) >= self.presence_ratio
+        self._previous = small
+
+        if self._state == "idle":
+            if present:
+                self._state, self._still = "arriving", 0
+            elif not moving:
+                # 照明のゆっくりした変化に追従する
+                self._background += self.background_rate * (small - self._background)
+            return None
+        if self._state == "leaving":
+            # 確定した部品が揺れて止まり直しても同じ部品として扱い、いなくなるまで次の部品を待たない
+            if not present:
+                self._state = "idle"
+            return None
+        if not present:
+            emitted = self._emit()
+            self._state = "idle"
+            return emitted
+        if self._state == "arriving":
+            self._still = 0 if moving else self._still + 1
+            if self._still >= self.settle_frames:
+                self._state, self._settled, self._best = "settled", 0, None
+                self._consider(frame, frame_index)
+            return None
+        # settled
+        if moving:
+            emitted = self._emit()
+            self._state = "leaving"
+            return emitted
+        self._consider(frame, frame_index)
+        if self._settled >= self.max_settled_frames:
+            emitted = self._emit()
+            self._state = "leaving"
+            return emitted
+        return None
+
+    def flush(self) -> Optional[PartFrame]:
+        """映像の終わりに静止中の部品があれば確定する"""
+        emitted = self._emit() if self._state == "settled" else None
+        self._state = "idle"
+        return emitted
+
+    def _consider(self, frame: Any, frame_index: int) -> None:
+        self._settled += 1
+        score = frame_sharpness(frame)
+        if self._best is None or score > self._best[0]:
+            self._best = (score, frame_index, frame.copy())
+
+    def _emit(self) -> Optional[PartFrame]:
+        if self._best is None:
+            return None
+        score, frame_index, frame = self._best
+        part = PartFrame(
+            index=self._parts,
+            frame_index=frame_index,
+            image=Image.fromarray(frame[..., 2::-1].copy() if frame.ndim == 3 else frame),
+            sharpness=score,
+            settled_frames=self._settled,
+        )
+        self._parts += 1
+        self._best = None
+        self._settled = 0
+        return part
+
+
+def iter_video_frames(source: Union[str, int], sample_every: int = 1) -> Iterator[Tuple[int, Any]]:
+    """OpenCV の VideoCapture（動画ファイル・RTSP などの URL・カメラ番号）から (フレーム番号, BGR 配列) を読む"""
+    import cv2
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise RuntimeError(f"映像を開けませんでした: {source}")
+    try:
+        frame_index = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            if frame_index % max(1, sample_every) == 0:
+                yield frame_index, frame
+            frame_index += 1
+    finally:
+        capture.release()
+
+
+def iter_parts(frames: Iterable[Tuple[int, Any]], detector: Optional[PartDetector] = None, max_parts: Optional[int] = None) -> Iterator[PartFrame]:
+    """フレーム列から部品ごとに1枚ずつ PartFrame を返す"""
+    detector = detector or PartDetector()
+    emitted = 0
+    for frame_index, frame in frames:
+        part = detector.update(frame, frame_index)
+        if part is not None:
+            yield part
+            emitted += 1
+            if max_parts is not None and emitted >= max_parts:
+                return
+    part = detector.flush()
+    if part is not None:
+        yield part
+
+
+def inspect_stream(
+    provider: LLMProvider,
+    prompt_bundle: Dict[str, Any],
+    source: Union[str, int, Iterable[Tuple[int, Any]]],
+    detector: Optional[PartDetector] = None,
+    queue_size: int = 4,
+    net_workers: int = 2,
+    backpressure: str = "block",
+    sample_every: int = 1,
+    max_parts: Optional[int] = None,
+    on_drop: Optional[Callable[[PartFrame], Any]] = None,
+) -> Iterator[Tuple[PartFrame, Dict[str, Any]]]:
+    """映像から部品ごとに選んだ1枚だけを上限付きキュー経由で判定し、(PartFrame, 判定結果) を部品の順に返す
+
+    source は VideoCapture に渡せるもの（動画ファイル・URL・カメラ番号）か、(フレーム番号, BGR 配列) の列。
+    判定が追いつかないとき、backpressure="block" は映像の読み込みを待たせ、"reject" はその部品を捨てて on_drop を呼ぶ
+    （ライブ配信で読み込みを止めるとフレームが古くなるため）。
+    1部品の判定が例外で失敗しても映像の処理は止めず、その部品を verdict=ERROR（判定不能）として返す。
+    """
+    frames = iter_video_frames(source, sample_every) if isinstance(source, (str, int)) else source
+
+    def decision_of(future: Any) -> Dict[str, Any]:
+        exc = future.exception()
+        if exc is not None:
+            return {"verdict": "ERROR", "details": str(exc), "checks": [], "fallback_verdict": True}
+        return future.result()
+
+    pending: deque = deque()
+    with inspection_pipeline(
+        provider, prompt_bundle, cpu_workers=1, net_workers=net_workers, queue_size=queue_size, cpu_kind="thread", backpressure=backpressure
+    ) as pipeline:
+        for part in iter_parts(frames, detector, max_parts):
+            try:
+                pending.append((part, pipeline.submit(part.image)))
+            except PipelineFull:
+                if on_drop is not None:
+                    on_drop(part)
+            while pending and pending[0][1].done():
+                done_part, future = pending.popleft()
+                yield done_part, decision_of(future)
+        while pending:
+            done_part, future = pending.popleft()
+            yield done_part, decision_of(future)
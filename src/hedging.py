@@ -0,0 +1,207 @@
+import dataclasses
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, Future
+from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, Tuple
+
+from .llm_providers import RequestCancelled, cancel_scope, current_cancel_event
+
+
+@dataclass
+class HedgePolicy:
+    deadline_s: float = 30.0          # 1回の検査あたりのレイテンシ予算
+    hedge_quantile: float = 95.0      # この分位点を超えたら重複リクエストを送る
+    initial_hedge_delay_s: float = 10.0  # 実績が少ないうちのヘッジ開始までの待ち時間
+    min_hedge_delay_s: float = 0.5
+    min_samples: int = 20
+    window: int = 200
+    fallback_verdict: str = "NG"      # 期限切れ時に返す判定
+
+
+TIMEOUT_DETAILS = "応答が検査の期限（{deadline:.1f} 秒）内に返らなかったため、既定の判定 {verdict} を返しました。"
+
+
+class HedgedProvider:
+    """LLMProvider を包み、遅い応答に重複リクエスト（ヘッジ）と期限を適用するプロバイダ
+
+    run_vision_eval にそのまま渡せる。観測したレイテンシの p95 を超えても応答がなければ同じリクエストをもう1本送り、
+    先に返った有効な応答を採用する。期限を過ぎたら `timed_out: True` を付けたフォールバック判定を返す。
+    採用されなかった側の同期HTTPは中断できないため、結果を破棄する（HTTPタイムアウトは期限に揃える）。
+    呼び出し元の `cancel_scope` はワーカーに引き継ぎ、取り消されたらヘッジを送らずに `RequestCancelled` を送出する。
+    """
+
+    def __init__(self, provider: Any, policy: Optional[HedgePolicy] = None, max_workers: int = 8) -> None:
+        self.policy = policy or HedgePolicy()
+        if dataclasses.is_dataclass(provider) and hasattr(provider, "timeout"):
+            provider = dataclasses.replace(provider, timeout=min(provider.timeout, self.policy.deadline_s))
+        self.provider = provider
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self._lock = threading.Lock()
+        self._latencies: deque = deque(maxlen=self.policy.window)
+        self._counters = {"calls": 0, "hedged": 0, "hedge_wins": 0, "timeouts": 0, "errors": 0}
+        self._saved_ms: List[float] = []
+
+    def __getattr__(self, name: str) -> Any:
+        # provider_name / model / temperature / pil_to_datauri などは元のプロバイダに委譲する
+        # （非同期API はヘッジと期限を通らないため委譲しない）
+        if name.startswith("achat_"):
+            raise AttributeError(name)
+        return getattr(self.provider, name)
+
+    # --- レイテンシ統計 ---------------------------------------------------
+
+    def _observe(self, latency_s: float) -> None:
+        with self._lock:
+            self._latencies.append(latency_s)
+
+    def hedge_delay_s(self) -> float:
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < self.policy.min_samples:
+            return self.policy.initial_hedge_delay_s
+        rank = min(len(samples) - 1, int(len(samples) * self.policy.hedge_quantile / 100.0))
+        return max(self.policy.min_hedge_delay_s, samples[rank])
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            samples = sorted(self._latencies)
+            saved = list(self._saved_ms)
+
+        def pct(p: float) -> Optional[float]:
+            if not samples:
+                return None
+            return round(samples[min(len(samples) - 1, int(len(samples) * p / 100.0))] * 1000.0, 1)
+
+        calls = counters["calls"] or 1
+        counters.update(
+            {
+                "hedge_rate": counters["hedged"] / calls,
+                "timeout_rate": counters["timeouts"] / calls,
+                "p50_ms": pct(50),
+                "p95_ms": pct(95),
+                "p99_ms": pct(99),
+                # ヘッジが勝った呼び出しで、元のリクエストより何ms早く返せたか
+                "tail_saved_ms_mean": (sum(saved) / len(saved)) if saved else None,
+                "tail_saved_ms_max": max(saved) if saved else None,
+            }
+        )
+        return counters
+
+    # --- 呼び出し ---------------------------------------------------------
+
+    def _timed_call(self, cancel_event: Optional[threading.Event], method: str, *args: Any, **kwargs: Any) -> Tuple[Any, float]:
+        started = time.monotonic()
+        with cancel_scope(cancel_event):
+            resp = getattr(self.provider, method)(*args, **kwargs)
+        return resp, time.monotonic() - started
+
+    @staticmethod
+    def _is_valid(resp: Any) -> bool:
+        if isinstance(resp, dict) and isinstance(resp.get("json"), dict):
+            return str(resp["json"].get("verdict", "")).upper() != "ERROR"
+        return True
+
+    def _record_primary_late(self, future: Future, hedge_latency_s: float) -> None:
+        # 元のリクエストが後から有効な応答を返したら、ヘッジで短縮できた時間を記録する
+        # （失敗・verdict=ERROR の応答は比べる対象にならず、レイテンシにも入れない）
+        if future.cancelled() or future.exception() is not None:
+            return
+        resp, primary_latency = future.result()
+        if not self._is_valid(resp):
+            return
+        self._observe(primary_latency)
+        with self._lock:
+            self._saved_ms.append(round((primary_latency - hedge_latency_s) * 1000.0, 1))
+            if len(self._saved_ms) > self.policy.window:
+                self._saved_ms.pop(0)
+
+    def _record_late(self, future: Future) -> None:
+        # 期限後に返った元のリクエストもレイテンシ統計に入れる（遅い呼び出しを落とすと p95 とヘッジ開始が低く偏る）。
+        # HTTPタイムアウトなどで失敗した場合は、少なくとも期限まではかかった打ち切り値として記録する
+        # （verdict=ERROR の応答も失敗と同じく扱い、その所要時間は入れない）
+        if future.cancelled() or isinstance(future.exception(), RequestCancelled):
+            return
+        if future.exception() is not None or not self._is_valid(future.result()[0]):
+            self._observe(self.policy.deadline_s)
+            return
+        _, latency = future.result()
+        self._observe(latency)
+
+    def _hedged(self, method: str, *args: Any, **kwargs: Any) -> Tuple[Optional[Any], bool]:
+        """(応答, 期限切れか) を返す"""
+        started = time.monotonic()
+        deadline = started + self.policy.deadline_s
+        hedge_at = started + self.hedge_delay_s()
+        cancel_event = current_cancel_event()
+        primary = self._executor.submit(self._timed_call, cancel_event, method, *args, **kwargs)
+        futures: List[Future] = [primary]
+        hedge_sent = False
+        last_invalid: Optional[Any] = None
+        last_error: Optional[BaseException] = None
+        with self._lock:
+            self._counters["calls"] += 1
+        while True:
+            until = deadline if hedge_sent else min(hedge_at, deadline)
+            wait(futures, timeout=max(0.0, until - time.monotonic()), return_when=FIRST_COMPLETED)
+            for future in [f for f in futures if f.done()]:
+                futures.remove(future)
+                if isinstance(future.exception(), RequestCancelled):
+                    for other in futures:
+                        other.cancel()
+                    raise future.exception()  # type: ignore[misc]
+                if future.exception() is not None:
+                    last_error = future.exception()
+                    continue
+                resp, latency = future.result()
+                if not self._is_valid(resp):
+                    last_invalid = resp
+                    continue
+                if future is primary:
+                    self._observe(latency)
+                else:
+                    with self._lock:
+                        self._counters["hedge_wins"] += 1
+                    primary.add_done_callback(lambda f, lat=latency: self._record_primary_late(f, lat))
+                for other in futures:
+                    other.cancel()
+                return resp, False
+            now = time.monotonic()
+            if not futures:
+                if hedge_sent:
+                    if last_invalid is not None:
+                        return last_invalid, False
+                    with self._lock:
+                        self._counters["errors"] += 1
+                    raise last_error  # type: ignore[misc]
+                # 最初の応答がエラーなら期限内にもう1本だけ送る
+                hedge_at = now
+            if now >= deadline:
+                with self._lock:
+                    self._counters["timeouts"] += 1
+                if primary in futures:
+                    primary.add_done_callback(self._record_late)
+                for other in futures:
+                    other.cancel()
+                return None, True
+            if not hedge_sent and now >= hedge_at:
+                hedge_sent = True
+                with self._lock:
+                    self._counters["hedged"] += 1
+                futures.append(self._executor.submit(self._timed_call, cancel_event, method, *args, **kwargs))
+
+    def chat_vision(self, messages: List[Dict[str, Any]], **kwargs: Any) -> Dict[str, Any]:
+        resp, timed_out = self._hedged("chat_vision", messages, **kwargs)
+        if timed_out:
+            verdict = self.policy.fallback_verdict
+            details = TIMEOUT_DETAILS.format(deadline=self.policy.deadline_s, verdict=verdict)
+            return {"output_text": "", "json": {"verdict": verdict, "details": details, "checks": [], "timed_out": True}}
+        return resp
+
+    def chat_text(self, system_prompt: str, user_prompt: str) -> str:
+        resp, timed_out = self._hedged("chat_text", system_prompt, user_prompt)
+        if timed_out:
+            raise TimeoutError(f"応答が期限（{self.policy.deadline_s:.1f} 秒）内に返りませんでした。")
+        return resp
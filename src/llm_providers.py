@@ -1,38 +1,166 @@
 import os, base64, io, json, re
-from typing import Dict, Any, List, Optional
+import asyncio
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Callable, Dict, Any, Generator, List, Optional, Tuple
 from dataclasses import dataclass
 import requests
 from dotenv import load_dotenv
 from PIL import Image
 
+from .verdict_schema import CORRECTION_PROMPT, PARSE_STATS, SCHEMAS, gemini_response_schema, openai_json_schema, parse_verdict
+
 
 load_dotenv()
 
+TRUNCATED_NOTE = "出力が途中で打ち切られました。max_output_tokens を増やして再実行してください。"
+
+# リクエストの手順（(url, headers, payload) を yield してレスポンスを受け取り、最後に結果を返すジェネレータ）
+Flow = Generator[Tuple[str, Dict[str, str], Dict[str, Any]], Any, Any]
+
+ASYNC_MAX_CONNECTIONS = 256  # 非同期クライアントの同時接続数の上限（これを超える要求は接続待ちになる）
+CANCEL_POLL_S = 0.05  # 取り消し可能な同期呼び出しが取り消しトークンを確かめる間隔（秒）
+
+_ASYNC_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+
+
+def _async_client() -> Any:
+    """実行中のイベントループごとに1つの httpx.AsyncClient（接続プール）を共有する"""
+    loop = asyncio.get_running_loop()
+    client = _ASYNC_CLIENTS.get(loop)
+    if client is None or client.is_closed:
+        try:
+            import httpx
+        except ImportError as exc:
+            raise RuntimeError("非同期API（achat_vision / achat_text）には httpx が必要です。pip install httpx を実行してください。") from exc
+        limits = httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=ASYNC_MAX_CONNECTIONS // 4)
+        client = httpx.AsyncClient(limits=limits)
+        _ASYNC_CLIENTS[loop] = client
+    return client
+
+
+async def aclose_async_client() -> None:
+    """実行中のイベントループの共有クライアントを閉じる（ループを終える前に呼ぶ）"""
+    client = _ASYNC_CLIENTS.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+class RequestCancelled(RuntimeError):
+    """取り消しトークンが立ったため実行中のリクエストを中断したときに送出する"""
+
+
+_CANCEL_SCOPE = threading.local()
+
+
+def current_cancel_event() -> Optional[threading.Event]:
+    """このスレッドで有効な取り消しトークン（`cancel_scope` の外なら None）"""
+    return getattr(_CANCEL_SCOPE, "event", None)
+
+
+@contextmanager
+def cancel_scope(cancel_event: Optional[threading.Event]):
+    """このスレッドで行う同期の呼び出しを取り消し可能にする（None なら範囲を外す）
+
+    範囲内の `LLMProvider` の同期呼び出しは httpx で送信し、`cancel_event` が立つと送信中・受信中でも
+    中断して `RequestCancelled` を送出する（httpx がなければ従来どおり requests で送信する）。
+    別スレッドで呼び出すラッパーは `current_cancel_event()` を渡して範囲を引き継ぐ。
+    """
+    previous = getattr(_CANCEL_SCOPE, "event", None)
+    _CANCEL_SCOPE.event = cancel_event
+    try:
+        yield
+    finally:
+        _CANCEL_SCOPE.event = previous
+
+
+def _cancellable_run(arun: Callable[[], Any], cancel_event: threading.Event) -> Any:
+    """非同期の送信を専用のイベントループで進め、取り消しトークンが立てばタスクを取り消す"""
+    async def main() -> Any:
+        task = asyncio.ensure_future(arun())
+        try:
+            while not task.done():
+                if cancel_event.is_set():
+                    task.cancel()
+                    break
+                await asyncio.wait({task}, timeout=CANCEL_POLL_S)
+            try:
+                return await task
+            except asyncio.CancelledError:
+                raise RequestCancelled("取り消されました。") from None
+        finally:
+            await aclose_async_client()
+
+    return asyncio.run(main())
+
+
+def _httpx_available() -> bool:
+    try:
+        import httpx  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
 @dataclass
 class LLMProvider:
     provider_name: str = "OpenAI"  # or "Gemini"
     model: str = ""
     temperature: float = 0.2
     max_tokens: int = 1024
+    timeout: float = 120.0  # 1回のHTTPリクエストのタイムアウト（秒）
+    api_base: str = ""  # 空なら OPENAI_API_BASE / GEMINI_API_BASE、なければ公式エンドポイント
 
-    # 画像を data:uri に変換（OpenAI Vision系のinput向け）
+    # 画像を data:uri に変換（OpenAI Vision系のinput向け）。format は PNG / JPEG / WEBP、quality は非可逆形式のみ
     @staticmethod
-    def pil_to_datauri(img: Image.Image) -> str:
+    def pil_to_datauri(img: Image.Image, format: str = "PNG", quality: Optional[int] = None) -> str:
+        fmt = "JPEG" if format.upper() == "JPG" else format.upper()
+        options: Dict[str, Any] = {}
+        if fmt in {"JPEG", "WEBP"}:
+            if img.mode not in {"RGB", "L"}:
+                img = img.convert("RGB")
+            if quality:
+                options["quality"] = int(quality)
         buf = io.BytesIO()
-        img.save(buf, format="PNG")
+        img.save(buf, format=fmt, **options)
         data = base64.b64encode(buf.getvalue()).decode("utf-8")
-        return f"data:image/png;base64,{data}"
+        return f"data:image/{fmt.lower()};base64,{data}"
+
+    def chat_vision(self, messages: List[Dict[str, Any]], schema: str = "verdict", max_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """プロバイダ別のVisionチャット呼び出し (MVP: 疑似実装/ホンモノ実装の両方に対応)
 
-    def chat_vision(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """プロバイダ別のVisionチャット呼び出し (MVP: 疑似実装/ホンモノ実装の両方に対応)"""
-        if self.provider_name.lower() == "openai":
-            return self._openai_chat(messages)
-        elif self.provider_name.lower() == "gemini":
-            return self._gemini_chat(messages)
-        else:
-            raise ValueError("Unsupported provider")
+        schema は verdict_schema.SCHEMAS のキー、max_tokens はこの呼び出しだけの出力上限（未指定なら self.max_tokens）。
+        """
+        return self._run(self._vision(messages, schema, max_tokens))
 
     def chat_text(self, system_prompt: str, user_prompt: str) -> str:
+        return self._run(self._text(system_prompt, user_prompt))
+
+    async def achat_vision(self, messages: List[Dict[str, Any]], schema: str = "verdict", max_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """chat_vision の非同期版。リクエストの組み立て・エラー処理・再送は同期版と共通"""
+        return await self._arun(self._vision(messages, schema, max_tokens))
+
+    async def achat_text(self, system_prompt: str, user_prompt: str) -> str:
+        return await self._arun(self._text(system_prompt, user_prompt))
+
+    def resolved_model(self) -> str:
+        """実際に呼び出すモデル名（model が空なら環境変数 OPENAI_MODEL / GEMINI_MODEL、なければ既定のモデル）"""
+        if self.model:
+            return self.model
+        if self.provider_name.lower() == "gemini":
+            return os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+        return os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+
+    def _vision(self, messages: List[Dict[str, Any]], schema: str, max_tokens: Optional[int]) -> Flow:
+        provider = self.provider_name.lower()
+        if provider == "openai":
+            return self._openai_chat(messages, schema, max_tokens)
+        if provider == "gemini":
+            return self._gemini_chat(messages, schema, max_tokens)
+        raise ValueError("Unsupported provider")
+
+    def _text(self, system_prompt: str, user_prompt: str) -> Flow:
         provider = self.provider_name.lower()
         if provider == "openai":
             return self._openai_text(system_prompt, user_prompt)
@@ -40,6 +168,14 @@ class LLMProvider:
             return self._gemini_text(system_prompt, user_prompt)
         raise ValueError("Unsupported provider")
 
+    def _openai_url(self) -> str:
+        base = self.api_base or os.getenv("OPENAI_API_BASE", "") or "https://api.openai.com/v1"
+        return f"{base.rstrip('/')}/chat/completions"
+
+    def _gemini_url(self, model: str, api_key: str) -> str:
+        base = self.api_base or os.getenv("GEMINI_API_BASE", "") or "https://generativelanguage.googleapis.com"
+        return f"{base.rstrip('/')}/v1beta/models/{model}:generateContent?key={api_key}"
+
     @staticmethod
     def _split_messages(messages: List[Dict[str, Any]]) -> tuple[str, str, Optional[str], Optional[tuple[str, str]]]:
         system_text = ""
@@ -82,21 +218,120 @@ class LLMProvider:
         return response.text or f"HTTP {response.status_code}"
 
     @staticmethod
-    def _parse_json_response(text: str, fallback_reason: Optional[str] = None) -> Dict[str, Any]:
-        if not text:
-            details = fallback_reason or "empty response"
-            return {"verdict": "NG", "details": details, "checks": []}
+    def _http_error_result(details: str) -> Dict[str, Any]:
+        if "maximum" in details and "tokens" in details:
+            return {"output_text": details, "json": {"verdict": "ERROR", "details": TRUNCATED_NOTE, "checks": [], "note": details}}
+        return {"output_text": details, "json": {"verdict": "ERROR", "details": details, "checks": []}}
+
+    @staticmethod
+    def _relax_payload(payload: Dict[str, Any], details: str) -> bool:
+        """エラー内容から非対応のパラメータを外す。外せるものがなければ False"""
+        config = payload.get("generationConfig", payload)
+        if "temperature" in details and "default (1)" in details and "temperature" in config:
+            config.pop("temperature", None)
+            return True
+        response_format = payload.get("response_format") or {}
+        if response_format.get("type") == "json_schema" and ("response_format" in details or "json_schema" in details):
+            # 構造化出力（json_schema）に非対応のモデルは JSON モードで再送する
+            payload.update({"response_format": {"type": "json_object"}})
+            return True
+        if "responseSchema" in config and ("responseSchema" in details or "response_schema" in details):
+            config.pop("responseSchema", None)
+            return True
+        return False
+
+    def _exchange(self, url: str, headers: Dict[str, str], payload: Dict[str, Any]) -> Flow:
+        """(レスポンスJSON, エラー時の結果) を返す送受信の手順。非対応パラメータのエラーは外して再送する
+
+        HTTP の送信は行わず (url, headers, payload) を yield してレスポンスを受け取る。
+        同じ手順を同期（requests）と非同期（httpx）の両方の送信で使う。
+        """
+        while True:
+            response = yield url, headers, payload
+            if response.status_code >= 400:
+                details = self._extract_error_details(response)
+                if self._relax_payload(payload, details):
+                    continue
+                return None, self._http_error_result(details)
+            return response.json(), None
+
+    def _run(self, flow: Flow) -> Any:
+        """手順を requests で送信しながら最後まで進める（`cancel_scope` の範囲内では取り消し可能な httpx で送信する）"""
+        cancel_event = current_cancel_event()
+        if cancel_event is not None and _httpx_available():
+            return _cancellable_run(lambda: self._arun(flow), cancel_event)
+        try:
+            request = next(flow)
+            while True:
+                url, headers, payload = request
+                request = flow.send(requests.post(url, headers=headers, json=payload, timeout=self.timeout))
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            flow.close()
+
+    async def _arun(self, flow: Flow) -> Any:
+        """手順を共有の httpx.AsyncClient で送信しながら最後まで進める（await 中に取り消せる）"""
+        client = _async_client()
         try:
-            return json.loads(text)
-        except json.JSONDecodeError:
-            match = re.search(r"\{.*\}", text, re.DOTALL)
-            if match:
-                try:
-                    return json.loads(match.group(0))
-                except json.JSONDecodeError:
-                    pass
-        details = fallback_reason or text
-        return {"verdict": "NG", "details": details, "checks": []}
+            request = next(flow)
+            while True:
+                url, headers, payload = request
+                response = await client.post(url, headers=headers, json=payload, timeout=self.timeout)
+                request = flow.send(response)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            flow.close()
+
+    @staticmethod
+    def _merge_usage(a: Dict[str, int], b: Dict[str, int]) -> Dict[str, int]:
+        return {key: int(a.get(key) or 0) + int(b.get(key) or 0) for key in set(a) | set(b)}
+
+    def _structured_result(
+        self,
+        data: Dict[str, Any],
+        extract: Callable[[Dict[str, Any]], Tuple[str, bool]],
+        resend: Callable[[str, str], Flow],
+        schema: str = "verdict",
+    ) -> Flow:
+        """判定JSONを検証し、合致しなければ修正依頼を添えて1回だけ再問い合わせする"""
+        model = SCHEMAS[schema]
+        text, truncated = extract(data)
+        usage = self._normalize_usage(data)
+        parsed, error = parse_verdict(text, model)
+        if parsed is None and not truncated:
+            PARSE_STATS.add("retried")
+            retry_data, http_error = yield from resend(text, CORRECTION_PROMPT.format(error=error))
+            if http_error is None and retry_data is not None:
+                text, truncated = extract(retry_data)
+                usage = self._merge_usage(usage, self._normalize_usage(retry_data))
+                parsed, error = parse_verdict(text, model)
+        if parsed is None:
+            PARSE_STATS.add("failed")
+            details = TRUNCATED_NOTE if truncated else f"応答を判定JSONとして解釈できませんでした（{error}）。"
+            parsed = {"verdict": "ERROR", "details": details, "checks": [], "parse_error": True}
+        # finish_reason は "length"（出力上限で打ち切り）/ "stop" に揃える
+        return {"output_text": text, "json": parsed, "usage": usage, "finish_reason": "length" if truncated else "stop"}
+
+    @staticmethod
+    def _normalize_usage(data: Dict[str, Any]) -> Dict[str, int]:
+        """OpenAI の usage / Gemini の usageMetadata を共通のキーに揃える"""
+        usage = data.get("usage")
+        if isinstance(usage, dict):
+            return {
+                "prompt_tokens": int(usage.get("prompt_tokens") or 0),
+                "completion_tokens": int(usage.get("completion_tokens") or 0),
+                "total_tokens": int(usage.get("total_tokens") or 0),
+            }
+        meta = data.get("usageMetadata")
+        if isinstance(meta, dict):
+            return {
+                "prompt_tokens": int(meta.get("promptTokenCount") or 0),
+                "completion_tokens": int(meta.get("candidatesTokenCount") or 0),
+                "total_tokens": int(meta.get("totalTokenCount") or 0),
+            }
+        return {}
 
     @staticmethod
     def _debug_print(title: str, payload: Any) -> None:
@@ -104,13 +339,13 @@ class LLMProvider:
             print(title)
             print(json.dumps(payload, ensure_ascii=False, indent=2) if isinstance(payload, (dict, list)) else payload)
 
-    def _openai_chat(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    def _openai_chat(self, messages: List[Dict[str, Any]], schema: str = "verdict", max_tokens: Optional[int] = None) -> Flow:
         api_key = os.getenv("OPENAI_API_KEY", "").strip()
         if not api_key:
             raise RuntimeError("OPENAI_API_KEYが設定されていません。")
 
         system_text, user_text, image_uri, _ = self._split_messages(messages)
-        model = self.model or os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+        model = self.resolved_model()
 
         content: List[Dict[str, Any]] = []
         if user_text:
@@ -126,12 +361,12 @@ class LLMProvider:
                 {"role": "system", "content": system_text},
                 {"role": "user", "content": content},
             ],
-            "response_format": {"type": "json_object"},
+            "response_format": {"type": "json_schema", "json_schema": openai_json_schema(SCHEMAS[schema])},
         }
         if self.temperature not in (None, 1):
             payload["temperature"] = self.temperature
-        if self.max_tokens:
-            payload["max_completion_tokens"] = self.max_tokens
+        if max_tokens or self.max_tokens:
+            payload["max_completion_tokens"] = max_tokens or self.max_tokens
 
         printable_messages = []
         for msg in messages:
@@ -143,68 +378,42 @@ class LLMProvider:
             printable_messages.append(msg_copy)
         self._debug_print("=== OpenAI メッセージ ===", printable_messages)
 
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=120,
-        )
-        try:
-            response.raise_for_status()
-        except requests.HTTPError:
-            details = self._extract_error_details(response)
-            if "temperature" in details and "default (1)" in details and "temperature" in payload:
-                payload.pop("temperature", None)
-                response = requests.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "Content-Type": "application/json",
-                    },
-                    json=payload,
-                    timeout=120,
-                )
-                try:
-                    response.raise_for_status()
-                except requests.HTTPError:
-                    details = self._extract_error_details(response)
-                    return {"output_text": details, "json": {"verdict": "ERROR", "details": details, "checks": []}}
-            elif "maximum" in details and "tokens" in details:
-                note = "出力が途中で打ち切られました。max_output_tokens を増やして再実行してください。"
-                return {"output_text": details, "json": {"verdict": "ERROR", "details": note, "checks": [], "note": details}}
-            else:
-                return {"output_text": details, "json": {"verdict": "ERROR", "details": details, "checks": []}}
-
-        data = response.json()
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+        data, error = yield from self._exchange(self._openai_url(), headers, payload)
+        if error is not None:
+            return error
         self._debug_print("=== OpenAI レスポンス ===", data)
 
-        choices = data.get("choices") or []
-        if not choices:
-            raise RuntimeError("OpenAIレスポンスにchoicesが含まれていません。")
-
-        message_content = choices[0].get("message", {}).get("content", "")
-        if isinstance(message_content, list):
-            text = "\n".join(part.get("text", "") for part in message_content if part.get("type") == "text").strip()
-        else:
-            text = str(message_content).strip()
+        def extract(data: Dict[str, Any]) -> Tuple[str, bool]:
+            choices = data.get("choices") or []
+            if not choices:
+                raise RuntimeError("OpenAIレスポンスにchoicesが含まれていません。")
+            message_content = choices[0].get("message", {}).get("content", "")
+            if isinstance(message_content, list):
+                text = "\n".join(part.get("text", "") for part in message_content if part.get("type") == "text").strip()
+            else:
+                text = str(message_content or "").strip()
+            return text, choices[0].get("finish_reason") == "length"
 
-        fallback_reason = None
-        if choices[0].get("finish_reason") == "length":
-            fallback_reason = "出力が途中で打ち切られました。max_output_tokens を増やして再実行してください。"
+        def resend(previous: str, correction: str) -> Flow:
+            payload["messages"] = payload["messages"] + [
+                {"role": "assistant", "content": previous},
+                {"role": "user", "content": correction},
+            ]
+            return self._exchange(self._openai_url(), headers, payload)
 
-        parsed = self._parse_json_response(text, fallback_reason)
-        return {"output_text": text, "json": parsed}
+        return (yield from self._structured_result(data, extract, resend, schema))
 
-    def _gemini_chat(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    def _gemini_chat(self, messages: List[Dict[str, Any]], schema: str = "verdict", max_tokens: Optional[int] = None) -> Flow:
         api_key = os.getenv("GEMINI_API_KEY", "").strip()
         if not api_key:
             raise RuntimeError("GEMINI_API_KEYが設定されていません。")
 
         system_text, user_text, _, inline_data = self._split_messages(messages)
-        model = self.model or os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+        model = self.resolved_model()
         prompt_text = "\n\n".join(filter(None, [system_text, user_text]))
 
         parts: List[Dict[str, Any]] = []
@@ -214,11 +423,11 @@ class LLMProvider:
             mime, data_b64 = inline_data
             parts.append({"inlineData": {"mimeType": mime, "data": data_b64}})
 
-        generation_config: Dict[str, Any] = {}
+        generation_config: Dict[str, Any] = {"responseMimeType": "application/json", "responseSchema": gemini_response_schema(SCHEMAS[schema])}
         if self.temperature not in (None, 1):
             generation_config["temperature"] = self.temperature
-        if self.max_tokens:
-            generation_config["maxOutputTokens"] = self.max_tokens
+        if max_tokens or self.max_tokens:
+            generation_config["maxOutputTokens"] = max_tokens or self.max_tokens
 
         payload = {
             "contents": [
@@ -228,7 +437,6 @@ class LLMProvider:
                 }
             ],
             "generationConfig": generation_config,
-            "responseMimeType": "application/json",
         }
 
         printable_messages = []
@@ -241,61 +449,36 @@ class LLMProvider:
             printable_messages.append(msg_copy)
         self._debug_print("=== Gemini メッセージ ===", printable_messages)
 
-        url = (
-            f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
-            f"?key={api_key}"
-        )
-        response = requests.post(
-            url,
-            headers={"Content-Type": "application/json"},
-            json=payload,
-            timeout=120,
-        )
-        try:
-            response.raise_for_status()
-        except requests.HTTPError:
-            details = self._extract_error_details(response)
-            if "temperature" in details and "default (1)" in details and "temperature" in payload.get("generationConfig", {}):
-                payload["generationConfig"].pop("temperature", None)
-                response = requests.post(
-                    url,
-                    headers={"Content-Type": "application/json"},
-                    json=payload,
-                    timeout=120,
-                )
-                try:
-                    response.raise_for_status()
-                except requests.HTTPError:
-                    details = self._extract_error_details(response)
-                    return {"output_text": details, "json": {"verdict": "ERROR", "details": details, "checks": []}}
-            elif "maximum" in details and "tokens" in details:
-                note = "出力が途中で打ち切られました。max_output_tokens を増やして再実行してください。"
-                return {"output_text": details, "json": {"verdict": "ERROR", "details": note, "checks": [], "note": details}}
-            else:
-                return {"output_text": details, "json": {"verdict": "ERROR", "details": details, "checks": []}}
-
-        data = response.json()
+        url = self._gemini_url(model, api_key)
+        headers = {"Content-Type": "application/json"}
+        data, error = yield from self._exchange(url, headers, payload)
+        if error is not None:
+            return error
         self._debug_print("=== Gemini レスポンス ===", data)
 
-        candidates = data.get("candidates") or []
-        text = ""
-        if candidates:
-            parts = candidates[0].get("content", {}).get("parts", [])
-            text = "".join(part.get("text", "") for part in parts if "text" in part).strip()
+        def extract(data: Dict[str, Any]) -> Tuple[str, bool]:
+            candidates = data.get("candidates") or []
+            text = ""
+            if candidates:
+                parts = candidates[0].get("content", {}).get("parts", [])
+                text = "".join(part.get("text", "") for part in parts if "text" in part).strip()
+            return text, bool(candidates) and candidates[0].get("finishReason") == "MAX_TOKENS"
 
-        fallback_reason = None
-        if candidates and candidates[0].get("finishReason") == "MAX_TOKENS":
-            fallback_reason = "出力が途中で打ち切られました。max_output_tokens を増やして再実行してください。"
+        def resend(previous: str, correction: str) -> Flow:
+            payload["contents"] = payload["contents"] + [
+                {"role": "model", "parts": [{"text": previous}]},
+                {"role": "user", "parts": [{"text": correction}]},
+            ]
+            return self._exchange(url, headers, payload)
 
-        parsed = self._parse_json_response(text, fallback_reason)
-        return {"output_text": text, "json": parsed}
+        return (yield from self._structured_result(data, extract, resend, schema))
 
-    def _openai_text(self, system_prompt: str, user_prompt: str) -> str:
+    def _openai_text(self, system_prompt: str, user_prompt: str) -> Flow:
         api_key = os.getenv("OPENAI_API_KEY", "").strip()
         if not api_key:
             raise RuntimeError("OPENAI_API_KEYが設定されていません。")
 
-        model = self.model or os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+        model = self.resolved_model()
         payload: Dict[str, Any] = {
             "model": model,
             "messages": [
@@ -310,41 +493,13 @@ class LLMProvider:
 
         self._debug_print("=== OpenAI テキストプロンプト ===", payload)
 
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=120,
-        )
-        try:
-            response.raise_for_status()
-        except requests.HTTPError:
-            details = self._extract_error_details(response)
-            if "temperature" in details and "default (1)" in details and "temperature" in payload:
-                payload.pop("temperature", None)
-                response = requests.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "Content-Type": "application/json",
-                    },
-                    json=payload,
-                    timeout=120,
-                )
-                try:
-                    response.raise_for_status()
-                except requests.HTTPError:
-                    details = self._extract_error_details(response)
-                    raise RuntimeError(details)
-            elif "maximum" in details and "tokens" in details:
-                raise RuntimeError("出力が途中で打ち切られました。max_output_tokens を増やして再実行してください。")
-            else:
-                raise RuntimeError(details)
-
-        data = response.json()
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+        data, error = yield from self._exchange(self._openai_url(), headers, payload)
+        if error is not None:
+            raise RuntimeError(error["json"]["details"])
         self._debug_print("=== OpenAI テキストレスポンス ===", data)
 
         choices = data.get("choices") or []
@@ -356,12 +511,12 @@ class LLMProvider:
             return "\n".join(part.get("text", "") for part in message_content if part.get("type") == "text").strip()
         return str(message_content).strip()
 
-    def _gemini_text(self, system_prompt: str, user_prompt: str) -> str:
+    def _gemini_text(self, system_prompt: str, user_prompt: str) -> Flow:
         api_key = os.getenv("GEMINI_API_KEY", "").strip()
         if not api_key:
             raise RuntimeError("GEMINI_API_KEYが設定されていません。")
 
-        model = self.model or os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+        model = self.resolved_model()
         generation_config: Dict[str, Any] = {}
         if self.temperature not in (None, 1):
             generation_config["temperature"] = self.temperature
@@ -381,39 +536,10 @@ class LLMProvider:
 
         self._debug_print("=== Gemini テキストプロンプト ===", payload)
 
-        url = (
-            f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
-            f"?key={api_key}"
-        )
-        response = requests.post(
-            url,
-            headers={"Content-Type": "application/json"},
-            json=payload,
-            timeout=120,
-        )
-        try:
-            response.raise_for_status()
-        except requests.HTTPError:
-            details = self._extract_error_details(response)
-            if "temperature" in details and "default (1)" in details and "temperature" in payload.get("generationConfig", {}):
-                payload["generationConfig"].pop("temperature", None)
-                response = requests.post(
-                    url,
-                    headers={"Content-Type": "application/json"},
-                    json=payload,
-                    timeout=120,
-                )
-                try:
-                    response.raise_for_status()
-                except requests.HTTPError:
-                    details = self._extract_error_details(response)
-                    raise RuntimeError(details)
-            elif "maximum" in details and "tokens" in details:
-                raise RuntimeError("出力が途中で打ち切られました。max_output_tokens を増やして再実行してください。")
-            else:
-                raise RuntimeError(details)
-
-        data = response.json()
+        url = self._gemini_url(model, api_key)
+        data, error = yield from self._exchange(url, {"Content-Type": "application/json"}, payload)
+        if error is not None:
+            raise RuntimeError(error["json"]["details"])
         self._debug_print("=== Gemini テキストレスポンス ===", data)
 
         candidates = data.get("candidates") or []
@@ -0,0 +1,304 @@
+import functools
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Any, Iterable, Iterator, List, Optional, Tuple
+
+from .llm_providers import LLMProvider
+from .vision_eval import evaluate_prepared, prepare_request
+
+
+class PipelineFull(Exception):
+    """backpressure="reject" で入口のキューが満杯のときに送出する"""
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable[[Any], Any]
+    workers: int = 1
+    kind: str = "thread"  # "thread" | "process"（CPU処理はプロセスプールで GIL を避ける）
+    queue_size: int = 16  # このステージの入力キューの上限（満杯なら上流が待つ）
+
+
+class _Job:
+    __slots__ = ("value", "future")
+
+    def __init__(self, value: Any, future: Future) -> None:
+        self.value = value
+        self.future = future
+
+
+_STOP = object()
+
+
+class _StageState:
+    def __init__(self, stage: Stage) -> None:
+        self.stage = stage
+        self.queue: "queue.Queue[Any]" = queue.Queue(maxsize=max(1, stage.queue_size))
+        self.pool: Optional[ProcessPoolExecutor] = (
+            # ワーカースレッドを持つプロセスからの fork はデッドロックし得るため spawn で起動する
+            ProcessPoolExecutor(max_workers=stage.workers, mp_context=multiprocessing.get_context("spawn"))
+            if stage.kind == "process"
+            else None
+        )
+        self.threads: List[threading.Thread] = []
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.errors = 0
+        self.busy_s = 0.0
+        self.active = 0
+
+
+class Pipeline:
+    """ステージを上限付きキューでつないだ生産者/消費者パイプライン
+
+    `submit` は1件ごとの Future を返し（常駐サービス向け）、`map` は入力順に結果を返す（バッチ向け）。
+    下流が詰まるとキューが埋まり、入口の `submit` が待つ（backpressure="block"）か `PipelineFull` を送出する（"reject"）。
+    `close(drain=True)` は受け付けを止めて投入済みの項目を最後まで流してから停止する。
+    """
+
+    def __init__(self, stages: List[Stage], backpressure: str = "block") -> None:
+        if not stages:
+            raise ValueError("ステージを1つ以上指定してください。")
+        if backpressure not in {"block", "reject"}:
+            raise ValueError(f"未対応の backpressure です: {backpressure}")
+        self.backpressure = backpressure
+        self._states = [_StageState(stage) for stage in stages]
+        self._lock = threading.Lock()
+        self._closed = False
+        self._submitted = 0
+        self._completed = 0
+        self._started_at = time.monotonic()
+        for index, state in enumerate(self._states):
+            for n in range(max(1, state.stage.workers)):
+                thread = threading.Thread(
+                    target=self._work, args=(index,), name=f"pipeline-{state.stage.name}-{n}", daemon=True
+                )
+                thread.start()
+                state.threads.append(thread)
+
+    # --- 投入 -------------------------------------------------------------
+
+    def submit(self, item: Any, timeout: Optional[float] = None) -> Future:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("パイプラインは停止しています。")
+        future: Future = Future()
+        job = _Job(item, future)
+        entry = self._states[0].queue
+        if self.backpressure == "reject":
+            try:
+                entry.put_nowait(job)
+            except queue.Full:
+                raise PipelineFull(f"入口のキューが満杯です（{entry.maxsize} 件）。") from None
+        else:
+            # timeout を過ぎても空かなければ queue.Full を送出する
+            entry.put(job, timeout=timeout)
+        with self._lock:
+            self._submitted += 1
+        future.add_done_callback(self._on_done)
+        return future
+
+    def map(self, items: Iterable[Any], return_exceptions: bool = False) -> Iterator[Any]:
+        """入力順に結果を返す。投入はキューの上限で自然に抑えられるため、大量の入力もメモリに溜めない"""
+        pending: deque = deque()
+
+        def take(future: Future) -> Any:
+            try:
+                return future.result()
+            except Exception as exc:
+                if return_exceptions:
+                    return exc
+                raise
+
+        for item in items:
+            pending.append(self.submit(item))
+            while pending and pending[0].done():
+                yield take(pending.popleft())
+        while pending:
+            yield take(pending.popleft())
+
+    def _on_done(self, future: Future) -> None:
+        with self._lock:
+            self._completed += 1
+
+    # --- 実行 -------------------------------------------------------------
+
+    def _work(self, index: int) -> None:
+        state = self._states[index]
+        downstream = self._states[index + 1].queue if index + 1 < len(self._states) else None
+        while True:
+            job = state.queue.get()
+            if job is _STOP:
+                return
+            if job.future.done():
+                # 取り消し済み
+                continue
+            with state.lock:
+                state.active += 1
+            started = time.monotonic()
+            try:
+                if state.pool is not None:
+                    value = state.pool.submit(state.stage.fn, job.value).result()
+                else:
+                    value = state.stage.fn(job.value)
+            except BaseException as exc:
+                with state.lock:
+                    state.errors += 1
+                if not job.future.done():
+                    job.future.set_exception(exc)
+            else:
+                if downstream is None:
+                    if not job.future.done():
+                        job.future.set_result(value)
+                else:
+                    job.value = value
+                    # 下流のキューが満杯ならここで待つ（上流へ backpressure が伝わる）
+                    downstream.put(job)
+            finally:
+                with state.lock:
+                    state.active -= 1
+                    state.processed += 1
+                    state.busy_s += time.monotonic() - started
+
+    # --- 停止 -------------------------------------------------------------
+
+    def close(self, drain: bool = True, timeout: Optional[float] = None) -> None:
+        """受け付けを止めて停止する。drain=False なら未着手の項目を取り消す"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if not drain:
+            for state in self._states:
+                while True:
+                    try:
+                        job = state.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    job.future.cancel()
+        # 上流から順に停止する。停止の合図はキューの末尾に入るため、先に入った項目は処理される
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for state in self._states:
+            for _ in state.threads:
+                state.queue.put(_STOP)
+            for thread in state.threads:
+                thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            if state.pool is not None:
+                state.pool.shutdown(wait=drain, cancel_futures=not drain)
+
+    def __enter__(self) -> "Pipeline":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    # --- 参照 -------------------------------------------------------------
+
+    def metrics(self) -> Dict[str, Any]:
+        """ステージごとのキューの深さ・処理件数・稼働率（ワーカー数あたりの処理中時間の割合）"""
+        elapsed = max(1e-9, time.monotonic() - self._started_at)
+        stages = []
+        for state in self._states:
+            with state.lock:
+                processed, errors, busy_s, active = state.processed, state.errors, state.busy_s, state.active
+            workers = max(1, state.stage.workers)
+            stages.append(
+                {
+                    "name": state.stage.name,
+                    "kind": state.stage.kind,
+                    "workers": workers,
+                    "queue_depth": state.queue.qsize(),
+                    "queue_capacity": state.queue.maxsize,
+                    "active": active,
+                    "processed": processed,
+                    "errors": errors,
+                    "utilisation": min(1.0, busy_s / (workers * elapsed)),
+                    "mean_ms": (busy_s / processed * 1000.0) if processed else None,
+                }
+            )
+        with self._lock:
+            submitted, completed = self._submitted, self._completed
+        return {"submitted": submitted, "completed": completed, "in_flight": submitted - completed, "stages": stages}
+
+
+def _stage_encoder(provider: Any, cpu_kind: str) -> Tuple[Callable[..., str], str]:
+    """送信画像のエンコーダ（プロバイダのもの）と前処理ステージの種類
+
+    プロバイダ独自のエンコーダをプロセスへ渡せない（pickle できない）場合は、送信画像が run_vision_eval と
+    変わらないよう、前処理ステージをスレッドで動かす。
+    """
+    encode = getattr(provider, "pil_to_datauri", None) or LLMProvider.pil_to_datauri
+    if cpu_kind == "process":
+        try:
+            pickle.dumps(encode)
+        except Exception:
+            return encode, "thread"
+    return encode, cpu_kind
+
+
+def inspection_pipeline(
+    provider: LLMProvider,
+    prompt_bundle: Dict[str, Any],
+    cpu_workers: int = 2,
+    net_workers: int = 8,
+    queue_size: int = 32,
+    cpu_kind: str = "process",
+    sink: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    backpressure: str = "block",
+) -> Pipeline:
+    """画像（PIL・バイト列・パス）を入力に run_vision_eval と同じ判定結果を返すパイプライン
+
+    prepare（デコード・切り出し・エンコード・base64、既定はプロセスプール）→ evaluate（API呼び出しと応答の検証、スレッド）
+    →（sink を渡せば）record の順に流す。sink は結果の保存などに使い、戻り値は無視して判定結果をそのまま返す。
+    エンコードにはプロバイダの pil_to_datauri を使う。
+    """
+
+    def record(result: Dict[str, Any]) -> Dict[str, Any]:
+        sink(result)  # type: ignore[misc]
+        return result
+
+    encode, cpu_kind = _stage_encoder(provider, cpu_kind)
+    stages = [
+        Stage("prepare", functools.partial(prepare_request, prompt_bundle, encode=encode), cpu_workers, cpu_kind, queue_size),
+        Stage("evaluate", functools.partial(evaluate_prepared, provider, prompt_bundle), net_workers, "thread", queue_size),
+    ]
+    if sink is not None:
+        stages.append(Stage("record", record, 1, "thread", queue_size))
+    return Pipeline(stages, backpressure=backpressure)
+
+
+def _prepare_pair(encode: Callable[..., str], pair: Tuple[Dict[str, Any], Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    prompt_bundle, img = pair
+    return prompt_bundle, prepare_request(prompt_bundle, img, encode)
+
+
+def _evaluate_pair(provider: Any, pair: Tuple[Dict[str, Any], Dict[str, Any]]) -> Dict[str, Any]:
+    prompt_bundle, prepared = pair
+    return evaluate_prepared(provider, prompt_bundle, prepared)
+
+
+def batch_pipeline(
+    provider: LLMProvider,
+    cpu_workers: int = 2,
+    net_workers: int = 8,
+    queue_size: int = 32,
+    cpu_kind: str = "process",
+) -> Pipeline:
+    """(プロンプトバンドル, 画像) の組を入力に run_vision_eval と同じ判定結果を返すパイプライン
+
+    仕様の候補や送信画像の設定ごとにバンドルが変わる一括評価（自動探索・キャリブレーション）向け。
+    ステージの構成は inspection_pipeline と同じ。
+    """
+    encode, cpu_kind = _stage_encoder(provider, cpu_kind)
+    stages = [
+        Stage("prepare", functools.partial(_prepare_pair, encode), cpu_workers, cpu_kind, queue_size),
+        Stage("evaluate", functools.partial(_evaluate_pair, provider), net_workers, "thread", queue_size),
+    ]
+    return Pipeline(stages)
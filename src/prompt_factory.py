@@ -1,5 +1,12 @@
-from typing import Dict, Any
-import textwrap, json
+from typing import Dict, Any, List, Optional, Sequence, TYPE_CHECKING
+import textwrap, json, re
+
+from PIL import Image
+
+from .eval_cache import image_digest
+
+if TYPE_CHECKING:
+    from .fewshot import FewShotStore
 
 SYSTEM_PROMPT = """あなたは製造業の外観検査エキスパートです。
 ユーザが入力した日本語仕様に基づき、与えられた画像全体に対して厳密で一貫したOK/NG判定を行います。
@@ -7,15 +14,117 @@ SYSTEM_PROMPT = """あなたは製造業の外観検査エキスパートです
 視点の傾き・遠近がある場合も可能な限り判定のロバスト性を維持し、根拠をdetailsに明記してください。
 """
 
-def build_prompt_bundle(spec_text: str) -> Dict[str, Any]:
-    """System / User のバンドル（各プロバイダで適宜整形して使う）"""
+# ライン（短縮）モード: 出力トークンを抑えるため判定コードと NG 時の短い理由だけを返させる
+LINE_SYSTEM_PROMPT = """あなたは製造業の外観検査エキスパートです。
+ユーザが入力した日本語仕様に基づき、与えられた画像全体に対して厳密で一貫したOK/NG判定を行います。
+応答は1行のJSONのみ: {"v": "OK|NG", "r": "NGの場合のみ30字以内の理由。OKなら空文字"}。説明・改行・チェック項目の列挙は出力しないでください。
+"""
+
+OUTPUT_MODES = {"json": SYSTEM_PROMPT, "line": LINE_SYSTEM_PROMPT}
+
+# 検査項目ごとの判定: 1項目だけを短い出力で判定させる（run_vision_eval が項目ごとに並列で呼び出す）
+CHECK_SYSTEM_PROMPT = """あなたは製造業の外観検査エキスパートです。
+与えられた画像全体について、指定された1つの検査項目だけを厳密に判定します（他の項目は判定しない）。
+応答は1行のJSONのみ: {"v": "OK|NG", "r": "NGの場合のみ30字以内の理由。OKなら空文字"}。
+"""
+
+_BULLET = re.compile(r"^\s*(?:[・\-\*•●○]|\(?\d+[.)．）]|[①-⑳])\s*")
+
+
+def split_spec_checks(spec_text: str) -> List[str]:
+    """検査仕様を独立した検査項目に分ける（改行・箇条書きで区切り、1文だけなら読点区切りが3つ以上のときのみ分ける）
+
+    句点では区切らない（「傷がないこと。ただし端面の擦れは許容する。」の但し書きが別の項目にならないように）。
+    """
+    items = [_BULLET.sub("", line).strip() for line in spec_text.splitlines()]
+    items = [item for item in items if item]
+    if len(items) == 1 and "。" not in items[0].rstrip("。"):
+        pieces = [piece.strip() for piece in re.split(r"[、,;；]", items[0]) if piece.strip()]
+        if len(pieces) >= 3:
+            items = pieces
+    return items
+
+
+def build_prompt_bundle(
+    spec_text: str,
+    fewshot_store: Optional["FewShotStore"] = None,
+    query_image: Optional[Image.Image] = None,
+    fewshot_k: int = 3,
+    output_mode: str = "json",
+    checks: Optional[Sequence[str]] = None,
+    decompose: bool = False,
+    preprocess: Optional[Dict[str, Any]] = None,
+    image: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """System / User のバンドル（各プロバイダで適宜整形して使う）
+
+    fewshot_store と query_image を渡すと、クエリ画像に最も近いラベル付きの例だけを few_shots に添付する
+    （画像ごとに判定する場合は attach_few_shots を使う）。
+    output_mode="line" は短縮スキーマ（判定コード + NG 時のみ理由）で回答させる。
+    checks（または decompose=True で仕様から自動分割した項目）が2件以上あれば、項目ごとの並列判定用に添付する。
+    preprocess は判定前の部品切り出し設定（vision_eval.preprocess_image を参照）。
+    image は送信画像の長辺・形式・品質（calibration.calibrate_resolution で決めた値、vision_eval.prepare_request を参照）。
+    """
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError(f"未対応の出力モードです: {output_mode}")
 
     user_payload = {
         "spec_text": spec_text,
         "instruction": "画像全体が仕様に合致するか検証し、OK/NGと理由をJSONで一貫して回答してください。"
     }
 
-    return {
-        "system": SYSTEM_PROMPT,
+    bundle: Dict[str, Any] = {
+        "system": OUTPUT_MODES[output_mode],
         "user": user_payload,
     }
+    if output_mode != "json":
+        bundle["output_mode"] = output_mode
+    if preprocess:
+        bundle["preprocess"] = dict(preprocess)
+    if image:
+        bundle["image"] = dict(image)
+    if checks is None and decompose:
+        checks = split_spec_checks(spec_text)
+    check_items = [str(check).strip() for check in (checks or []) if str(check).strip()]
+    if len(check_items) >= 2:
+        bundle["checks"] = [{"id": f"C{i}", "text": text} for i, text in enumerate(check_items, 1)]
+        bundle["check_system"] = CHECK_SYSTEM_PROMPT
+    if fewshot_store is not None and query_image is not None:
+        bundle = attach_few_shots(bundle, fewshot_store, query_image, k=fewshot_k)
+    return bundle
+
+
+def attach_few_shots(
+    bundle: Dict[str, Any],
+    fewshot_store: "FewShotStore",
+    img: Image.Image,
+    k: int = 3,
+    image_hash: Optional[str] = None,
+) -> Dict[str, Any]:
+    """この画像に似たラベル付きの例を few_shots に添付したバンドルのコピーを返す（例が無ければ元のバンドル）
+
+    判定する画像ごとに呼ぶ。その画像自身から作った例は除く（自分の正解ラベルをヒントにしない）。
+    """
+    if k <= 0:
+        return bundle
+    examples = fewshot_store.similar_examples(
+        img,
+        k=k,
+        spec_text=bundle["user"]["spec_text"],
+        exclude_image=image_hash or image_digest(img),
+    )
+    if not examples:
+        return bundle
+    attached = dict(bundle)
+    attached["few_shots"] = [_few_shot_summary(example) for example in examples]
+    return attached
+
+
+def _few_shot_summary(record: Dict[str, Any]) -> Dict[str, Any]:
+    # プロンプトに載せるのは判定とフィードバックのみ（例の画像は送らない）
+    decision = record.get("model_decision") or {}
+    return {
+        "verdict": record.get("verdict") or decision.get("verdict", ""),
+        "feedback": record.get("human_feedback") or decision.get("details", ""),
+        "similarity": record.get("similarity"),
+    }
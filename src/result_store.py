@@ -0,0 +1,208 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, List, Optional, Iterable, Sequence, Tuple
+
+DEFAULT_RESULT_DB = "data/eval_results.sqlite"
+
+
+class ResultStore:
+    """判定結果を SQLite に追記し、仕様バージョン・モデル別の集計をインデックスで返すストア
+
+    ブラッシュアップUIと最終アプリの双方から同じファイルを参照できる（環境変数 AVI_RESULT_DB で指定）。
+    集計は SQL 側で行い、全件を Python のメモリに読み込まない。
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or os.getenv("AVI_RESULT_DB") or DEFAULT_RESULT_DB
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY,
+                ts REAL NOT NULL,
+                source TEXT NOT NULL,
+                image_hash TEXT NOT NULL,
+                spec_version TEXT NOT NULL,
+                provider TEXT NOT NULL,
+                model TEXT NOT NULL,
+                verdict TEXT NOT NULL,
+                expected TEXT,
+                latency_ms REAL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                total_tokens INTEGER,
+                fallback INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS results_outcome ON results(spec_version, model, expected, verdict);
+            CREATE INDEX IF NOT EXISTS results_latency ON results(spec_version, model, latency_ms);
+            CREATE INDEX IF NOT EXISTS results_image ON results(image_hash);
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(results)")}
+        if "fallback" not in columns:
+            # 以前の形式のファイルには列を追加する（既存の行は判定として扱う）
+            self._conn.execute("ALTER TABLE results ADD COLUMN fallback INTEGER NOT NULL DEFAULT 0")
+        self._conn.commit()
+
+    # --- 書き込み ---------------------------------------------------------
+
+    @staticmethod
+    def row(
+        image_hash: str,
+        spec_version: str,
+        provider: str,
+        model: str,
+        decision: Dict[str, Any],
+        expected: Optional[str] = None,
+        source: str = "",
+        ts: Optional[float] = None,
+    ) -> Tuple[Any, ...]:
+        """record_many に渡す1行。判定不能（ERROR）・期限切れの既定判定はモデルの判定ではないため fallback を立てる"""
+        usage = decision.get("usage") or {}
+        verdict = str(decision.get("verdict", "")).upper()
+        fallback = bool(decision.get("fallback_verdict") or decision.get("timed_out")) or verdict not in {"OK", "NG"}
+        return (
+            ts if ts is not None else time.time(),
+            source,
+            image_hash,
+            spec_version,
+            provider,
+            model,
+            verdict,
+            expected.upper() if expected else None,
+            decision.get("latency_ms"),
+            usage.get("prompt_tokens"),
+            usage.get("completion_tokens"),
+            usage.get("total_tokens"),
+            int(fallback),
+        )
+
+    def record(self, image_hash: str, spec_version: str, provider: str, model: str, decision: Dict[str, Any], expected: Optional[str] = None, source: str = "") -> None:
+        """1件の判定結果（run_vision_eval の戻り値）を追記する"""
+        self.record_many([self.row(image_hash, spec_version, provider, model, decision, expected, source)])
+
+    def record_many(self, rows: Iterable[Tuple[Any, ...]]) -> None:
+        """`ResultStore.row` で作った行をまとめて1トランザクションで追記する"""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO results (ts, source, image_hash, spec_version, provider, model, verdict, expected,"
+                " latency_ms, prompt_tokens, completion_tokens, total_tokens, fallback) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    # --- 集計 -------------------------------------------------------------
+
+    @staticmethod
+    def _where(spec_version: Optional[str], model: Optional[str], extra: Sequence[str] = ()) -> Tuple[str, List[Any]]:
+        clauses: List[str] = []
+        params: List[Any] = []
+        if spec_version is not None:
+            clauses.append("spec_version = ?")
+            params.append(spec_version)
+        if model is not None:
+            clauses.append("model = ?")
+            params.append(model)
+        clauses.extend(extra)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def _query(self, sql: str, params: Sequence[Any]) -> List[Tuple[Any, ...]]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def count(self, spec_version: Optional[str] = None, model: Optional[str] = None) -> int:
+        where, params = self._where(spec_version, model)
+        return self._query(f"SELECT COUNT(*) FROM results{where}", params)[0][0]
+
+    def accuracy(self, spec_version: Optional[str] = None, model: Optional[str] = None) -> Dict[str, Any]:
+        """想定判定が付いた結果のみを対象とした正解率（判定不能・期限切れは除く）"""
+        where, params = self._where(spec_version, model, ["expected IS NOT NULL", "fallback = 0"])
+        total, correct = self._query(
+            f"SELECT COUNT(*), COALESCE(SUM(verdict = expected), 0) FROM results{where}", params
+        )[0]
+        return {"total": total, "correct": correct, "accuracy": (correct / total) if total else None}
+
+    def confusion_matrix(self, spec_version: Optional[str] = None, model: Optional[str] = None) -> Dict[str, Dict[str, int]]:
+        """{想定判定: {AI判定: 件数}}（判定不能・期限切れは除く）"""
+        where, params = self._where(spec_version, model, ["expected IS NOT NULL", "fallback = 0"])
+        matrix: Dict[str, Dict[str, int]] = {}
+        for expected, verdict, n in self._query(
+            f"SELECT expected, verdict, COUNT(*) FROM results{where} GROUP BY expected, verdict", params
+        ):
+            matrix.setdefault(expected, {})[verdict] = n
+        return matrix
+
+    def latency_percentiles(
+        self,
+        spec_version: Optional[str] = None,
+        model: Optional[str] = None,
+        percentiles: Sequence[float] = (50, 90, 95, 99),
+    ) -> Dict[float, Optional[float]]:
+        """レイテンシの分位点（ms）。latency_ms インデックスを OFFSET で辿るため全件を読み込まない（判定不能・期限切れは除く）"""
+        where, params = self._where(spec_version, model, ["latency_ms IS NOT NULL", "fallback = 0"])
+        n = self._query(f"SELECT COUNT(*) FROM results{where}", params)[0][0]
+        out: Dict[float, Optional[float]] = {}
+        for p in percentiles:
+            if not n:
+                out[p] = None
+                continue
+            # nearest-rank 法
+            rank = max(1, min(n, int(-(-p * n // 100))))
+            row = self._query(
+                f"SELECT latency_ms FROM results{where} ORDER BY latency_ms LIMIT 1 OFFSET ?", params + [rank - 1]
+            )
+            out[p] = row[0][0] if row else None
+        return out
+
+    def completion_tokens(self, spec_version: Optional[str] = None, model: Optional[str] = None, limit: int = 500) -> List[int]:
+        """直近の出力トークン数（max_tokens の自動設定に使う）"""
+        where, params = self._where(spec_version, model, ["completion_tokens IS NOT NULL"])
+        rows = self._query(f"SELECT completion_tokens FROM results{where} ORDER BY id DESC LIMIT ?", params + [limit])
+        return [row[0] for row in rows]
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """仕様バージョン × モデルごとの件数・判定不能（ERROR・期限切れ）の件数・正解率・平均レイテンシ・平均トークン数
+
+        正解率と平均レイテンシは判定不能の結果を除いて求める。
+        """
+        rows = self._query(
+            "SELECT spec_version, model, COUNT(*), COALESCE(SUM(expected IS NOT NULL AND fallback = 0), 0),"
+            " COALESCE(SUM(verdict = expected AND fallback = 0), 0), COALESCE(SUM(fallback), 0),"
+            " AVG(CASE WHEN fallback = 0 THEN latency_ms END), AVG(total_tokens), MAX(ts)"
+            " FROM results GROUP BY spec_version, model ORDER BY MAX(ts) DESC",
+            [],
+        )
+        return [
+            {
+                "spec_version": spec_version,
+                "model": model,
+                "count": count,
+                "labeled": labeled or 0,
+                "accuracy": (correct / labeled) if labeled else None,
+                "errors": errors,
+                "mean_latency_ms": mean_latency,
+                "mean_tokens": mean_tokens,
+                "last_ts": last_ts,
+            }
+            for spec_version, model, count, labeled, correct, errors, mean_latency, mean_tokens, last_ts in rows
+        ]
+
+    def recent(self, limit: int = 20, spec_version: Optional[str] = None) -> List[Dict[str, Any]]:
+        where, params = self._where(spec_version, None)
+        rows = self._query(
+            f"SELECT ts, source, image_hash, spec_version, model, verdict, expected, latency_ms, total_tokens"
+            f" FROM results{where} ORDER BY id DESC LIMIT ?",
+            params + [limit],
+        )
+        keys = ["ts", "source", "image_hash", "spec_version", "model", "verdict", "expected", "latency_ms", "total_tokens"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,232 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Dict, Any, List, Optional
+
+
+@dataclass
+class PriorityClass:
+    name: str
+    weight: float = 1.0               # 重み付き公平キューイングの重み（大きいほど多く順番が回る）
+    rate_share: float = 0.0           # 全体のレート上限のうちこのクラスに保証する割合
+    slo_ms: Optional[float] = None    # 待ち時間＋応答時間の目標（SLO 達成率の集計用）
+    strict: bool = False              # True なら待機中の他クラスより先に流す（保証分のレートが残っているクラスは追い越さない）
+
+
+DEFAULT_CLASSES = [
+    PriorityClass("interactive", weight=8.0, rate_share=0.5, slo_ms=5_000, strict=True),
+    PriorityClass("line", weight=4.0, rate_share=0.3, slo_ms=15_000),
+    PriorityClass("bulk", weight=1.0, rate_share=0.2),
+]
+
+
+class _Ticket:
+    __slots__ = ("cls", "finish_tag", "enqueued_at", "granted")
+
+    def __init__(self, cls: str, finish_tag: float) -> None:
+        self.cls = cls
+        self.finish_tag = finish_tag
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+
+
+class _Bucket:
+    """トークンバケット（rate 件/秒、容量は1秒分・最低1件）"""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self) -> bool:
+        return self.tokens >= 1.0
+
+    def wait_s(self) -> float:
+        return max(0.0, (1.0 - self.tokens) / self.rate) if self.rate > 0 else float("inf")
+
+
+class Scheduler:
+    """優先度クラスごとのキューから、同時実行数とレート上限の範囲で呼び出しを流すスケジューラ
+
+    strict なクラス（既定では interactive）は待機中の他クラスより先に流し、それ以外は重み付き公平キューイング
+    （自己クロック方式の仮想終了時刻が小さいものから）で順番を決める。レート上限は各クラスの rate_share を保証し
+    （保証分が残っているクラスは strict なクラスにも追い越されない）、他のクラスに待ちがなければ保証分を超えて使える。
+    実行中の呼び出しは中断しない（追い越すのはキューの中だけ）。
+    """
+
+    def __init__(self, max_concurrency: int = 8, rate_per_s: Optional[float] = None, classes: Optional[List[PriorityClass]] = None, window: int = 500) -> None:
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate_per_s = rate_per_s
+        self.classes = {cls.name: cls for cls in (classes or DEFAULT_CLASSES)}
+        self._cond = threading.Condition()
+        self._queues: Dict[str, deque] = {name: deque() for name in self.classes}
+        self._last_finish = {name: 0.0 for name in self.classes}
+        self._virtual_time = 0.0
+        self._running = 0
+        self._in_flight = {name: 0 for name in self.classes}
+        self._global_bucket = _Bucket(rate_per_s) if rate_per_s else None
+        self._buckets = {
+            name: _Bucket(rate_per_s * cls.rate_share) for name, cls in self.classes.items() if rate_per_s and cls.rate_share > 0
+        }
+        self._waits: Dict[str, deque] = {name: deque(maxlen=window) for name in self.classes}
+        self._latencies: Dict[str, deque] = {name: deque(maxlen=window) for name in self.classes}
+        self._completed = {name: 0 for name in self.classes}
+
+    # --- 実行 -------------------------------------------------------------
+
+    def run(self, priority: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """順番が来るまで待ってから呼び出し元のスレッドで fn を実行する"""
+        if priority not in self.classes:
+            raise ValueError(f"未定義の優先度クラスです: {priority}")
+        with self._cond:
+            start = max(self._virtual_time, self._last_finish[priority])
+            ticket = _Ticket(priority, start + 1.0 / self.classes[priority].weight)
+            self._last_finish[priority] = ticket.finish_tag
+            self._queues[priority].append(ticket)
+            while True:
+                timeout = self._dispatch_locked()
+                if ticket.granted:
+                    break
+                self._cond.wait(timeout)
+        granted_at = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            finished_at = time.monotonic()
+            with self._cond:
+                self._running -= 1
+                self._in_flight[priority] -= 1
+                self._completed[priority] += 1
+                self._waits[priority].append((granted_at - ticket.enqueued_at) * 1000.0)
+                self._latencies[priority].append((finished_at - ticket.enqueued_at) * 1000.0)
+                self._cond.notify_all()
+
+    def _dispatch_locked(self) -> Optional[float]:
+        """空き枠とレートの範囲で順番を与える。レート待ちなら次に空くまでの秒数を返す"""
+        granted_any = False
+        wait_s: Optional[float] = None
+        while self._running < self.max_concurrency:
+            now = time.monotonic()
+            if self._global_bucket is not None:
+                self._global_bucket.refill(now)
+                if not self._global_bucket.ready():
+                    wait_s = self._global_bucket.wait_s()
+                    break
+            for bucket in self._buckets.values():
+                bucket.refill(now)
+            name = self._pick_locked()
+            if name is None:
+                break
+            ticket = self._queues[name].popleft()
+            ticket.granted = True
+            granted_any = True
+            self._virtual_time = max(self._virtual_time, ticket.finish_tag)
+            self._running += 1
+            self._in_flight[name] += 1
+            if self._global_bucket is not None:
+                self._global_bucket.tokens -= 1.0
+            if name in self._buckets:
+                self._buckets[name].tokens -= 1.0
+        if granted_any:
+            self._cond.notify_all()
+        return wait_s
+
+    def _eligible(self, name: str, waiting: List[str]) -> bool:
+        # 保証分のレートが残っているか、他に待っているクラスがなければ流せる
+        bucket = self._buckets.get(name)
+        if bucket is None or bucket.ready():
+            return True
+        return all(other == name for other in waiting)
+
+    def _pick_locked(self) -> Optional[str]:
+        waiting = [name for name, queue in self._queues.items() if queue]
+        # どのクラスも保証分を使い切っている場合は全体の枠の範囲で公平に流す
+        eligible = [name for name in waiting if self._eligible(name, waiting)] or waiting
+        strict = [name for name in eligible if self.classes[name].strict]
+        # strict なクラスが待っていても、保証分のレートが残っているクラスは追い越されない（rate_share を保証する）
+        guaranteed = [
+            name for name in eligible
+            if not self.classes[name].strict and name in self._buckets and self._buckets[name].ready()
+        ]
+        candidates = strict + guaranteed if strict else eligible
+        if not candidates:
+            return None
+        return min(candidates, key=lambda name: self._queues[name][0].finish_tag)
+
+    # --- 参照 -------------------------------------------------------------
+
+    def report(self) -> List[Dict[str, Any]]:
+        """クラスごとの待ち件数・実行中・完了数・待ち時間と応答時間の分位点・SLO 達成率"""
+
+        def percentile(samples: List[float], q: float) -> Optional[float]:
+            if not samples:
+                return None
+            return round(samples[min(len(samples) - 1, int(len(samples) * q / 100.0))], 1)
+
+        rows = []
+        with self._cond:
+            for name, cls in self.classes.items():
+                waits = sorted(self._waits[name])
+                latencies = sorted(self._latencies[name])
+                slo_met = None
+                if cls.slo_ms is not None and latencies:
+                    slo_met = sum(1 for latency in latencies if latency <= cls.slo_ms) / len(latencies)
+                rows.append(
+                    {
+                        "class": name,
+                        "queued": len(self._queues[name]),
+                        "in_flight": self._in_flight[name],
+                        "completed": self._completed[name],
+                        "wait_p50_ms": percentile(waits, 50),
+                        "wait_p95_ms": percentile(waits, 95),
+                        "latency_p95_ms": percentile(latencies, 95),
+                        "slo_ms": cls.slo_ms,
+                        "slo_met": slo_met,
+                    }
+                )
+        return rows
+
+
+class ScheduledProvider:
+    """Scheduler を通してプロバイダを呼ぶラッパー。run_vision_eval にそのまま渡せる
+
+    同じ Scheduler を共有する複数のラッパーを `with_priority` で作り分ければ、
+    1つの APIキー・同時実行枠を対話的な判定と一括処理で分け合える。
+    内側のプロバイダが `admission()`（予算の確保など、待つ可能性のある前処理）を持つ場合は、枠を取る前に済ませる。
+    """
+
+    def __init__(self, provider: Any, scheduler: Scheduler, priority: str = "bulk") -> None:
+        if priority not in scheduler.classes:
+            raise ValueError(f"未定義の優先度クラスです: {priority}")
+        self.provider = provider
+        self.scheduler = scheduler
+        self.priority = priority
+
+    def __getattr__(self, name: str) -> Any:
+        # provider_name / model / temperature / pil_to_datauri などは元のプロバイダに委譲する（非同期API はスケジューラを通らないため委譲しない）
+        if name in {"provider", "scheduler", "priority"} or name.startswith("achat_"):
+            raise AttributeError(name)
+        return getattr(self.provider, name)
+
+    def with_priority(self, priority: str) -> "ScheduledProvider":
+        return ScheduledProvider(self.provider, self.scheduler, priority)
+
+    def _run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        admission = getattr(self.provider, "admission", None)
+        if admission is None:
+            return self.scheduler.run(self.priority, fn, *args, **kwargs)
+        # 一時停止中の予算などを待つ間に同時実行枠を塞がない
+        with admission():
+            return self.scheduler.run(self.priority, fn, *args, **kwargs)
+
+    def chat_vision(self, messages: List[Dict[str, Any]], **kwargs: Any) -> Dict[str, Any]:
+        return self._run(self.provider.chat_vision, messages, **kwargs)
+
+    def chat_text(self, system_prompt: str, user_prompt: str) -> str:
+        return self._run(self.provider.chat_text, system_prompt, user_prompt)
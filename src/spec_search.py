@@ -0,0 +1,284 @@
+import copy
+import json
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Tuple
+
+from PIL import Image
+
+from .eval_cache import VerdictCache, image_digest
+from .llm_providers import LLMProvider
+from .pipeline import Pipeline, batch_pipeline
+from .prompt_factory import split_spec_checks
+from .verdict_schema import first_json_object
+from .vision_eval import run_vision_eval
+
+
+CANDIDATE_SYSTEM_PROMPT = """あなたは製造業の外観検査プロンプトを改善する専門家です。
+与えられた検査仕様と判定結果をもとに、互いに異なる方針で書き直した検査仕様の候補を作成します。
+応答はJSONのみで出力してください。JSONスキーマ: {"candidates": ["検査仕様の文章", ...]}。"""
+
+
+@dataclass
+class CandidateScore:
+    spec_text: str
+    bundle: Dict[str, Any]
+    total: int
+    correct: int = 0
+    evaluated: int = 0
+    cache_hits: int = 0
+    tokens: int = 0
+    latencies_ms: List[float] = field(default_factory=list)
+    decisions: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+
+    @property
+    def accuracy(self) -> float:
+        # 未評価のサンプルは不正解として扱う（途中打ち切りの候補が過大評価されないように）
+        return self.correct / self.total if self.total else 0.0
+
+    @property
+    def complete(self) -> bool:
+        return self.evaluated >= self.total
+
+    @property
+    def mean_latency_ms(self) -> float:
+        return sum(self.latencies_ms) / len(self.latencies_ms) if self.latencies_ms else 0.0
+
+    @property
+    def mean_tokens(self) -> float:
+        return self.tokens / self.evaluated if self.evaluated else 0.0
+
+    def best_possible(self) -> float:
+        return (self.correct + self.total - self.evaluated) / self.total if self.total else 0.0
+
+
+@dataclass
+class SpecSearchResult:
+    candidates: List[CandidateScore]
+    api_calls: int
+    cache_hits: int
+    stopped_reason: str  # "perfect" | "budget" | "exhausted"
+
+    @property
+    def best(self) -> CandidateScore:
+        return self.candidates[0]
+
+    @property
+    def best_bundle(self) -> Dict[str, Any]:
+        """そのまま generate_runtime_app に渡せるプロンプトバンドル"""
+        return self.best.bundle
+
+
+def _rank_key(score: CandidateScore) -> Tuple[float, float, float]:
+    return (-score.accuracy, score.mean_latency_ms, score.mean_tokens)
+
+
+def _parse_candidates(text: str) -> List[str]:
+    try:
+        payload = json.loads(text)
+    except json.JSONDecodeError:
+        # 前置き・後書きや複数のJSONが混ざっても最初のオブジェクトだけを取り出す
+        obj = first_json_object(text)
+        payload = None
+        if obj:
+            try:
+                payload = json.loads(obj)
+            except json.JSONDecodeError:
+                payload = None
+    if isinstance(payload, dict) and isinstance(payload.get("candidates"), list):
+        return [str(item).strip() for item in payload["candidates"] if str(item).strip()]
+    # JSONで返らなかった場合は区切り線・空行で分割して扱う
+    chunks = re.split(r"\n\s*(?:---+|\n)\s*", text)
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+def candidate_bundle(bundle: Dict[str, Any], spec_text: str) -> Dict[str, Any]:
+    """現在のバンドルの検査仕様だけを差し替えたコピー（前処理・出力モード・送信画像・max_tokens などはそのまま）
+
+    検査項目ごとの並列判定（checks）は仕様から作り直す（2件未満になれば1回の判定に戻す）。
+    """
+    updated = copy.deepcopy(bundle)
+    if updated["user"]["spec_text"] == spec_text:
+        return updated
+    updated["user"]["spec_text"] = spec_text
+    if "checks" in updated:
+        checks = split_spec_checks(spec_text)
+        if len(checks) >= 2:
+            updated["checks"] = [{"id": f"C{i}", "text": text} for i, text in enumerate(checks, 1)]
+        else:
+            updated.pop("checks", None)
+            updated.pop("check_system", None)
+    return updated
+
+
+def generate_candidate_specs(
+    provider: LLMProvider,
+    spec_text: str,
+    feedback: List[Dict[str, Any]],
+    n_candidates: int,
+) -> List[str]:
+    """chat_text で仕様の候補を n_candidates 件生成する（元の仕様は含まない）"""
+    if n_candidates <= 0:
+        return []
+    lines = []
+    for item in feedback:
+        decision = item.get("decision", {})
+        details = str(decision.get("details", "-")).replace("\n", " ")[:200]
+        lines.append(
+            f"- {item['image']}: 想定 {item['expected']} / AI {decision.get('verdict', 'UNKNOWN')} / {details}"
+        )
+    feedback_text = "\n".join(lines) or "- （判定結果なし）"
+    user_prompt = f"""
+現在の検査仕様:
+{spec_text}
+
+ラベル付きサンプルの判定結果:
+{feedback_text}
+
+すべてのサンプルが想定どおりに判定されることを目標に、検査仕様の候補を{n_candidates}件作成してください。
+各候補はそのまま別のアプリに貼り付けられる完成形の日本語の文章にしてください。
+"""
+    text = provider.chat_text(CANDIDATE_SYSTEM_PROMPT, user_prompt)
+    seen = {spec_text.strip()}
+    candidates: List[str] = []
+    for candidate in _parse_candidates(text):
+        if candidate not in seen:
+            seen.add(candidate)
+            candidates.append(candidate)
+    return candidates[:n_candidates]
+
+
+def search_specs(
+    provider: LLMProvider,
+    bundle: Dict[str, Any],
+    samples: List[Tuple[str, Image.Image]],
+    expected: Dict[str, str],
+    n_candidates: int = 4,
+    max_calls: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    max_workers: int = 4,
+    cache: Optional[VerdictCache] = None,
+    feedback: Optional[List[Dict[str, Any]]] = None,
+    cpu_workers: int = 0,
+    cpu_kind: str = "process",
+) -> SpecSearchResult:
+    """仕様候補 × ラベル付きサンプルを並列評価し、精度・レイテンシ・トークン数で順位付けする
+
+    候補は現在のバンドル（bundle）の検査仕様だけを差し替えたもの（candidate_bundle）。元の仕様は bundle のまま評価するため、
+    ボタンBなどで同じバンドルを判定済みならキャッシュを使う。
+    既に評価済みの (仕様, 画像) はキャッシュを再利用し、API を呼ばない。
+    いずれかの候補が全サンプル正解になるか、呼び出し回数/トークン数の予算を使い切った時点で打ち切る。
+    cpu_workers が1以上なら、画像の前処理・エンコードを batch_pipeline の前処理ステージ（既定はプロセスプール）で行う。
+    """
+    labeled = [(name, img) for name, img in samples if expected.get(name) in {"OK", "NG"}]
+    if not labeled:
+        raise ValueError("想定判定(OK/NG)が設定されたサンプルがありません。")
+    cache = cache if cache is not None else VerdictCache()
+
+    spec_text = bundle["user"]["spec_text"]
+    specs = [spec_text] + generate_candidate_specs(provider, spec_text, feedback or [], n_candidates)
+    scores = [
+        CandidateScore(spec_text=spec, bundle=candidate_bundle(bundle, spec), total=len(labeled))
+        for spec in specs
+    ]
+    hashes = {name: image_digest(img) for name, img in labeled}
+    # 候補ごとにまとめて評価し、早い段階で全問正解の候補を見つけられるようにする
+    pending = deque((ci, name, img) for ci in range(len(scores)) for name, img in labeled)
+
+    api_calls = 0
+    tokens_used = 0
+    cache_hits = 0
+    stopped_reason = "exhausted"
+
+    def record(ci: int, name: str, decision: Dict[str, Any], from_cache: bool) -> None:
+        nonlocal tokens_used
+        score = scores[ci]
+        score.evaluated += 1
+        score.decisions[name] = decision
+        if str(decision.get("verdict", "")).upper() == expected[name]:
+            score.correct += 1
+        if "latency_ms" in decision:
+            score.latencies_ms.append(float(decision["latency_ms"]))
+        used = int(decision.get("usage", {}).get("total_tokens") or 0)
+        score.tokens += used
+        if from_cache:
+            score.cache_hits += 1
+        else:
+            tokens_used += used
+
+    def failed(exc: BaseException) -> Dict[str, Any]:
+        return {"verdict": "ERROR", "details": str(exc), "checks": []}
+
+    def evaluate(ci: int, img: Image.Image) -> Dict[str, Any]:
+        try:
+            return run_vision_eval(provider, scores[ci].bundle, img)
+        except Exception as exc:
+            return failed(exc)
+
+    def over_budget() -> bool:
+        if max_calls is not None and api_calls >= max_calls:
+            return True
+        return max_tokens is not None and tokens_used >= max_tokens
+
+    def best_complete_accuracy() -> float:
+        return max((s.accuracy for s in scores if s.complete), default=0.0)
+
+    def found_perfect() -> bool:
+        return best_complete_accuracy() >= 1.0
+
+    pipeline: Optional[Pipeline] = None
+    executor: Optional[ThreadPoolExecutor] = None
+    if cpu_workers > 0:
+        pipeline = batch_pipeline(provider, cpu_workers=cpu_workers, net_workers=max_workers, queue_size=max_workers, cpu_kind=cpu_kind)
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    in_flight: Dict[Any, Tuple[int, str]] = {}
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_workers and not found_perfect():
+                ci, name, img = pending[0]
+                # 残りを全問正解しても既存の最良候補に届かない候補は評価しない
+                if scores[ci].best_possible() < best_complete_accuracy():
+                    pending.popleft()
+                    continue
+                key = cache.key_for(provider, scores[ci].bundle, hashes[name])
+                cached = cache.get(key)
+                if cached is not None:
+                    pending.popleft()
+                    cache_hits += 1
+                    record(ci, name, cached, from_cache=True)
+                    continue
+                if over_budget():
+                    break
+                pending.popleft()
+                api_calls += 1
+                if pipeline is not None:
+                    in_flight[pipeline.submit((scores[ci].bundle, img))] = (ci, name)
+                else:
+                    in_flight[executor.submit(evaluate, ci, img)] = (ci, name)  # type: ignore[union-attr]
+            if found_perfect():
+                stopped_reason = "perfect"
+                break
+            if not in_flight:
+                if pending:
+                    stopped_reason = "budget"
+                break
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in done:
+                ci, name = in_flight.pop(future)
+                decision = failed(future.exception()) if future.exception() is not None else future.result()
+                cache.put(cache.key_for(provider, scores[ci].bundle, hashes[name]), decision)
+                record(ci, name, decision, from_cache=False)
+        if stopped_reason == "exhausted" and found_perfect():
+            stopped_reason = "perfect"
+    finally:
+        # 打ち切り時は未完了の呼び出しを待たずに戻る
+        if pipeline is not None:
+            pipeline.close(drain=False, timeout=0)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    ranked = sorted(scores, key=_rank_key)
+    return SpecSearchResult(candidates=ranked, api_calls=api_calls, cache_hits=cache_hits, stopped_reason=stopped_reason)
@@ -0,0 +1,102 @@
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+
+from PIL import Image
+
+from .eval_cache import CacheKey, VerdictCache, bundle_digest, image_digest
+from .eval_jobs import EvalJob, JobCancelled, cancellable_provider
+from .prompt_factory import attach_few_shots
+from .vision_eval import run_vision_eval
+
+
+SKIPPED_MESSAGE = "予算の上限が近いため先回り判定を見送りました。"
+
+
+class SpeculationSkipped(RuntimeError):
+    """予算の都合で先回り判定を見送ったときに送出する（項目は error になり、余裕が戻れば再試行する）"""
+
+
+def context_key(provider: Any, bundle: Dict[str, Any]) -> Tuple[str, ...]:
+    """判定結果を左右する仕様とモデル設定の組（VerdictCache のキーから画像を除いたもの）"""
+    key = VerdictCache.key_for(provider, bundle, "")
+    return key[:1] + key[2:]
+
+
+class SpeculativeRunner:
+    """プロンプトバンドルができた時点でサンプルを先回りして判定し、結果を VerdictCache に入れておく
+
+    結果はキャッシュのキー（仕様・画像・モデル設定）で引くため、仕様やモデル設定が変わった古い結果が使われることはない。
+    `sync()` のたびに仕様・モデル設定・サンプルを比べ、変わっていれば実行中の先回り判定を取り消して新しい内容でやり直す。
+    予算を管理している場合は、節約モードに入った（上限が近い）時点で先回り判定を見送り、本番の判定に予算を残す。
+    """
+
+    def __init__(self, cache: VerdictCache, max_workers: int = 2) -> None:
+        self.cache = cache
+        self.max_workers = max(1, max_workers)
+        self.job: Optional[EvalJob] = None
+        self._context: Optional[Tuple[Any, ...]] = None
+
+    def sync(
+        self,
+        provider: Any,
+        bundle: Dict[str, Any],
+        samples: List[Tuple[str, Image.Image]],
+        governor: Any = None,
+        fewshot_store: Any = None,
+        fewshot_k: int = 3,
+    ) -> None:
+        """現在の仕様・モデル設定・サンプルに合わせて先回り判定を始める（同じ内容なら見送った項目の再試行だけ行う）
+
+        fewshot_store を渡すと、本番の判定と同じく画像ごとに似た例を添付したバンドルで判定する。
+        """
+        hashes = {name: image_digest(img) for name, img in samples}
+        bundles = {
+            name: attach_few_shots(bundle, fewshot_store, img, k=fewshot_k, image_hash=hashes[name]) if fewshot_store is not None else bundle
+            for name, img in samples
+        }
+        # 添付される例が変わった（ラベル付きの例が増えた）場合もやり直す
+        context = (
+            context_key(provider, bundle),
+            tuple(sorted((name, hashes[name], bundle_digest(bundles[name])) for name in hashes)),
+        )
+        if context == self._context and self.job is not None:
+            if governor is None or not governor.degraded:
+                for item in self.job.snapshot():
+                    if item.status == "error" and item.error == SKIPPED_MESSAGE:
+                        self.job.retry(item.name)
+            return
+        self.cancel()
+        self._context = context
+
+        def keyed(name: str) -> CacheKey:
+            return self.cache.key_for(provider, bundles[name], hashes[name])
+
+        def task(name: str, img: Image.Image, expected: Optional[str], cancel_event: threading.Event) -> Dict[str, Any]:
+            cached = self.cache.peek(keyed(name))
+            if cached is not None:
+                return cached
+            if governor is not None and governor.degraded:
+                raise SpeculationSkipped(SKIPPED_MESSAGE)
+            # 取り消された先回り判定は、スケジューラの順番が来た時点で API を呼ばずに打ち切る
+            decision = run_vision_eval(cancellable_provider(provider, cancel_event), bundles[name], img)
+            if cancel_event.is_set():
+                raise JobCancelled("取り消されました。")
+            self.cache.put(keyed(name), decision)
+            return decision
+
+        pending = [(name, img) for name, img in samples if self.cache.peek(keyed(name)) is None]
+        self.job = EvalJob(task, pending, {}, max_workers=self.max_workers).start()
+
+    def cancel(self) -> None:
+        if self.job is not None:
+            self.job.cancel_all()
+        self.job = None
+        self._context = None
+
+    def status(self) -> Dict[str, int]:
+        """先回り判定の件数（queued / running / done / error / cancelled）"""
+        counts = {"queued": 0, "running": 0, "done": 0, "error": 0, "cancelled": 0}
+        if self.job is not None:
+            for item in self.job.snapshot():
+                counts[item.status] += 1
+        return counts
@@ -0,0 +1,35 @@
+import math
+from typing import Dict, Any, Optional, Sequence
+
+
+def suggest_max_tokens(
+    completion_tokens: Sequence[int],
+    quantile: float = 99.0,
+    margin: float = 0.3,
+    min_samples: int = 10,
+    floor: int = 64,
+    cap: int = 16384,
+) -> Optional[int]:
+    """観測した出力トークン数の分位点に安全マージンを足した max_tokens（実績が少なければ None）
+
+    打ち切られた場合は run_vision_eval が上限を倍にして再実行するため、ここでは分布の裾だけを見ればよい。
+    """
+    samples = sorted(int(n) for n in completion_tokens if n)
+    if len(samples) < min_samples:
+        return None
+    # nearest-rank 法
+    rank = max(1, min(len(samples), math.ceil(quantile / 100.0 * len(samples))))
+    budget = math.ceil(samples[rank - 1] * (1.0 + margin))
+    # 64 単位に切り上げて、実績の揺れで値が毎回変わらないようにする
+    budget = int(math.ceil(budget / 64.0) * 64)
+    return max(floor, min(cap, budget))
+
+
+def apply_token_budget(bundle: Dict[str, Any], completion_tokens: Sequence[int], **kwargs: Any) -> Optional[int]:
+    """バンドルに仕様ごとの max_tokens を書き込み、設定した値を返す（実績不足なら既存の値を外す）"""
+    budget = suggest_max_tokens(completion_tokens, **kwargs)
+    if budget is None:
+        bundle.pop("max_tokens", None)
+    else:
+        bundle["max_tokens"] = budget
+    return budget
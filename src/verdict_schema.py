@@ -0,0 +1,168 @@
+import json
+import re
+import threading
+from typing import Dict, Any, List, Literal, Optional, Tuple
+
+from pydantic import BaseModel, ConfigDict, ValidationError
+
+
+class Check(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    result: Literal["OK", "NG"]
+    reason: str
+
+
+# モデルに返させる判定JSON。プロバイダの構造化出力スキーマもここから生成する
+# （docstring はスキーマの description としてモデルに送られるため付けない）
+class Verdict(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    verdict: Literal["OK", "NG"]
+    details: str
+    checks: List[Check]
+
+
+# ライン（短縮）モードの判定。v=判定コード、r=NGの場合のみ短い理由（OKなら空文字）
+class LineVerdict(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    v: Literal["OK", "NG"]
+    r: str
+
+
+SCHEMAS = {"verdict": Verdict, "line": LineVerdict}
+
+
+CORRECTION_PROMPT = "直前の応答は指定のJSONスキーマに合致しませんでした（{error}）。説明文を付けず、スキーマに合致するJSONだけを出力し直してください。"
+
+
+class ParseStats:
+    """構造化出力の検証結果の件数（そのまま通った / 修復した / 再問い合わせした / 失敗した）"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counts = {"parsed": 0, "repaired": 0, "retried": 0, "failed": 0}
+
+    def add(self, key: str) -> None:
+        with self._lock:
+            self._counts[key] += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+
+PARSE_STATS = ParseStats()
+
+
+def _inline_refs(schema: Any, defs: Dict[str, Any]) -> Any:
+    if isinstance(schema, dict):
+        if "$ref" in schema:
+            return _inline_refs(defs[schema["$ref"].rsplit("/", 1)[-1]], defs)
+        return {key: _inline_refs(value, defs) for key, value in schema.items() if key != "$defs"}
+    if isinstance(schema, list):
+        return [_inline_refs(item, defs) for item in schema]
+    return schema
+
+
+def _drop_keys(schema: Any, keys: set) -> Any:
+    if isinstance(schema, dict):
+        return {key: _drop_keys(value, keys) for key, value in schema.items() if key not in keys}
+    if isinstance(schema, list):
+        return [_drop_keys(item, keys) for item in schema]
+    return schema
+
+
+def openai_json_schema(model: type = Verdict) -> Dict[str, Any]:
+    """OpenAI の response_format={"type": "json_schema", ...} に渡す定義（strict）"""
+    schema = model.model_json_schema()
+    return {"name": model.__name__.lower(), "strict": True, "schema": _inline_refs(schema, schema.get("$defs", {}))}
+
+
+def gemini_response_schema(model: type = Verdict) -> Dict[str, Any]:
+    """Gemini の generationConfig.responseSchema に渡す定義（OpenAPI のサブセットのため $ref・title 等を除く）"""
+    schema = model.model_json_schema()
+    inlined = _inline_refs(schema, schema.get("$defs", {}))
+    return _drop_keys(inlined, {"title", "additionalProperties", "const"})
+
+
+def first_json_object(text: str) -> Optional[str]:
+    """テキスト中で最初に括弧の対応が取れる JSON オブジェクトの部分文字列（なければ None）
+
+    貪欲な正規表現ではなく、文字列リテラルを考慮して括弧の対応を取る（前置き・後書きや複数のオブジェクトが混ざっても切り出せる）。
+    """
+    start = text.find("{")
+    while start != -1:
+        depth = 0
+        in_string = False
+        escaped = False
+        for i in range(start, len(text)):
+            ch = text[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+                if depth == 0:
+                    return text[start:i + 1]
+        start = text.find("{", start + 1)
+    return None
+
+
+def _normalize(payload: Dict[str, Any], model: type) -> Dict[str, Any]:
+    # 大文字小文字の揺れ・欠けた任意項目・余分なキーを吸収する
+    fields = set(model.model_fields)
+    data = {key: value for key, value in payload.items() if key in fields}
+    for key in ("verdict", "v"):
+        if isinstance(data.get(key), str):
+            data[key] = data[key].strip().upper()
+    for key in ("details", "r"):
+        if key in fields and data.get(key) is None:
+            data[key] = ""
+    if "checks" in fields:
+        checks = data.get("checks") or []
+        data["checks"] = [
+            {
+                "result": str(check.get("result", "")).strip().upper(),
+                "reason": str(check.get("reason", "")),
+            }
+            for check in checks
+            if isinstance(check, dict)
+        ]
+    return data
+
+
+def parse_verdict(text: str, model: type = Verdict) -> Tuple[Optional[Dict[str, Any]], str]:
+    """応答テキストを検証し、(判定dict, エラー内容) を返す。修復できなければ判定は None"""
+    if not text:
+        return None, "空の応答"
+    try:
+        parsed = model.model_validate_json(text).model_dump()
+        PARSE_STATS.add("parsed")
+        return parsed, ""
+    except ValidationError as exc:
+        error = exc.errors()[0].get("msg", str(exc)) if exc.errors() else str(exc)
+    candidate = re.sub(r"^```(?:json)?\s*|\s*```$", "", text.strip())
+    candidate = first_json_object(candidate) or candidate
+    candidate = re.sub(r",\s*([}\]])", r"\1", candidate)
+    try:
+        payload = json.loads(candidate)
+    except json.JSONDecodeError as exc:
+        return None, f"JSONとして解釈できません: {exc.msg}"
+    if not isinstance(payload, dict):
+        return None, "JSONオブジェクトではありません"
+    try:
+        parsed = model.model_validate(_normalize(payload, model)).model_dump()
+    except ValidationError as exc:
+        return None, "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in exc.errors()[:3]) or error
+    PARSE_STATS.add("repaired")
+    return parsed, ""
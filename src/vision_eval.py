@@ -1,27 +1,296 @@
+import io
 import json
-from typing import Dict, Any
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Any, List, Optional, Tuple
 from PIL import Image
 from .llm_providers import LLMProvider
 
-def run_vision_eval(provider: LLMProvider, prompt_bundle: Dict[str, Any], img: Image.Image) -> Dict[str, Any]:
-    """画像全体を評価対象としてVLMに判定を依頼する"""
-    system = prompt_bundle["system"]
+# finish_reason == "length" で判定が読めなかったときに max_tokens を倍にして再実行する上限
+MAX_TOKENS_CAP = 16384
+MAX_TOKEN_ESCALATIONS = 2
+# 検査項目ごとの判定の同時呼び出し数
+MAX_CHECK_WORKERS = 6
+# ラッパー（予算管理など）が応答に付ける、実際に応答したモデル・節約モード・送信サイズ
+ANSWER_STAMPS = ("model", "degraded", "image_size")
+
+_BACKGROUNDS: Dict[str, Any] = {}
+
+
+def learn_background(images: List[Image.Image]) -> Image.Image:
+    """部品が写っていないコンベア画像（複数可）の画素ごとの中央値を背景として返す"""
+    import numpy as np
+
+    if not images:
+        raise ValueError("背景画像を1枚以上指定してください。")
+    size = images[0].size
+    stack = np.stack([np.asarray(img.convert("RGB").resize(size)) for img in images])
+    return Image.fromarray(np.median(stack, axis=0).astype(np.uint8))
+
+
+def _load_background(path: str) -> Image.Image:
+    # 背景を学習し直した場合に備えて更新時刻もキーに含める
+    key = f"{path}:{os.path.getmtime(path)}"
+    if key not in _BACKGROUNDS:
+        _BACKGROUNDS[key] = Image.open(path).convert("RGB")
+    return _BACKGROUNDS[key]
+
+
+def crop_to_part(
+    img: Image.Image,
+    method: str = "threshold",
+    background: Optional[Image.Image] = None,
+    margin: float = 0.05,
+    deskew: bool = False,
+    min_area_ratio: float = 0.005,
+) -> Tuple[Image.Image, Dict[str, Any]]:
+    """部品の領域を見つけて余白付きで切り出す（見つからなければ元画像のまま）
+
+    method="threshold" は大津の二値化（背景は画像の縁の明るさから推定）、"background" は学習した背景画像との差分で前景を求める。
+    deskew=True なら前景の最小外接矩形に沿って回転・透視補正する。
+    """
+    import cv2
+    import numpy as np
+
+    rgb = np.asarray(img.convert("RGB"))
+    height, width = rgb.shape[:2]
+    info: Dict[str, Any] = {"method": method, "original_size": {"width": width, "height": height}, "found": False}
+    gray = cv2.GaussianBlur(cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY), (5, 5), 0)
+    if method == "background":
+        if background is None:
+            raise ValueError("method='background' には背景画像が必要です。")
+        bg = np.asarray(background.convert("RGB").resize((width, height)))
+        diff = cv2.cvtColor(cv2.absdiff(rgb, bg), cv2.COLOR_RGB2GRAY)
+        _, mask = cv2.threshold(cv2.GaussianBlur(diff, (5, 5), 0), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    elif method == "threshold":
+        _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        border = np.concatenate([mask[0], mask[-1], mask[:, 0], mask[:, -1]])
+        if border.mean() > 127:
+            # 縁（= 背景）が白になった場合は反転して部品を白にする
+            mask = cv2.bitwise_not(mask)
+    else:
+        raise ValueError(f"未対応の切り出し方法です: {method}")
+    kernel = np.ones((5, 5), np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=2)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contours = [c for c in contours if cv2.contourArea(c) >= min_area_ratio * width * height]
+    if not contours:
+        return img, info
+    points = np.concatenate(contours)
+    pad = int(round(margin * max(width, height)))
+    info["found"] = True
+    if deskew:
+        (cx, cy), (rw, rh), angle = cv2.minAreaRect(points)
+        if rw < rh:
+            rw, rh, angle = rh, rw, angle + 90.0
+        out_w, out_h = int(round(rw)) + 2 * pad, int(round(rh)) + 2 * pad
+        src = cv2.boxPoints(((cx, cy), (out_w, out_h), angle)).astype(np.float32)
+        # boxPoints の並びを 左上・右上・右下・左下 に揃える
+        s_sum, s_diff = src.sum(axis=1), np.diff(src, axis=1).ravel()
+        ordered = np.array([src[np.argmin(s_sum)], src[np.argmin(s_diff)], src[np.argmax(s_sum)], src[np.argmax(s_diff)]], np.float32)
+        dst = np.array([[0, 0], [out_w - 1, 0], [out_w - 1, out_h - 1], [0, out_h - 1]], np.float32)
+        warped = cv2.warpPerspective(rgb, cv2.getPerspectiveTransform(ordered, dst), (out_w, out_h), borderMode=cv2.BORDER_REPLICATE)
+        info.update({"deskewed": True, "angle": round(float(angle), 2), "center": [round(float(cx), 1), round(float(cy), 1)]})
+        return Image.fromarray(warped), info
+    x, y, w, h = cv2.boundingRect(points)
+    x0, y0 = max(0, x - pad), max(0, y - pad)
+    x1, y1 = min(width, x + w + pad), min(height, y + h + pad)
+    info["box"] = [x0, y0, x1, y1]  # 元画像上の切り出し範囲 (左, 上, 右, 下)
+    return img.crop((x0, y0, x1, y1)), info
+
+
+def preprocess_image(img: Image.Image, options: Dict[str, Any]) -> Tuple[Image.Image, Dict[str, Any]]:
+    """バンドルの preprocess 設定（crop / margin / deskew / background_path）に従って切り出す"""
+    background = _load_background(options["background_path"]) if options.get("background_path") else None
+    return crop_to_part(
+        img,
+        method=options.get("crop", "background" if background is not None else "threshold"),
+        background=background,
+        margin=float(options.get("margin", 0.05)),
+        deskew=bool(options.get("deskew", False)),
+    )
+
+
+def _call_with_escalation(provider: LLMProvider, messages: List[Dict[str, Any]], options: Dict[str, Any], line_mode: bool) -> Tuple[Dict[str, Any], Dict[str, int], Optional[int]]:
+    """(応答, 合計usage, 引き上げた max_tokens) を返す"""
+    options = dict(options)
+    usage: Dict[str, int] = {}
+    escalations = 0
+    while True:
+        resp = provider.chat_vision(messages, **options)
+        for key, value in (resp.get("usage") or {}).items():
+            usage[key] = usage.get(key, 0) + int(value or 0)
+        answer = resp.get("json", {})
+        readable = str(answer.get("v" if line_mode else "verdict", "")).upper() in {"OK", "NG"}
+        current = int(options.get("max_tokens") or getattr(provider, "max_tokens", 0) or 0)
+        if readable or resp.get("finish_reason") != "length" or escalations >= MAX_TOKEN_ESCALATIONS or not 0 < current < MAX_TOKENS_CAP:
+            break
+        # 出力上限で打ち切られた場合は上限を引き上げて再実行する
+        options["max_tokens"] = min(MAX_TOKENS_CAP, current * 2)
+        escalations += 1
+    return resp, usage, options["max_tokens"] if escalations else None
+
+
+def _run_checks(provider: LLMProvider, prompt_bundle: Dict[str, Any], user: Dict[str, Any], datauri: str, options: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, int], Optional[int]]:
+    """検査項目ごとに短い判定を並列に依頼し、いずれかが NG になった時点で残りを打ち切る"""
+    checks = prompt_bundle["checks"]
+    system = prompt_bundle.get("check_system") or prompt_bundle["system"]
+    check_options = dict(options, schema="line")
+
+    def evaluate(check: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, int], Optional[int]]:
+        check_user = {
+            "check": check["text"],
+            "instruction": "画像全体についてこの検査項目だけを判定し、OK/NGとNGの場合のみ短い理由を1行のJSONで回答してください。",
+            "image_size": user["image_size"],
+        }
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": {"text": json.dumps(check_user, ensure_ascii=False), "image_url": datauri}},
+        ]
+        return _call_with_escalation(provider, messages, check_options, True)
+
+    outcomes: Dict[str, Tuple[str, str]] = {}
+    stamps: Dict[str, Any] = {}
+    usage: Dict[str, int] = {}
+    escalated: Optional[int] = None
+    executor = ThreadPoolExecutor(max_workers=min(MAX_CHECK_WORKERS, len(checks)))
+    futures = {executor.submit(evaluate, check): check for check in checks}
+    try:
+        for future in as_completed(futures):
+            check = futures[future]
+            try:
+                resp, used, check_escalated = future.result()
+            except Exception as exc:
+                resp, used, check_escalated = {"json": {"v": "ERROR", "r": str(exc)}}, {}, None
+            for key, value in used.items():
+                usage[key] = usage.get(key, 0) + value
+            escalated = max(filter(None, [escalated, check_escalated]), default=None)
+            stamps.update({key: resp[key] for key in ANSWER_STAMPS if key in resp})
+            answer = resp.get("json", {})
+            code = str(answer.get("v", answer.get("verdict", ""))).upper()
+            outcomes[check["id"]] = (code, str(answer.get("r", answer.get("details", "")) or ""))
+            if code == "NG":
+                break
+    finally:
+        # 未開始の項目は取り消し、実行中の呼び出しは結果を待たずに破棄する
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    evaluated = [check for check in checks if check["id"] in outcomes]
+    ng = [check for check in evaluated if outcomes[check["id"]][0] == "NG"]
+    unreadable = [check for check in evaluated if outcomes[check["id"]][0] not in {"OK", "NG"}]
+    if ng:
+        verdict = "NG"
+        details = " / ".join(f"{check['text']}: {outcomes[check['id']][1] or 'NG'}" for check in ng)
+    elif unreadable:
+        verdict = "ERROR"
+        details = " / ".join(f"{check['text']}: {outcomes[check['id']][1] or '判定不能'}" for check in unreadable)
+    else:
+        verdict = "OK"
+        details = "すべての検査項目に合致しました。"
+    result = {
+        "verdict": verdict,
+        "details": details,
+        "checks": [
+            {"id": check["id"], "result": outcomes[check["id"]][0], "reason": outcomes[check["id"]][1] or check["text"]}
+            for check in evaluated
+        ],
+    }
+    result.update(stamps)
+    skipped = [check["id"] for check in checks if check["id"] not in outcomes]
+    if skipped:
+        result["skipped_checks"] = skipped
+    return result, usage, escalated
+
+
+def load_image(source: Any) -> Image.Image:
+    """PIL画像・エンコード済みバイト列・ファイルパスのいずれかを RGB 画像として読み込む"""
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, (bytes, bytearray)):
+        return Image.open(io.BytesIO(source)).convert("RGB")
+    return Image.open(source).convert("RGB")
+
+
+def prepare_request(prompt_bundle: Dict[str, Any], img: Any, encode: Optional[Callable[..., str]] = None) -> Dict[str, Any]:
+    """送信前のCPU処理（デコード・切り出し・縮小・エンコード・base64）。戻り値はプロセス間で受け渡せる
+
+    バンドルの image（{"max_side": 長辺px, "format": "PNG"|"JPEG"|"WEBP", "quality": 1-100}）があれば、
+    長辺をそこまで縮めて指定の形式で送る（キャリブレーションで決めた値が最終アプリに固定される）。
+    """
+    img = load_image(img)
+    crop_info: Optional[Dict[str, Any]] = None
+    if prompt_bundle.get("preprocess"):
+        # 背景を除いた部品全体だけを送る（画素数が減り、画像トークンと転送量を抑えられる）
+        img, crop_info = preprocess_image(img, prompt_bundle["preprocess"])
+    image_options = prompt_bundle.get("image") or {}
+    max_side = int(image_options.get("max_side") or 0)
+    if max_side and max(img.size) > max_side:
+        img = img.copy()
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
     width, height = img.size
     user = {
         "spec_text": prompt_bundle["user"]["spec_text"],
         "instruction": "画像全体が仕様に合致するか検証し、OK/NGと理由をJSONで一貫して回答してください。",
         "image_size": {"width": width, "height": height},
     }
-    datauri = provider.pil_to_datauri(img)
-    messages = [
-        {"role": "system", "content": system},
-        {"role": "user", "content": {"text": json.dumps(user, ensure_ascii=False), "image_url": datauri}},
-    ]
-    resp = provider.chat_vision(messages)
-    result = resp.get("json", {})
+    if prompt_bundle.get("output_mode") == "line":
+        user["instruction"] = "画像全体が仕様に合致するか検証し、OK/NGとNGの場合のみ短い理由を1行のJSONで回答してください。"
+    if prompt_bundle.get("few_shots"):
+        # 類似したラベル付きの例（判定と人のフィードバック）を参考情報として渡す
+        user["few_shots"] = prompt_bundle["few_shots"]
+    encoder = encode or LLMProvider.pil_to_datauri
+    if image_options.get("format"):
+        datauri = encoder(img, format=image_options["format"], quality=image_options.get("quality"))
+    else:
+        datauri = encoder(img)
+    return {"user": user, "datauri": datauri, "crop": crop_info}
+
+
+def evaluate_prepared(provider: LLMProvider, prompt_bundle: Dict[str, Any], prepared: Dict[str, Any]) -> Dict[str, Any]:
+    """prepare_request の結果をモデルに送り、判定結果に整える（ネットワーク待ちが中心）"""
+    system = prompt_bundle["system"]
+    user = prepared["user"]
+    datauri = prepared["datauri"]
+    line_mode = prompt_bundle.get("output_mode") == "line"
+    # 既定の呼び出しでは追加の引数を渡さない（chat_vision(messages) だけを実装したプロバイダとも互換）
+    options: Dict[str, Any] = {"schema": "line"} if line_mode else {}
+    if prompt_bundle.get("max_tokens"):
+        options["max_tokens"] = int(prompt_bundle["max_tokens"])
+    started = time.perf_counter()
+    if len(prompt_bundle.get("checks") or []) >= 2:
+        result, usage, escalated = _run_checks(provider, prompt_bundle, user, datauri, options)
+    else:
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": {"text": json.dumps(user, ensure_ascii=False), "image_url": datauri}},
+        ]
+        resp, usage, escalated = _call_with_escalation(provider, messages, options, line_mode)
+        result = resp.get("json", {})
+        if line_mode and "v" in result:
+            result = {"verdict": result["v"], "details": result.get("r", ""), "checks": []}
+        result.update({key: resp[key] for key in ANSWER_STAMPS if key in resp})
+    latency_ms = (time.perf_counter() - started) * 1000.0
     verdict = str(result.get("verdict", "")).upper()
     if verdict not in {"OK", "NG"}:
-        result["verdict"] = "NG"
-        result["details"] = result.get("details") or "モデルから有効な判定が返らなかったためNGとします。"
+        # 解釈できない応答・API エラーは NG に読み替えず ERROR（判定不能）として返す（誤った不合格として表示・記録しない）
+        result["verdict"] = "ERROR"
+        result["details"] = result.get("details") or "モデルから有効な判定が返らなかったため判定できませんでした。"
+        # モデルの判定ではないことを残す（キャッシュ・集計から除外するため）
+        result["fallback_verdict"] = True
     result.setdefault("details", "")
+    result["latency_ms"] = round(latency_ms, 1)
+    result["usage"] = usage
+    result["image_size"] = dict(result.get("image_size") or user["image_size"])
+    result["payload_bytes"] = len(datauri)
+    if prepared.get("crop") is not None:
+        result["crop"] = prepared["crop"]
+    if escalated:
+        result["max_tokens_escalated"] = escalated
     return result
+
+
+def run_vision_eval(provider: LLMProvider, prompt_bundle: Dict[str, Any], img: Image.Image) -> Dict[str, Any]:
+    """画像全体を評価対象としてVLMに判定を依頼する"""
+    return evaluate_prepared(provider, prompt_bundle, prepare_request(prompt_bundle, img, provider.pil_to_datauri))
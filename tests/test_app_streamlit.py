@@ -10,7 +10,9 @@ def test_app_streamlit_no_roi_artifacts():
     assert "streamlit_drawable_canvas" not in text
     assert "_build_full_image_roi_map" not in text
     assert ".get(\"roi_full_map\"" not in text
-    assert "FewShotStore" not in text
+    # Few-shot は仕様全体に固定せず、判定する画像ごとに似た例を選んで添付する
+    assert "query_image" not in text
+    assert "attach_few_shots(prompt_bundle" in text
 
 
 def test_run_vision_eval_call_uses_three_arguments():
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("httpx")
+
+from src.llm_providers import LLMProvider, aclose_async_client
+
+
+VERDICT = {"verdict": "OK", "details": "問題なし", "checks": []}
+MESSAGES = [{"role": "system", "content": "sys"}, {"role": "user", "content": {"text": "spec"}}]
+
+
+class _StandIn:
+    """OpenAI 互換のローカルサーバー。temperature を拒否する・応答を遅らせる設定ができる"""
+
+    def __init__(self):
+        self.reject_temperature = False
+        self.delay_s = 0.0
+        self.payloads = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                stand_in.payloads.append(payload)
+                time.sleep(stand_in.delay_s)
+                if stand_in.reject_temperature and "temperature" in payload:
+                    self._send(400, {"error": {"message": "Unsupported value: 'temperature' does not support 0.2 with this model. Only the default (1) value is supported."}})
+                    return
+                content = json.dumps(VERDICT) if "response_format" in payload else "説明文"
+                self._send(200, {
+                    "choices": [{"message": {"content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+                })
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 512  # 同時接続を受け切れるように listen の待ち行列を広げる
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    server = _StandIn()
+    yield server
+    server.close()
+
+
+def _run(coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await aclose_async_client()
+
+    return asyncio.run(main())
+
+
+def test_async_results_match_sync_with_many_in_flight(stand_in):
+    provider = LLMProvider("OpenAI", "gpt-test", api_base=stand_in.url, timeout=10)
+    expected = provider.chat_vision(MESSAGES)
+
+    async def many():
+        return await asyncio.gather(*(provider.achat_vision(MESSAGES) for _ in range(200)))
+
+    results = _run(many())
+    assert len(results) == 200
+    assert all(result == expected for result in results)
+    assert expected["json"]["verdict"] == "OK"
+    assert _run(provider.achat_text("sys", "user")) == provider.chat_text("sys", "user") == "説明文"
+
+
+def test_async_shares_temperature_fallback(stand_in):
+    stand_in.reject_temperature = True
+    provider = LLMProvider("OpenAI", "gpt-test", api_base=stand_in.url, timeout=10)
+    result = _run(provider.achat_vision(MESSAGES))
+    assert result["json"]["verdict"] == "OK"
+    assert ["temperature" in payload for payload in stand_in.payloads] == [True, False]
+
+
+def test_async_call_can_be_cancelled(stand_in):
+    stand_in.delay_s = 2.0
+    provider = LLMProvider("OpenAI", "gpt-test", api_base=stand_in.url, timeout=10)
+
+    async def cancel_soon():
+        task = asyncio.create_task(provider.achat_vision(MESSAGES))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    started = time.monotonic()
+    _run(cancel_soon())
+    assert time.monotonic() - started < 1.0
@@ -0,0 +1,135 @@
+import base64
+import io
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List
+
+import pytest
+from PIL import Image
+
+from src.budget import BudgetExceeded, BudgetGovernor, BudgetLimits, GovernedProvider, estimate_batch, estimate_image_tokens
+from src.eval_cache import VerdictCache
+from src.llm_providers import LLMProvider
+from src.prompt_factory import build_prompt_bundle
+from src.vision_eval import run_vision_eval
+
+
+@dataclass
+class _MeteredProvider(LLMProvider):
+    """毎回 usage を返し、受け取った画像の幅を記録するプロバイダ"""
+
+    tokens: int = 40
+    widths: List[int] = field(default_factory=list)
+
+    def chat_vision(self, messages, **kwargs):
+        datauri = messages[-1]["content"]["image_url"]
+        self.widths.append(Image.open(io.BytesIO(base64.b64decode(datauri.split(",", 1)[1]))).width)
+        usage = {"prompt_tokens": self.tokens - 10, "completion_tokens": 10, "total_tokens": self.tokens}
+        return {"output_text": "", "json": {"verdict": "OK", "details": "", "checks": []}, "usage": usage}
+
+
+def test_estimate_uses_sent_size_prompt_and_history():
+    provider = LLMProvider("OpenAI", "gpt-4o")
+    bundle = build_prompt_bundle("ネジが6本あること")
+    images = [Image.new("RGB", (512, 512))] * 3
+
+    estimate = estimate_batch(provider, bundle, images, completion_tokens=[100, 200])
+    assert estimate["images"] == estimate["calls"] == 3
+    assert estimate["completion_tokens"] == 450
+    assert estimate["completion_basis"] == "history"
+    assert estimate["prompt_tokens"] > 3 * estimate_image_tokens("OpenAI", "gpt-4o", 512, 512) == 3 * 255
+    assert estimate["cost_usd"] == pytest.approx((estimate["prompt_tokens"] * 2.5 + 450 * 10.0) / 1_000_000)
+
+    small = estimate_batch(LLMProvider("Gemini", "gemini-1.5-flash"), bundle, images)
+    assert small["completion_basis"] == "default"
+    assert small["cost_usd"] < estimate["cost_usd"]
+
+
+def test_degrades_then_stops_at_limit():
+    provider = _MeteredProvider("OpenAI", "gpt-4o")
+    cheap = _MeteredProvider("OpenAI", "gpt-4o-mini")
+    governor = BudgetGovernor(BudgetLimits(max_tokens=100, degrade_at=0.8, on_limit="stop"))
+    governed = GovernedProvider(provider, governor, degrade_provider=cheap, degrade_max_side=64)
+    bundle = build_prompt_bundle("仕様")
+    img = Image.new("RGB", (256, 128))
+
+    decisions = [run_vision_eval(governed, bundle, img) for _ in range(3)]
+    assert [decision["verdict"] for decision in decisions] == ["OK"] * 3
+    assert provider.widths == [256, 256]
+    # 80% を超えたら安いモデル・縮小した画像で呼ぶ
+    assert cheap.widths == [64]
+    assert decisions[0]["model"] == "gpt-4o" and "degraded" not in decisions[0]
+    # 節約モードの結果には実際に応答したモデルと送信サイズが残り、通常の結果としてはキャッシュしない
+    assert decisions[2]["model"] == "gpt-4o-mini" and decisions[2]["degraded"] is True
+    assert decisions[2]["image_size"] == {"width": 64, "height": 32}
+    cache = VerdictCache()
+    cache.put(cache.key_for(governed, bundle, "img"), decisions[2])
+    assert len(cache) == 0
+    with pytest.raises(BudgetExceeded):
+        run_vision_eval(governed, bundle, img)
+    status = governor.status()
+    assert status["state"] == "stopped"
+    assert status["tokens"] == 120 and status["calls"] == 3
+
+
+def test_pause_waits_until_limit_is_raised():
+    provider = _MeteredProvider("OpenAI", "gpt-4o", tokens=60)
+    governor = BudgetGovernor(BudgetLimits(max_tokens=100, degrade_at=1.0))
+    governed = GovernedProvider(provider, governor)
+    bundle = build_prompt_bundle("仕様")
+    img = Image.new("RGB", (8, 8))
+    run_vision_eval(governed, bundle, img)
+    run_vision_eval(governed, bundle, img)
+
+    done = threading.Event()
+    threading.Thread(target=lambda: (run_vision_eval(governed, bundle, img), done.set()), daemon=True).start()
+    time.sleep(0.1)
+    assert not done.is_set()
+    assert governor.status()["state"] == "paused"
+
+    governor.update_limits(BudgetLimits(max_tokens=1000, degrade_at=1.0))
+    assert done.wait(2)
+    assert governor.status()["calls"] == 3
+
+
+def test_paused_budget_does_not_hold_a_scheduler_slot():
+    from src.scheduler import ScheduledProvider, Scheduler
+
+    scheduler = Scheduler(max_concurrency=1)
+    governor = BudgetGovernor(BudgetLimits(max_tokens=0, degrade_at=1.0))
+    governed = ScheduledProvider(GovernedProvider(_MeteredProvider("OpenAI", "gpt-4o"), governor), scheduler, "line")
+    other = ScheduledProvider(_MeteredProvider("OpenAI", "gpt-4o"), scheduler, "line")
+    bundle = build_prompt_bundle("仕様")
+    img = Image.new("RGB", (8, 8))
+
+    done = threading.Event()
+    threading.Thread(target=lambda: (run_vision_eval(governed, bundle, img), done.set()), daemon=True).start()
+    time.sleep(0.1)
+    assert governor.status()["state"] == "paused"
+    # 予算を待っている呼び出しは枠を取っていないため、同じスケジューラの他の呼び出しは流れる
+    other_done = threading.Event()
+    threading.Thread(target=lambda: (run_vision_eval(other, bundle, img), other_done.set()), daemon=True).start()
+    assert other_done.wait(2)
+    assert not done.is_set()
+
+    governor.update_limits(BudgetLimits(max_tokens=1000, degrade_at=1.0))
+    assert done.wait(2)
+    status = governor.status()
+    assert status["calls"] == 1 and status["in_flight"] == 0
+
+
+def test_unknown_model_price_is_reported(monkeypatch):
+    monkeypatch.delenv("OPENAI_MODEL", raising=False)
+    governor = BudgetGovernor()
+    with pytest.warns(UserWarning, match="my-finetune"):
+        governor.acquire()
+        governor.record("my-finetune", {"prompt_tokens": 1000, "completion_tokens": 0})
+    governor.acquire()
+    governor.record("gpt-4o", {"prompt_tokens": 1000, "completion_tokens": 0})
+    assert governor.status()["unpriced_models"] == {"my-finetune": 1}
+
+    # モデル名が空なら実際に呼び出す既定のモデルの料金で積算する
+    governed = GovernedProvider(_MeteredProvider("OpenAI", ""), governor)
+    run_vision_eval(governed, build_prompt_bundle("仕様"), Image.new("RGB", (8, 8)))
+    assert governor.status()["unpriced_models"] == {"my-finetune": 1}
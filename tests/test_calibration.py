@@ -0,0 +1,115 @@
+import base64
+import io
+import threading
+
+import pytest
+from PIL import Image
+
+from src.budget import estimate_batch
+from src.calibration import calibrate_resolution, resolution_sweep
+from src.eval_cache import VerdictCache
+from src.llm_providers import LLMProvider
+from src.prompt_factory import build_prompt_bundle
+from src.vision_eval import run_vision_eval
+
+
+class _ResolutionSensitiveProvider(LLMProvider):
+    """送られた画像の幅が 512px 未満だと赤い部品を見落とす（常に OK と答える）スタブ"""
+
+    def __init__(self):
+        super().__init__(provider_name="OpenAI", model="gpt-4o")
+        self.vision_calls = 0
+        self.formats = []
+        self._lock = threading.Lock()
+
+    def chat_vision(self, messages, **kwargs):
+        header, data = messages[-1]["content"]["image_url"].split(",", 1)
+        img = Image.open(io.BytesIO(base64.b64decode(data)))
+        with self._lock:
+            self.vision_calls += 1
+            self.formats.append(header)
+        is_red = img.convert("RGB").getpixel((img.width // 2, img.height // 2))[0] > 200
+        verdict = "NG" if is_red and img.width >= 512 else "OK"
+        return {"json": {"verdict": verdict, "details": ""}, "usage": {"total_tokens": 10}}
+
+
+def _samples():
+    return [("red.png", Image.new("RGB", (1024, 1024), "red")), ("blue.png", Image.new("RGB", (1024, 1024), "blue"))]
+
+
+def test_calibration_picks_smallest_accurate_setting_and_reuses_cache():
+    provider = _ResolutionSensitiveProvider()
+    cache = VerdictCache()
+    expected = {"red.png": "NG", "blue.png": "OK"}
+    bundle = build_prompt_bundle("赤い部品はNG")
+    settings = resolution_sweep((None, 512, 384), (("PNG", None), ("JPEG", 75)))
+
+    result = calibrate_resolution(provider, bundle, _samples(), expected, settings=settings, max_workers=4, cache=cache)
+    assert result.baseline.setting == {} and result.baseline.accuracy == 1.0
+    # 縮小なしの PNG は元の送り方と同じ画像になるため評価しない
+    assert result.api_calls == provider.vision_calls == 2 * len(settings)
+    by_label = {point.label: point for point in result.points}
+    assert "縮小なし / PNG" not in by_label
+    assert by_label["長辺384px / JPEG q75"].accuracy == 0.5
+    assert by_label["長辺512px / PNG"].mean_image_tokens < result.baseline.mean_image_tokens
+    assert by_label["長辺512px / JPEG q75"].mean_bytes > 0
+    assert any(header.startswith("data:image/jpeg") for header in provider.formats)
+
+    # 精度を保つ中で画像トークンが最小の 512px が選ばれ、バンドルに固定される
+    assert result.best.setting["max_side"] == 512
+    best_bundle = result.best_bundle
+    assert best_bundle["image"] == result.best.setting
+    assert run_vision_eval(provider, best_bundle, _samples()[0][1])["image_size"] == {"width": 512, "height": 512}
+    assert estimate_batch(provider, best_bundle, [img for _, img in _samples()])["prompt_tokens"] < estimate_batch(provider, bundle, [img for _, img in _samples()])["prompt_tokens"]
+
+    # 2回目はすべてキャッシュから
+    calls = provider.vision_calls
+    again = calibrate_resolution(provider, best_bundle, _samples(), expected, settings=settings, cache=cache)
+    assert provider.vision_calls == calls
+    assert again.api_calls == 0 and again.cache_hits == 2 * len(settings)
+    assert again.best.setting == result.best.setting
+
+
+def test_calibration_through_process_pipeline_matches_threads():
+    expected = {"red.png": "NG", "blue.png": "OK"}
+    bundle = build_prompt_bundle("赤い部品はNG")
+    settings = resolution_sweep((None, 384), (("PNG", None), ("JPEG", 75)))
+    threaded = calibrate_resolution(_ResolutionSensitiveProvider(), bundle, _samples(), expected, settings=settings)
+    provider = _ResolutionSensitiveProvider()
+    piped = calibrate_resolution(provider, bundle, _samples(), expected, settings=settings, cpu_workers=1, cpu_kind="process")
+    assert provider.vision_calls == piped.api_calls == 2 * len(settings)
+    assert [(p.label, p.accuracy, p.mean_image_tokens) for p in piped.points] == [
+        (p.label, p.accuracy, p.mean_image_tokens) for p in threaded.points
+    ]
+    assert (piped.best.accuracy, piped.best.mean_image_tokens) == (threaded.best.accuracy, threaded.best.mean_image_tokens)
+
+
+def test_calibration_skips_equivalent_settings_and_stays_within_max_calls():
+    provider = _ResolutionSensitiveProvider()
+    expected = {"red.png": "NG", "blue.png": "OK"}
+    bundle = build_prompt_bundle("赤い部品はNG")
+    settings = [
+        {"format": "png", "quality": 90},  # PNG の品質は使われない
+        {"format": "PNG", "max_side": 2048},  # サンプル（1024px）より大きい長辺は縮小しない
+        {"format": "JPEG", "quality": 75, "max_side": 512},
+        {"format": "JPG", "quality": 75, "max_side": 512},
+        {"format": "PNG", "max_side": 512},
+        {"format": "PNG", "max_side": 384},
+    ]
+
+    result = calibrate_resolution(provider, bundle, _samples(), expected, settings=settings, max_calls=4)
+    assert [point.setting for point in result.points] == [{}, {"format": "JPEG", "quality": 75, "max_side": 512}]
+    assert result.skipped == [{"format": "PNG", "max_side": 512}, {"format": "PNG", "max_side": 384}]
+    assert result.stopped_reason == "budget"
+    assert result.api_calls == provider.vision_calls == 4
+
+    # キャッシュ済みの設定は予算を使わない
+    cache = VerdictCache()
+    calibrate_resolution(provider, bundle, _samples(), expected, settings=settings[2:3], cache=cache)
+    again = calibrate_resolution(provider, bundle, _samples(), expected, settings=settings, cache=cache, max_calls=2)
+    assert [point.setting for point in again.points] == [{}, settings[2], settings[4]]
+    assert again.skipped == [settings[5]]
+    assert again.api_calls == 2
+
+    with pytest.raises(ValueError, match="元の送り方"):
+        calibrate_resolution(provider, bundle, _samples(), expected, settings=settings, max_calls=1)
@@ -0,0 +1,74 @@
+import json
+import threading
+import time
+
+from PIL import Image
+
+from src.prompt_factory import build_prompt_bundle, split_spec_checks
+from src.vision_eval import run_vision_eval
+
+
+class _CheckProvider:
+    """検査項目ごとに (判定, 所要秒) を返すプロバイダ"""
+
+    provider_name = "OpenAI"
+    model = "fake"
+    max_tokens = 64
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.started = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def pil_to_datauri(img):
+        return "data:image/png;base64,"
+
+    def chat_vision(self, messages, schema="verdict", max_tokens=None):
+        check = json.loads(messages[1]["content"]["text"])["check"]
+        with self._lock:
+            self.started.append(check)
+        verdict, delay = self.answers[check]
+        time.sleep(delay)
+        reason = "" if verdict == "OK" else f"{check}を満たさない"
+        return {"json": {"v": verdict, "r": reason}, "usage": {"total_tokens": 5}, "finish_reason": "stop"}
+
+
+def test_split_keeps_single_instruction_sentence_intact():
+    assert split_spec_checks("ネジ6本がすべてシール済み、ラベルがある、傷がない") == ["ネジ6本がすべてシール済み", "ラベルがある", "傷がない"]
+    assert len(split_spec_checks("ネジを確認し、外れていればNGとする")) == 1
+    assert "checks" not in build_prompt_bundle("ネジを確認し、外れていればNGとする", decompose=True)
+
+
+def test_split_keeps_provisos_with_their_check():
+    spec = "・傷がないこと。ただし端面の擦れ、バリ、汚れは許容する。\n・ラベルがある"
+    assert split_spec_checks(spec) == ["傷がないこと。ただし端面の擦れ、バリ、汚れは許容する。", "ラベルがある"]
+    assert split_spec_checks("傷がないこと。ただし端面の擦れ、バリ、汚れは許容する。") == ["傷がないこと。ただし端面の擦れ、バリ、汚れは許容する。"]
+
+
+def test_all_checks_ok_populates_checks_in_spec_order():
+    bundle = build_prompt_bundle("ネジがある、ラベルがある、傷がない", decompose=True)
+    provider = _CheckProvider({"ネジがある": ("OK", 0.05), "ラベルがある": ("OK", 0.0), "傷がない": ("OK", 0.02)})
+
+    decision = run_vision_eval(provider, bundle, Image.new("RGB", (4, 4)))
+
+    assert decision["verdict"] == "OK"
+    assert [check["id"] for check in decision["checks"]] == ["C1", "C2", "C3"]
+    assert all(check["result"] == "OK" for check in decision["checks"])
+    assert decision["usage"]["total_tokens"] == 15
+
+
+def test_first_ng_short_circuits_remaining_checks():
+    checks = ["ネジがある", "ラベルがある", "傷がない"]
+    bundle = build_prompt_bundle("仕様", checks=checks)
+    provider = _CheckProvider({"ネジがある": ("OK", 1.0), "ラベルがある": ("NG", 0.0), "傷がない": ("OK", 1.0)})
+
+    started = time.monotonic()
+    decision = run_vision_eval(provider, bundle, Image.new("RGB", (4, 4)))
+
+    assert time.monotonic() - started < 0.5
+    assert decision["verdict"] == "NG"
+    assert "ラベルがある" in decision["details"]
+    assert decision["checks"] == [{"id": "C2", "result": "NG", "reason": "ラベルがあるを満たさない"}]
+    assert decision["skipped_checks"] == ["C1", "C3"]
+    assert "fallback_verdict" not in decision
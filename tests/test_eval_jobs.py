@@ -0,0 +1,206 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+from src.eval_jobs import EvalJob, JobCancelled, cancellable_provider
+from src.hedging import HedgedProvider, HedgePolicy
+from src.llm_providers import LLMProvider
+from src.scheduler import ScheduledProvider, Scheduler
+
+
+def _samples(*names):
+    return [(name, Image.new("RGB", (2, 2))) for name in names]
+
+
+def test_cancelled_item_keeps_its_slot_until_the_call_returns():
+    release = threading.Event()
+    calls = []
+    tokens = {}
+
+    def task(name, img, expected, cancel_event):
+        calls.append(name)
+        tokens[name] = cancel_event
+        if name == "slow.png":
+            release.wait(5)
+        return {"image": name, "expected": expected}
+
+    job = EvalJob(task, _samples("slow.png", "fast.png"), {"fast.png": "OK"}, max_workers=1).start()
+    while job.snapshot()[0].status != "running":
+        time.sleep(0.01)
+    job.cancel("slow.png")
+    assert tokens["slow.png"].is_set()
+    # 取り消した呼び出しが戻るまで、次の項目は枠を待つ
+    time.sleep(0.1)
+    assert calls == ["slow.png"] and job.snapshot()[1].status == "queued"
+    release.set()
+    assert job.wait(5)
+
+    slow, fast = job.snapshot()
+    assert slow.status == "cancelled" and slow.result is None
+    assert fast.status == "done" and fast.result == {"image": "fast.png", "expected": "OK"}
+    assert job.progress() == (2, 2)
+
+    job.retry("slow.png")
+    assert job.wait(5)
+    assert job.snapshot()[0].status == "done"
+    assert calls.count("slow.png") == 2
+    assert not tokens["slow.png"].is_set()
+
+
+def test_concurrency_never_exceeds_max_workers_across_cancellations():
+    lock = threading.Lock()
+    gate = threading.Event()
+    state = {"running": 0, "peak": 0}
+
+    def task(name, img, expected, cancel_event):
+        with lock:
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+        gate.wait(0.2)
+        with lock:
+            state["running"] -= 1
+        return {}
+
+    job = EvalJob(task, _samples(*[f"{i}.png" for i in range(8)]), {}, max_workers=2).start()
+    for name in job.order[:6]:
+        job.cancel(name)
+    for name in job.order[:6]:
+        job.retry(name)
+    assert job.wait(5)
+    assert state["peak"] <= 2
+    assert all(item.status == "done" for item in job.snapshot())
+
+
+def test_cancellable_provider_stops_calls_waiting_in_the_scheduler():
+    gate = threading.Event()
+
+    class _Provider:
+        provider_name = "OpenAI"
+        model = "fake"
+
+        def __init__(self):
+            self.calls = []
+
+        def chat_vision(self, messages, **kwargs):
+            self.calls.append(messages)
+            gate.wait(5)
+            return {"json": {"verdict": "OK", "details": ""}}
+
+    provider = _Provider()
+    scheduler = Scheduler(max_concurrency=1)
+    client = ScheduledProvider(provider, scheduler, "line")
+    blocker = threading.Thread(target=client.chat_vision, args=(["blocker"],), daemon=True)
+    blocker.start()
+    while not provider.calls:
+        time.sleep(0.01)
+
+    cancel_event = threading.Event()
+    wrapped = cancellable_provider(client, cancel_event)
+    assert isinstance(wrapped, ScheduledProvider) and wrapped.model == "fake"
+    errors = []
+
+    def call():
+        try:
+            wrapped.chat_vision(["queued"])
+        except JobCancelled as exc:
+            errors.append(exc)
+
+    waiting = threading.Thread(target=call, daemon=True)
+    waiting.start()
+    while not any(row["queued"] for row in scheduler.report()):
+        time.sleep(0.01)
+    # 順番待ちの間に取り消すと、順番が来ても API を呼ばない
+    cancel_event.set()
+    gate.set()
+    waiting.join(5)
+    blocker.join(5)
+    assert len(errors) == 1 and provider.calls == [["blocker"]]
+
+
+def test_errors_are_reported_per_item_and_cancel_all_stops_queue():
+    gate = threading.Event()
+
+    def task(name, img, expected, cancel_event):
+        gate.wait(5)
+        raise RuntimeError(f"{name} failed")
+
+    job = EvalJob(task, _samples("a.png", "b.png", "c.png"), {}, max_workers=1).start()
+    job.cancel_all()
+    gate.set()
+    assert job.wait(5)
+    assert [item.status for item in job.snapshot()] == ["cancelled", "cancelled", "cancelled"]
+
+    job.retry("b.png")
+    assert job.wait(5)
+    assert job.snapshot()[1].status == "error"
+    assert job.snapshot()[1].error == "b.png failed"
+    assert job.results() == []
+
+
+@pytest.fixture
+def slow_server(monkeypatch):
+    """5秒待ってから応答する OpenAI 互換のローカルサーバー（切断されたら待つのをやめる）"""
+    pytest.importorskip("httpx")
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    received = threading.Event()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            received.set()
+            time.sleep(5)
+            body = json.dumps({"choices": [{"message": {"content": '{"verdict": "OK", "details": "", "checks": []}'}}]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1", received
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("hedged", [False, True])
+def test_cancel_aborts_the_request_in_flight(slow_server, hedged):
+    url, received = slow_server
+    provider = LLMProvider("OpenAI", "gpt-test", api_base=url, timeout=30)
+    if hedged:
+        provider = HedgedProvider(provider, HedgePolicy(deadline_s=30, initial_hedge_delay_s=20))
+    messages = [{"role": "system", "content": "sys"}, {"role": "user", "content": {"text": "spec"}}]
+
+    returned = threading.Event()
+    errors = []
+
+    def task(name, img, expected, cancel_event):
+        try:
+            return cancellable_provider(provider, cancel_event).chat_vision(messages)
+        except Exception as exc:
+            errors.append(exc)
+            raise
+        finally:
+            returned.set()
+
+    job = EvalJob(task, _samples("slow.png"), {}, max_workers=1).start()
+    assert received.wait(5)
+    started = time.monotonic()
+    job.cancel("slow.png")
+    # 5秒後の応答を待たずに呼び出しそのものが戻る
+    assert returned.wait(1.0)
+    assert time.monotonic() - started < 1.0
+    assert [type(exc) for exc in errors] == [JobCancelled]
+    assert job.wait(2) and job.snapshot()[0].status == "cancelled"
+    if hedged:
+        assert provider.metrics()["errors"] == 0 and provider.metrics()["p50_ms"] is None
@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+from src.failover import BreakerPolicy, FailoverProvider
+from src.llm_providers import LLMProvider
+from src.prompt_factory import build_prompt_bundle
+from src.vision_eval import run_vision_eval
+
+
+VERDICT = {"verdict": "OK", "details": "問題なし", "checks": []}
+
+
+class _StandIn:
+    """OpenAI / Gemini 互換の応答を返すローカルサーバー。mode を "ok" / "fail" / "down" に切り替えられる"""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.mode = "ok"
+        self.hits = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                stand_in.hits += 1
+                if stand_in.mode == "fail":
+                    self._send(500, {"error": {"message": "upstream unavailable"}})
+                elif stand_in.kind == "openai":
+                    self._send(200, {
+                        "choices": [{"message": {"content": json.dumps(VERDICT)}, "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+                    })
+                else:
+                    self._send(200, {
+                        "candidates": [{"content": {"parts": [{"text": json.dumps(VERDICT)}]}, "finishReason": "STOP"}],
+                        "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": 5, "totalTokenCount": 15},
+                    })
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_ins(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("GEMINI_API_KEY", "test")
+    servers = [_StandIn("openai"), _StandIn("gemini")]
+    yield servers
+    for server in servers:
+        server.close()
+
+
+def _evaluate(provider):
+    result = run_vision_eval(provider, build_prompt_bundle("仕様"), Image.new("RGB", (4, 4)))
+    result.pop("latency_ms")
+    return result
+
+
+def test_routes_away_from_failing_backend_and_recovers(stand_ins):
+    openai, gemini = stand_ins
+    failover = FailoverProvider(
+        [
+            LLMProvider("OpenAI", "gpt-test", api_base=f"{openai.url}/v1", timeout=5),
+            LLMProvider("Gemini", "gemini-test", api_base=gemini.url, timeout=5),
+        ],
+        BreakerPolicy(consecutive_failures=2, cooldown_s=0.2),
+    )
+    healthy = _evaluate(failover)
+    assert failover.last_backend == "OpenAI:gpt-test"
+
+    openai.mode = "fail"
+    for _ in range(3):
+        # Gemini が応答しても結果の形は OpenAI のときと同じ
+        assert _evaluate(failover) == healthy
+    assert failover.last_backend == "Gemini:gemini-test"
+    assert failover.status()[0]["state"] == "open"
+    hits_while_open = openai.hits
+    _evaluate(failover)
+    assert openai.hits == hits_while_open
+
+    openai.mode = "ok"
+    time.sleep(0.25)
+    assert _evaluate(failover) == healthy
+    assert failover.last_backend == "OpenAI:gpt-test"
+    assert failover.status()[0]["state"] == "closed"
+
+
+def test_unreachable_backend_is_skipped_and_all_down_returns_error(stand_ins):
+    _, gemini = stand_ins
+    failover = FailoverProvider(
+        [
+            LLMProvider("OpenAI", "gpt-test", api_base="http://127.0.0.1:9/v1", timeout=1),
+            LLMProvider("Gemini", "gemini-test", api_base=gemini.url, timeout=5),
+        ],
+        BreakerPolicy(consecutive_failures=1, cooldown_s=60),
+    )
+    assert _evaluate(failover)["verdict"] == "OK"
+    assert failover.status()[0]["state"] == "open"
+
+    gemini.mode = "fail"
+    resp = failover.chat_vision([{"role": "user", "content": "x"}])
+    assert resp["json"]["verdict"] == "ERROR"
+
+
+class _GarbledBackend:
+    provider_name = "OpenAI"
+    model = "garbled"
+
+    def __init__(self):
+        self.calls = 0
+
+    def chat_vision(self, messages, **kwargs):
+        self.calls += 1
+        return {"output_text": "???", "json": {"verdict": "ERROR", "details": "解釈できません", "checks": [], "parse_error": True}}
+
+
+def test_parse_errors_are_returned_without_tripping_or_failing_over():
+    primary, backup = _GarbledBackend(), _GarbledBackend()
+    failover = FailoverProvider([primary, backup], BreakerPolicy(consecutive_failures=1))
+    for _ in range(3):
+        resp = failover.chat_vision([{"role": "user", "content": "x"}])
+        assert resp["json"]["parse_error"] is True
+    assert primary.calls == 3 and backup.calls == 0
+    assert failover.status()[0]["state"] == "closed" and failover.status()[0]["error_rate"] == 0.0
@@ -0,0 +1,130 @@
+import json
+
+import pytest
+
+from src.fewshot import FewShotStore
+
+
+def _record(i, tag="screw", spec="spec-a"):
+    return {"spec_text": spec, "human_feedback": f"feedback {i}", "tags": [tag]}
+
+
+def test_fewshot_store_indexes_filters_and_reports_corruption(tmp_path):
+    path = tmp_path / "few_shots.jsonl"
+    path.write_text(
+        json.dumps(_record(0), ensure_ascii=False) + "\n" + "{broken\n",
+        encoding="utf-8",
+    )
+
+    with pytest.warns(UserWarning, match="破損"), FewShotStore(str(path)) as store:
+        ids = store.extend([_record(1, tag="label"), _record(2, spec="spec-b")])
+        assert ids == [2, 3]
+        assert store.get(2)["human_feedback"] == "feedback 1"
+        assert [r["human_feedback"] for r in store.filter(tag="screw")] == ["feedback 0", "feedback 2"]
+        assert [r["human_feedback"] for r in store.filter(spec_text="spec-b")] == ["feedback 2"]
+        report = store.corruption_report()
+        assert [item["line_no"] for item in report] == [2]
+
+    # 別プロセスによる追記も再オープン時に差分だけ取り込まれる
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(_record(3), ensure_ascii=False) + "\n")
+    with FewShotStore(str(path)) as store:
+        assert len(store) == 4
+        assert [record_id for record_id, _ in store.iter_records(batch_size=1)] == [1, 2, 3, 4]
+
+
+def test_fewshot_store_compaction_dedupes_and_keeps_ids(tmp_path):
+    path = tmp_path / "few_shots.jsonl"
+    with FewShotStore(str(path)) as store:
+        store.extend([_record(1), _record(1), _record(2)])
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("not json\n")
+        with pytest.warns(UserWarning, match="破損"):
+            store.compact_in_background().join()
+        assert len(store) == 2
+        assert store.get(3)["human_feedback"] == "feedback 2"
+        assert store.get(2) is None
+        assert store.corruption_report() == []
+        store.append(_record(4))
+        assert store.get(4)["human_feedback"] == "feedback 4"
+    assert len(path.read_text(encoding="utf-8").splitlines()) == 3
+
+
+def test_similar_examples_are_attached_to_prompt_bundle(tmp_path):
+    from PIL import Image
+
+    from src.prompt_factory import build_prompt_bundle
+
+    with FewShotStore(str(tmp_path / "few_shots.jsonl")) as store:
+        store.add_example(Image.new("RGB", (64, 64), "red"), {"spec_text": "spec-a", "verdict": "NG", "human_feedback": "赤はNG"})
+        store.add_example(Image.new("RGB", (64, 64), "blue"), {"spec_text": "spec-a", "verdict": "OK", "human_feedback": "青はOK"})
+        store.add_example(Image.new("RGB", (64, 64), "green"), {"spec_text": "spec-b", "verdict": "OK", "human_feedback": "緑はOK"})
+
+        query = Image.new("RGB", (48, 48), (250, 10, 10))
+        hits = store.nearest(query, k=2)
+        assert hits[0][0] == 1
+        assert hits[0][1] >= hits[1][1]
+
+        bundle = build_prompt_bundle("spec-a", fewshot_store=store, query_image=query, fewshot_k=1)
+        assert bundle["few_shots"] == [{"verdict": "NG", "feedback": "赤はNG", "similarity": bundle["few_shots"][0]["similarity"]}]
+        assert "features" not in json.dumps(bundle)
+        assert "few_shots" not in build_prompt_bundle("spec-a")
+
+
+def test_attach_few_shots_selects_per_image_and_skips_the_query_itself(tmp_path):
+    from PIL import Image
+
+    from src.eval_cache import image_digest
+    from src.prompt_factory import attach_few_shots, build_prompt_bundle
+
+    red, blue = Image.new("RGB", (64, 64), "red"), Image.new("RGB", (64, 64), "blue")
+    bundle = build_prompt_bundle("spec-a")
+    with FewShotStore(str(tmp_path / "few_shots.jsonl")) as store:
+        first = store.add_example(red, {"spec_text": "spec-a", "verdict": "NG", "human_feedback": "赤はNG"})
+        # 同じ画像・仕様・判定の例は重複して追記しない
+        assert store.add_example(red, {"spec_text": "spec-a", "verdict": "NG", "human_feedback": "再判定"}) == first
+        store.add_example(blue, {"spec_text": "spec-a", "verdict": "OK", "human_feedback": "青はOK"})
+        assert len(store) == 2
+        assert store.example_ids(image_digest(red), spec_text="spec-a") == [first]
+
+        near_red = attach_few_shots(bundle, store, Image.new("RGB", (64, 64), (240, 20, 20)), k=1)
+        near_blue = attach_few_shots(bundle, store, Image.new("RGB", (64, 64), (20, 20, 240)), k=1)
+        assert [shot["verdict"] for shot in near_red["few_shots"]] == ["NG"]
+        assert [shot["verdict"] for shot in near_blue["few_shots"]] == ["OK"]
+        assert "few_shots" not in bundle
+
+        # 判定する画像そのもののラベルは添付しない
+        own = attach_few_shots(bundle, store, red, k=2)
+        assert [shot["feedback"] for shot in own["few_shots"]] == ["青はOK"]
+
+
+def test_nearest_stays_within_a_few_ms_at_100k_examples(tmp_path):
+    import base64
+    import time
+
+    import numpy as np
+    from PIL import Image
+
+    from src.fewshot import FEATURE_DIM, image_features
+
+    rng = np.random.default_rng(0)
+    vectors = rng.random((100_000, FEATURE_DIM), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    blobs = vectors.astype(np.float16)
+    path = tmp_path / "few_shots.jsonl"
+    with open(path, "w", encoding="utf-8") as f:
+        for i, blob in enumerate(blobs):
+            features = base64.b64encode(blob.tobytes()).decode("ascii")
+            f.write(json.dumps({"spec_text": f"spec-{i % 2}", "verdict": "OK", "features": features}) + "\n")
+
+    # 件数に比例する検索部分を測る（クエリ画像の特徴量は件数によらず1ミリ秒前後）
+    query = image_features(Image.new("RGB", (1024, 768), (200, 40, 40)))
+    with FewShotStore(str(path)) as store:
+        store.nearest(query)  # 初回はベクトルを読み込む
+        timings = []
+        for _ in range(20):
+            start = time.perf_counter()
+            hits = store.nearest(query, k=3, spec_text="spec-1")
+            timings.append(time.perf_counter() - start)
+    assert len(hits) == 3
+    assert min(timings) < 0.005
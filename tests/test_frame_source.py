@@ -0,0 +1,131 @@
+import threading
+
+import cv2
+import numpy as np
+
+from src.frame_source import PartDetector, frame_sharpness, inspect_stream, iter_parts
+from src.llm_providers import LLMProvider
+from src.prompt_factory import build_prompt_bundle
+
+SIZE = (96, 128)  # (高さ, 幅)
+PART = 32
+
+
+def _part_texture():
+    tile = (np.indices((PART, PART)).sum(axis=0) // 4 % 2 * 200 + 30).astype(np.uint8)
+    return np.repeat(tile[..., None], 3, axis=2)
+
+
+def _frame(x=None, blur=False):
+    frame = np.full(SIZE + (3,), 90, np.uint8)
+    if x is not None:
+        left, right = max(0, x), min(SIZE[1], x + PART)
+        if right > left:
+            frame[32:32 + PART, left:right] = _part_texture()[:, left - x:right - x]
+    return cv2.GaussianBlur(frame, (5, 5), 0) if blur else frame
+
+
+def _conveyor(parts=2, settled=8, sharp_at=5):
+    """部品が左から入って止まり、右へ抜けていく映像。静止中は sharp_at 番目だけがピントの合ったフレーム"""
+    frames, sharp_indices = [], []
+    for _ in range(parts):
+        frames += [_frame() for _ in range(4)]
+        frames += [_frame(x, blur=True) for x in range(-PART, 48, 12)]
+        for i in range(settled):
+            if i == sharp_at:
+                sharp_indices.append(len(frames))
+            frames.append(_frame(48, blur=i != sharp_at))
+        frames += [_frame(x, blur=True) for x in range(60, SIZE[1] + 12, 12)]
+    frames += [_frame() for _ in range(4)]
+    return list(enumerate(frames)), sharp_indices
+
+
+def test_sharpness_prefers_focused_frame():
+    assert frame_sharpness(_frame(48)) > frame_sharpness(_frame(48, blur=True)) > frame_sharpness(_frame())
+
+
+def test_detector_emits_one_sharpest_frame_per_part():
+    frames, sharp_indices = _conveyor(parts=3)
+    parts = list(iter_parts(frames, PartDetector(settle_frames=2)))
+    assert [part.index for part in parts] == [0, 1, 2]
+    assert [part.frame_index for part in parts] == sharp_indices
+    assert all(part.image.size == (SIZE[1], SIZE[0]) and part.image.mode == "RGB" for part in parts)
+    assert all(part.settled_frames >= 5 for part in parts)
+
+
+def test_bumped_part_is_evaluated_once():
+    frames = [_frame() for _ in range(4)]
+    frames += [_frame(x, blur=True) for x in range(-PART, 48, 12)]
+    frames += [_frame(48) for _ in range(5)]
+    # 検査位置で小突かれて少し動き、止まり直す
+    frames += [_frame(52, blur=True), _frame(56, blur=True)]
+    frames += [_frame(56) for _ in range(5)]
+    frames += [_frame(x, blur=True) for x in range(68, SIZE[1] + 12, 12)]
+    frames += [_frame() for _ in range(4)]
+    parts = list(iter_parts(enumerate(frames), PartDetector(settle_frames=2)))
+    assert len(parts) == 1
+
+
+class _CountingProvider(LLMProvider):
+    def __init__(self):
+        super().__init__(provider_name="OpenAI", model="fake")
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def chat_vision(self, messages, **kwargs):
+        with self._lock:
+            self.calls += 1
+        return {"json": {"verdict": "OK", "details": ""}}
+
+
+def test_inspect_stream_from_video_file_evaluates_only_selected_frames(tmp_path):
+    frames, _ = _conveyor(parts=2)
+    path = str(tmp_path / "line.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (SIZE[1], SIZE[0]))
+    for _, frame in frames:
+        writer.write(frame)
+    writer.release()
+
+    provider = _CountingProvider()
+    results = list(inspect_stream(provider, build_prompt_bundle("仕様"), path, detector=PartDetector(settle_frames=2), queue_size=1))
+    assert [part.index for part, _ in results] == [0, 1]
+    assert all(decision["verdict"] == "OK" for _, decision in results)
+    # 数十フレームのうち判定に送るのは部品ごとの1枚だけ
+    assert provider.calls == 2 < len(frames)
+
+
+def test_inspect_stream_drops_parts_when_queue_is_full():
+    frames, _ = _conveyor(parts=8)
+    gate = threading.Event()
+
+    class _Blocking(_CountingProvider):
+        def chat_vision(self, messages, **kwargs):
+            gate.wait(5)
+            return super().chat_vision(messages, **kwargs)
+
+    provider = _Blocking()
+    dropped = []
+    stream = inspect_stream(
+        provider, build_prompt_bundle("仕様"), frames, detector=PartDetector(settle_frames=2),
+        queue_size=1, net_workers=1, backpressure="reject", on_drop=dropped.append,
+    )
+    threading.Timer(0.3, gate.set).start()
+    results = list(stream)
+    assert dropped and len(results) + len(dropped) == 8
+    assert provider.calls == len(results)
+
+
+def test_inspect_stream_reports_failed_part_as_error_and_keeps_going():
+    frames, _ = _conveyor(parts=3)
+
+    class _FailsOnce(_CountingProvider):
+        def chat_vision(self, messages, **kwargs):
+            result = super().chat_vision(messages, **kwargs)
+            if self.calls == 1:
+                raise RuntimeError("接続が切れました")
+            return result
+
+    results = list(inspect_stream(_FailsOnce(), build_prompt_bundle("仕様"), frames, detector=PartDetector(settle_frames=2), net_workers=1))
+    assert [part.index for part, _ in results] == [0, 1, 2]
+    assert results[0][1]["verdict"] == "ERROR" and "接続が切れました" in results[0][1]["details"]
+    assert [decision["verdict"] for _, decision in results[1:]] == ["OK", "OK"]
@@ -37,3 +37,75 @@ def test_generate_runtime_app_embeds_full_image_roi(tmp_path):
     assert '"responseMimeType": "application/json"' in code
     assert 'if verdict not in {"OK", "NG"}:' in code
     assert '"roi_map"' not in code
+
+
+def test_builds_are_content_hashed_deduplicated_and_pruned(tmp_path):
+    out_dir = tmp_path / "prod"
+
+    def build(spec):
+        bundle = {"system": "test system", "user": {"spec_text": spec, "instruction": "do it"}}
+        return generate_runtime_app(bundle, out_dir=str(out_dir), keep=2)
+
+    first_abs, first_rel = build("spec-1")
+    assert re.fullmatch(r"runtime_app_[0-9a-f]{12}\.py", first_rel)
+    mtime = Path(first_abs).stat().st_mtime_ns
+    manifest = (out_dir / "manifest.json").read_text(encoding="utf-8")
+
+    # 同じバンドルは何も書き込まない
+    assert build("spec-1") == (first_abs, first_rel)
+    assert Path(first_abs).stat().st_mtime_ns == mtime
+    assert (out_dir / "manifest.json").read_text(encoding="utf-8") == manifest
+
+    _, second_rel = build("spec-2")
+    _, third_rel = build("spec-3")
+    assert second_rel != first_rel
+    latest = (out_dir / "runtime_app_latest.py").read_text(encoding="utf-8")
+    assert latest == (out_dir / third_rel).read_text(encoding="utf-8")
+
+    manifest = json.loads((out_dir / "manifest.json").read_text(encoding="utf-8"))
+    assert manifest["latest"] == third_rel
+    assert [b["file"] for b in manifest["builds"]] == [second_rel, third_rel]
+    assert sorted(p.name for p in out_dir.glob("runtime_app_*.py")) == sorted([second_rel, third_rel, "runtime_app_latest.py"])
+
+
+def test_minimal_requirements_and_zipapp(tmp_path):
+    import zipfile
+
+    from PIL import Image
+
+    background = tmp_path / "bg.png"
+    Image.new("RGB", (4, 4)).save(background)
+    bundle = {"system": "s", "user": {"spec_text": "spec", "instruction": "do it"}}
+    out_dir = tmp_path / "prod"
+
+    abs_path, rel_path = generate_runtime_app(bundle, out_dir=str(out_dir))
+    requirements_name = Path(rel_path).stem.replace("runtime_app_", "requirements_") + ".txt"
+    requirements = (out_dir / requirements_name).read_text(encoding="utf-8").split()
+    names = {re.split(r"[<>=]", line)[0].lower() for line in requirements}
+    assert {"streamlit", "requests", "pillow", "pydantic", "python-dotenv"} <= names
+    assert not names & {"streamlit-drawable-canvas", "opencv-python-headless", "numpy", "httpx"}
+
+    with zipfile.ZipFile(Path(abs_path).with_suffix(".pyz")) as zf:
+        assert {"__main__.py", rel_path, "requirements.txt"} <= set(zf.namelist())
+        # バンドルはアプリに埋め込み済みで、別ファイルとしては同梱しない
+        assert "bundle.json" not in zf.namelist()
+        assert requirements_name in zf.read("__main__.py").decode("utf-8")
+        assert zf.read(rel_path).decode("utf-8") == Path(abs_path).read_text(encoding="utf-8")
+        assert zf.read("requirements.txt") == (out_dir / requirements_name).read_bytes()
+
+    preprocess = {"method": "background", "background_path": str(background)}
+    abs_path, rel_path = generate_runtime_app({**bundle, "preprocess": preprocess}, out_dir=str(out_dir))
+    manifest = json.loads((out_dir / "manifest.json").read_text(encoding="utf-8"))
+    assert [build["requirements"] for build in manifest["builds"]] == [requirements_name, manifest["builds"][-1]["requirements"]]
+    names = {re.split(r"[<>=]", line)[0].lower() for line in (out_dir / manifest["builds"][-1]["requirements"]).read_text(encoding="utf-8").split()}
+    assert {"opencv-python-headless", "numpy"} <= names
+    # 前のビルドの依存は書き換わらない
+    assert "numpy" not in (out_dir / requirements_name).read_text(encoding="utf-8")
+    assert not (out_dir / "requirements.txt").exists()
+    with zipfile.ZipFile(Path(abs_path).with_suffix(".pyz")) as zf:
+        assert any(name.startswith("background_") for name in zf.namelist())
+
+    # 古いビルドと一緒に削除される
+    generate_runtime_app(bundle, out_dir=str(out_dir), keep=1)
+    generate_runtime_app({**bundle, "user": {**bundle["user"], "spec_text": "spec-2"}}, out_dir=str(out_dir), keep=1)
+    assert len(list(out_dir.glob("requirements_*.txt"))) == 1
@@ -0,0 +1,94 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List
+
+from PIL import Image
+
+from src.eval_cache import VerdictCache
+from src.hedging import HedgedProvider, HedgePolicy
+from src.llm_providers import LLMProvider
+from src.prompt_factory import build_prompt_bundle
+from src.vision_eval import run_vision_eval
+
+
+@dataclass
+class _SlowFirstProvider(LLMProvider):
+    """n回目の呼び出しに delays[n]（末尾以降は最後の値）秒かかり、verdicts[n]（未指定なら verdict）を返すプロバイダ"""
+
+    delays: List[float] = field(default_factory=lambda: [0.0])
+    verdict: str = "OK"
+    verdicts: List[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def chat_vision(self, messages):
+        with self._lock:
+            index = min(self.calls, len(self.delays) - 1)
+            self.calls += 1
+        time.sleep(self.delays[index])
+        verdict = self.verdicts[index] if index < len(self.verdicts) else self.verdict
+        return {"output_text": "", "json": {"verdict": verdict, "details": "", "checks": []}}
+
+
+def test_hedge_wins_when_primary_is_slow():
+    provider = _SlowFirstProvider("OpenAI", "fake", delays=[1.0, 0.01])
+    hedged = HedgedProvider(provider, HedgePolicy(deadline_s=5.0, initial_hedge_delay_s=0.05))
+    started = time.monotonic()
+    decision = run_vision_eval(hedged, build_prompt_bundle("仕様"), Image.new("RGB", (4, 4)))
+
+    assert decision["verdict"] == "OK"
+    assert time.monotonic() - started < 0.8
+    metrics = hedged.metrics()
+    assert metrics["calls"] == 1
+    assert metrics["hedged"] == 1
+    assert metrics["hedge_wins"] == 1
+    assert metrics["timeouts"] == 0
+
+
+def test_deadline_returns_fallback_marked_timed_out_and_not_cached():
+    provider = _SlowFirstProvider("OpenAI", "fake", delays=[1.0])
+    hedged = HedgedProvider(provider, HedgePolicy(deadline_s=0.2, initial_hedge_delay_s=0.05, fallback_verdict="NG"))
+    assert hedged.provider.timeout == 0.2
+    decision = run_vision_eval(hedged, build_prompt_bundle("仕様"), Image.new("RGB", (4, 4)))
+
+    assert decision["verdict"] == "NG"
+    assert decision["timed_out"] is True
+    assert hedged.metrics()["timeouts"] == 1
+
+    cache = VerdictCache()
+    cache.put(("k",), decision)
+    assert len(cache) == 0
+
+
+def test_late_primary_after_deadline_enters_latency_window():
+    provider = _SlowFirstProvider("OpenAI", "fake", delays=[0.4])
+    hedged = HedgedProvider(provider, HedgePolicy(deadline_s=0.15, initial_hedge_delay_s=10.0))
+    assert hedged.chat_vision([{"role": "user", "content": "x"}])["json"]["timed_out"] is True
+    assert hedged.metrics()["p99_ms"] is None
+
+    time.sleep(0.4)
+    # 期限を過ぎた遅い呼び出しも分位点に反映される
+    assert hedged.metrics()["p99_ms"] >= 350
+
+
+def test_late_error_from_primary_is_not_counted_as_latency_or_saving():
+    provider = _SlowFirstProvider("OpenAI", "fake", delays=[0.4, 0.01], verdicts=["ERROR", "OK"])
+    hedged = HedgedProvider(provider, HedgePolicy(deadline_s=5.0, initial_hedge_delay_s=0.05))
+    assert hedged.chat_vision([{"role": "user", "content": "x"}])["json"]["verdict"] == "OK"
+
+    time.sleep(0.5)
+    metrics = hedged.metrics()
+    # エラーで返った元のリクエストは短縮時間にもレイテンシにも入らない
+    assert metrics["hedge_wins"] == 1
+    assert metrics["tail_saved_ms_mean"] is None
+    assert metrics["p99_ms"] is None
+
+    provider = _SlowFirstProvider("OpenAI", "fake", delays=[0.4], verdict="ERROR")
+    hedged = HedgedProvider(provider, HedgePolicy(deadline_s=0.15, initial_hedge_delay_s=10.0))
+    assert hedged.chat_vision([{"role": "user", "content": "x"}])["json"]["timed_out"] is True
+    time.sleep(0.4)
+    # 期限後のエラー応答は失敗と同じく期限の値で打ち切って記録する
+    assert hedged.metrics()["p99_ms"] == 150.0
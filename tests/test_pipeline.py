@@ -0,0 +1,139 @@
+import io
+import threading
+import time
+from dataclasses import dataclass
+
+import pytest
+from PIL import Image
+
+from src.llm_providers import LLMProvider
+from src.pipeline import Pipeline, PipelineFull, Stage, batch_pipeline, inspection_pipeline
+from src.prompt_factory import build_prompt_bundle
+from src.vision_eval import run_vision_eval
+
+
+@dataclass
+class _EchoProvider(LLMProvider):
+    """送られた画像サイズに応じて OK/NG を返すプロバイダ（幅が偶数なら OK）"""
+
+    def chat_vision(self, messages):
+        user = messages[-1]["content"]["text"]
+        verdict = "OK" if '"width": 4' in user or '"width": 8' in user else "NG"
+        return {"output_text": "", "json": {"verdict": verdict, "details": user[-20:], "checks": []}}
+
+
+def _slow(value):
+    time.sleep(0.02)
+    return value * 2
+
+
+def test_map_keeps_input_order_and_collects_metrics():
+    stages = [Stage("double", _slow, workers=4, queue_size=2), Stage("inc", lambda v: v + 1, workers=2, queue_size=2)]
+    with Pipeline(stages) as pipeline:
+        assert list(pipeline.map(range(20))) == [v * 2 + 1 for v in range(20)]
+        metrics = pipeline.metrics()
+    assert metrics["submitted"] == metrics["completed"] == 20
+    assert metrics["in_flight"] == 0
+    first = metrics["stages"][0]
+    assert first["processed"] == 20 and first["errors"] == 0
+    assert first["queue_capacity"] == 2
+    assert 0.0 < first["utilisation"] <= 1.0
+
+
+def test_errors_are_returned_per_item():
+    def check(value):
+        if value == 2:
+            raise ValueError("bad")
+        return value
+
+    with Pipeline([Stage("check", check)]) as pipeline:
+        results = list(pipeline.map(range(4), return_exceptions=True))
+        assert pipeline.metrics()["stages"][0]["errors"] == 1
+    assert results[:2] == [0, 1] and results[3] == 3
+    assert isinstance(results[2], ValueError)
+
+
+def test_reject_mode_raises_when_entry_queue_is_full():
+    gate = threading.Event()
+    pipeline = Pipeline([Stage("wait", lambda v: gate.wait(5) and v, queue_size=1)], backpressure="reject")
+    first = pipeline.submit(1)
+    time.sleep(0.05)  # ワーカーが1件目を取り出すのを待つ
+    second = pipeline.submit(2)
+    with pytest.raises(PipelineFull):
+        pipeline.submit(3)
+    assert pipeline.metrics()["stages"][0]["queue_depth"] == 1
+    gate.set()
+    assert first.result(5) == 1 and second.result(5) == 2
+    pipeline.close()
+
+
+def test_close_drains_or_cancels_pending_items():
+    pipeline = Pipeline([Stage("double", _slow, queue_size=8)])
+    futures = [pipeline.submit(v) for v in range(5)]
+    pipeline.close(drain=True)
+    assert [f.result(0) for f in futures] == [0, 2, 4, 6, 8]
+    with pytest.raises(RuntimeError):
+        pipeline.submit(1)
+
+    pipeline = Pipeline([Stage("double", _slow, queue_size=8)])
+    futures = [pipeline.submit(v) for v in range(5)]
+    time.sleep(0.01)
+    pipeline.close(drain=False)
+    assert any(f.cancelled() for f in futures)
+    assert all(f.done() for f in futures)
+
+
+@pytest.mark.parametrize("cpu_kind", ["thread", "process"])
+def test_inspection_pipeline_matches_run_vision_eval(cpu_kind):
+    provider = _EchoProvider("OpenAI", "fake")
+    bundle = build_prompt_bundle("仕様")
+    buffer = io.BytesIO()
+    Image.new("RGB", (5, 5)).save(buffer, format="PNG")
+    images = [Image.new("RGB", (4, 4)), buffer.getvalue(), Image.new("RGB", (8, 3))]
+    recorded = []
+
+    pipeline = inspection_pipeline(provider, bundle, cpu_workers=2, net_workers=2, cpu_kind=cpu_kind, sink=recorded.append)
+    results = list(pipeline.map(images))
+    pipeline.close()
+
+    expected = [run_vision_eval(provider, bundle, Image.open(io.BytesIO(img)) if isinstance(img, bytes) else img) for img in images]
+    for result in results + expected:
+        result.pop("latency_ms")
+    assert results == expected
+    assert [r["verdict"] for r in results] == ["OK", "NG", "OK"]
+    assert len(recorded) == 3
+    assert [stage["name"] for stage in pipeline.metrics()["stages"]] == ["prepare", "evaluate", "record"]
+
+
+@dataclass
+class _CustomEncoderProvider(_EchoProvider):
+    """独自のエンコーダを持つプロバイダ（ロックを持つため、エンコーダはプロセスへ渡せない）"""
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self.sent = []
+
+    def pil_to_datauri(self, img, format="PNG", quality=None):
+        return f"data:image/x-test;base64,{img.width}"
+
+    def chat_vision(self, messages):
+        with self._lock:
+            self.sent.append(messages[-1]["content"]["image_url"])
+        return super().chat_vision(messages)
+
+
+@pytest.mark.parametrize("cpu_kind", ["thread", "process"])
+def test_pipelines_encode_with_the_providers_encoder(cpu_kind):
+    provider = _CustomEncoderProvider("OpenAI", "fake")
+    bundle = build_prompt_bundle("仕様")
+    with inspection_pipeline(provider, bundle, cpu_workers=1, net_workers=2, cpu_kind=cpu_kind) as pipeline:
+        results = list(pipeline.map([Image.new("RGB", (4, 4)), Image.new("RGB", (8, 3))]))
+        # 渡せないエンコーダはスレッドで使い、送信画像を run_vision_eval と揃える
+        assert pipeline.metrics()["stages"][0]["kind"] == "thread"
+    assert [r["verdict"] for r in results] == ["OK", "OK"]
+    assert sorted(provider.sent) == ["data:image/x-test;base64,4", "data:image/x-test;base64,8"]
+
+    with batch_pipeline(provider, cpu_workers=1, net_workers=1, cpu_kind=cpu_kind) as pipeline:
+        result = list(pipeline.map([({**bundle, "image": {"max_side": 2}}, Image.new("RGB", (4, 4)))]))[0]
+    assert result["image_size"] == {"width": 2, "height": 2}
+    assert provider.sent[-1] == "data:image/x-test;base64,2"
@@ -0,0 +1,61 @@
+import numpy as np
+from PIL import Image, ImageDraw
+
+from src.prompt_factory import build_prompt_bundle
+from src.vision_eval import crop_to_part, learn_background, run_vision_eval
+
+
+class _SizeProvider:
+    provider_name = "OpenAI"
+    model = "fake"
+    max_tokens = 64
+
+    def __init__(self):
+        self.sizes = []
+
+    def pil_to_datauri(self, img):
+        self.sizes.append(img.size)
+        return "data:image/png;base64,"
+
+    def chat_vision(self, messages):
+        return {"json": {"verdict": "OK", "details": "", "checks": []}, "usage": {}}
+
+
+def _part_on_conveyor(size=(300, 200), box=(60, 40, 140, 90)):
+    img = Image.new("RGB", size, (235, 235, 235))
+    ImageDraw.Draw(img).rectangle(box, fill=(40, 40, 40))
+    return img
+
+
+def test_threshold_crop_keeps_whole_part_with_margin():
+    cropped, info = crop_to_part(_part_on_conveyor(), margin=0.05)
+
+    assert info["found"] is True
+    x0, y0, x1, y1 = info["box"]
+    assert x0 <= 60 and y0 <= 40 and x1 >= 141 and y1 >= 91
+    assert cropped.size == (x1 - x0, y1 - y0)
+    assert cropped.width * cropped.height < 300 * 200 / 4
+
+
+def test_background_difference_and_deskew():
+    rng = np.random.default_rng(0)
+    frames = [Image.fromarray(rng.integers(90, 140, (240, 240, 3), dtype=np.uint8)) for _ in range(5)]
+    background = learn_background(frames)
+    img = background.copy()
+    ImageDraw.Draw(img).polygon([(70, 120), (120, 70), (190, 140), (140, 190)], fill=(250, 250, 250))
+
+    cropped, info = crop_to_part(img, method="background", background=background, margin=0.0, deskew=True)
+
+    assert info["deskewed"] is True
+    assert sorted(cropped.size) == [71, 99]
+
+
+def test_run_vision_eval_records_crop_and_sent_image_size():
+    provider = _SizeProvider()
+    bundle = build_prompt_bundle("仕様", preprocess={"crop": "threshold", "margin": 0.0})
+
+    decision = run_vision_eval(provider, bundle, _part_on_conveyor())
+
+    assert decision["crop"]["original_size"] == {"width": 300, "height": 200}
+    assert decision["image_size"] == {"width": provider.sizes[0][0], "height": provider.sizes[0][1]}
+    assert provider.sizes[0] == (81, 51)
@@ -0,0 +1,56 @@
+import sqlite3
+
+from src.result_store import ResultStore
+
+
+def _decision(verdict, latency_ms):
+    return {"verdict": verdict, "latency_ms": latency_ms, "usage": {"total_tokens": 100}}
+
+
+def test_result_store_aggregates_per_spec_and_model(tmp_path):
+    store = ResultStore(str(tmp_path / "results.sqlite"))
+    rows = [
+        ResultStore.row(f"img{i}", "spec1", "OpenAI", "m1", _decision(verdict, float(latency)), expected)
+        for i, (verdict, expected, latency) in enumerate(
+            [("OK", "OK", 10), ("NG", "OK", 20), ("NG", "NG", 30), ("OK", None, 40)]
+        )
+    ]
+    store.record_many(rows)
+    store.record("img9", "spec2", "Gemini", "m2", _decision("OK", 5.0), "NG")
+
+    assert store.count() == 5
+    assert store.accuracy("spec1", "m1") == {"total": 3, "correct": 2, "accuracy": 2 / 3}
+    assert store.confusion_matrix("spec1") == {"OK": {"OK": 1, "NG": 1}, "NG": {"NG": 1}}
+    assert store.latency_percentiles("spec1", "m1", (50, 95)) == {50: 20.0, 95: 40.0}
+    summary = {(row["spec_version"], row["model"]): row for row in store.summary()}
+    assert summary[("spec2", "m2")]["accuracy"] == 0.0
+    assert summary[("spec1", "m1")]["mean_tokens"] == 100
+    assert store.recent(1)[0]["image_hash"] == "img9"
+
+    # 判定不能（ERROR）と期限切れの既定NGはモデルの判定ではないため、件数には含めて正解率・混同行列・レイテンシから除く
+    store.record("img10", "spec1", "OpenAI", "m1", dict(_decision("ERROR", 1.0), fallback_verdict=True), "NG")
+    store.record("img11", "spec1", "OpenAI", "m1", dict(_decision("NG", 900.0), timed_out=True), "OK")
+    assert store.count("spec1") == 6
+    assert store.accuracy("spec1", "m1") == {"total": 3, "correct": 2, "accuracy": 2 / 3}
+    assert store.confusion_matrix("spec1") == {"OK": {"OK": 1, "NG": 1}, "NG": {"NG": 1}}
+    assert store.latency_percentiles("spec1", "m1", (50, 95)) == {50: 20.0, 95: 40.0}
+    summary = {(row["spec_version"], row["model"]): row for row in store.summary()}
+    assert summary[("spec1", "m1")]["errors"] == 2 and summary[("spec2", "m2")]["errors"] == 0
+    assert summary[("spec1", "m1")]["labeled"] == 3 and summary[("spec1", "m1")]["mean_latency_ms"] == 25.0
+
+
+def test_result_store_adds_fallback_column_to_existing_file(tmp_path):
+    path = str(tmp_path / "old.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE results (id INTEGER PRIMARY KEY, ts REAL NOT NULL, source TEXT NOT NULL, image_hash TEXT NOT NULL,"
+        " spec_version TEXT NOT NULL, provider TEXT NOT NULL, model TEXT NOT NULL, verdict TEXT NOT NULL, expected TEXT,"
+        " latency_ms REAL, prompt_tokens INTEGER, completion_tokens INTEGER, total_tokens INTEGER)"
+    )
+    conn.execute("INSERT INTO results (ts, source, image_hash, spec_version, provider, model, verdict, expected) VALUES (0, '', 'a', 's', 'p', 'm', 'OK', 'OK')")
+    conn.commit()
+    conn.close()
+
+    store = ResultStore(path)
+    store.record("b", "s", "p", "m", _decision("ERROR", 1.0), "OK")
+    assert store.accuracy("s") == {"total": 1, "correct": 1, "accuracy": 1.0}
@@ -0,0 +1,119 @@
+import threading
+import time
+
+from PIL import Image
+
+from src.prompt_factory import build_prompt_bundle
+from src.scheduler import ScheduledProvider, Scheduler
+from src.vision_eval import run_vision_eval
+
+
+class _RecordingProvider:
+    """呼ばれた順にラベルを記録するプロバイダ。gate が閉じている間は最初の呼び出しが戻らない"""
+
+    provider_name = "OpenAI"
+    model = "fake"
+    max_tokens = 0
+
+    def __init__(self):
+        self.order = []
+        self.gate = threading.Event()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def pil_to_datauri(img):
+        return "data:image/png;base64,"
+
+    def chat_vision(self, messages, **kwargs):
+        label = messages[-1].get("label", "")
+        with self._lock:
+            self.order.append(label)
+        if label == "blocker":
+            self.gate.wait(5)
+        return {"output_text": "", "json": {"verdict": "OK", "details": "", "checks": []}}
+
+
+def _start(client, label):
+    thread = threading.Thread(target=client.chat_vision, args=([{"role": "user", "content": "", "label": label}],), daemon=True)
+    thread.start()
+    return thread
+
+
+def _wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "スケジューラが想定の状態になりませんでした"
+        time.sleep(0.001)
+
+
+def _counts(scheduler, key):
+    return sum(row[key] for row in scheduler.report())
+
+
+def _queue_behind_blocker(provider, scheduler, jobs):
+    """1件を実行中にしたまま jobs（(優先度, ラベル) のリスト）を順に積み、解放して全件の完了を待つ
+
+    積む順番はスケジューラのキューに入ったのを確かめてから次を積むことで固定する（sleep の長さに頼らない）。
+    """
+    client = ScheduledProvider(provider, scheduler, "bulk")
+    threads = [_start(client, "blocker")]
+    _wait_until(lambda: _counts(scheduler, "in_flight") == 1 and provider.order == ["blocker"])
+    for queued, (priority, label) in enumerate(jobs, start=1):
+        threads.append(_start(client.with_priority(priority), label))
+        _wait_until(lambda: _counts(scheduler, "queued") == queued)
+    provider.gate.set()
+    for thread in threads:
+        thread.join(5)
+    return provider.order[1:]
+
+
+def test_interactive_overtakes_queued_bulk_work():
+    provider = _RecordingProvider()
+    order = _queue_behind_blocker(provider, Scheduler(max_concurrency=1), [("bulk", f"bulk-{i}") for i in range(10)] + [("interactive", "operator")])
+    assert order[0] == "operator"
+    assert order[1:] == [f"bulk-{i}" for i in range(10)]
+
+
+def test_weighted_fair_queuing_between_line_and_bulk():
+    provider = _RecordingProvider()
+    jobs = [("bulk", f"bulk-{i}") for i in range(20)] + [("line", f"line-{i}") for i in range(20)]
+    order = _queue_behind_blocker(provider, Scheduler(max_concurrency=1), jobs)
+    first = order[:10]
+    # 重み 4:1 のため、後から積まれた line が先に積まれた bulk よりおよそ4倍多く流れる
+    assert sum(label.startswith("line") for label in first) >= 7
+    assert sum(label.startswith("bulk") for label in first) >= 1
+    assert len(order) == 40
+
+
+def test_strict_class_does_not_starve_guaranteed_share():
+    provider = _RecordingProvider()
+    # bulk の保証は毎秒 20×0.2=4 件。interactive が自分の保証分（10件）を使い切る前でも bulk の保証分は流れる
+    jobs = [("interactive", f"operator-{i}") for i in range(20)] + [("bulk", f"bulk-{i}") for i in range(4)]
+    order = _queue_behind_blocker(provider, Scheduler(max_concurrency=1, rate_per_s=20), jobs)
+    assert sum(label.startswith("bulk") for label in order[:10]) >= 1
+    assert order[0].startswith("operator")
+    assert len(order) == 24
+
+
+def test_rate_limit_and_slo_report():
+    provider = _RecordingProvider()
+    provider.gate.set()
+    scheduler = Scheduler(max_concurrency=8, rate_per_s=10)
+    client = ScheduledProvider(provider, scheduler, "interactive")
+    bundle = build_prompt_bundle("仕様")
+    img = Image.new("RGB", (4, 4))
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=run_vision_eval, args=(client, bundle, img)) for _ in range(15)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    # 最初の10件はバースト、残り5件は毎秒10件のペース
+    assert time.monotonic() - started >= 0.35
+
+    report = {row["class"]: row for row in scheduler.report()}
+    assert report["interactive"]["completed"] == 15
+    assert report["interactive"]["slo_met"] == 1.0
+    assert report["interactive"]["wait_p95_ms"] > 0
+    assert report["bulk"]["completed"] == 0 and report["bulk"]["slo_met"] is None
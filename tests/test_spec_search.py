@@ -0,0 +1,116 @@
+import base64
+import io
+import json
+import threading
+
+from PIL import Image
+
+from src.eval_cache import VerdictCache, image_digest
+from src.llm_providers import LLMProvider
+from src.prompt_factory import build_prompt_bundle
+from src.spec_search import _parse_candidates, candidate_bundle, search_specs
+from src.vision_eval import run_vision_eval
+
+
+class FakeProvider(LLMProvider):
+    """仕様文に "厳密" を含む場合のみ赤い画像をNGと判定するスタブ"""
+
+    def __init__(self):
+        super().__init__(provider_name="OpenAI", model="fake")
+        self.vision_calls = 0
+        self._lock = threading.Lock()
+
+    def chat_text(self, system_prompt, user_prompt):
+        return json.dumps({"candidates": ["赤い部品はNG（厳密）", "ゆるい仕様"]}, ensure_ascii=False)
+
+    def chat_vision(self, messages):
+        with self._lock:
+            self.vision_calls += 1
+        user = json.loads(messages[1]["content"]["text"])
+        is_red = messages[1]["content"]["image_url"] == self.pil_to_datauri(Image.new("RGB", (4, 4), "red"))
+        verdict = "NG" if is_red and "厳密" in user["spec_text"] else "OK"
+        return {"json": {"verdict": verdict, "details": ""}, "usage": {"total_tokens": 10}}
+
+
+def _samples():
+    return [("red.png", Image.new("RGB", (4, 4), "red")), ("blue.png", Image.new("RGB", (4, 4), "blue"))]
+
+
+def test_search_specs_finds_perfect_candidate_and_reuses_cache():
+    provider = FakeProvider()
+    cache = VerdictCache()
+    expected = {"red.png": "NG", "blue.png": "OK"}
+
+    result = search_specs(provider, build_prompt_bundle("元の仕様"), _samples(), expected, n_candidates=2, max_workers=1, cache=cache)
+
+    assert result.stopped_reason == "perfect"
+    assert result.best.spec_text == "赤い部品はNG（厳密）"
+    assert result.best.accuracy == 1.0
+    assert result.best_bundle["user"]["spec_text"] == "赤い部品はNG（厳密）"
+
+    calls_before = provider.vision_calls
+    again = search_specs(provider, build_prompt_bundle("元の仕様"), _samples(), expected, n_candidates=2, max_workers=1, cache=cache)
+    assert provider.vision_calls == calls_before
+    assert again.api_calls == 0
+    assert again.best.spec_text == "赤い部品はNG（厳密）"
+
+
+def test_search_specs_stops_when_budget_runs_out():
+    provider = FakeProvider()
+    expected = {"red.png": "NG", "blue.png": "OK"}
+
+    result = search_specs(provider, build_prompt_bundle("元の仕様"), _samples(), expected, n_candidates=2, max_calls=1, max_workers=1)
+
+    assert result.stopped_reason == "budget"
+    assert result.api_calls == 1
+    assert provider.vision_calls == 1
+
+
+def test_parse_candidates_takes_first_object_from_chatty_response():
+    text = '候補です: {"candidates": ["傷はNG", "{汚れ}はNG"]}\n補足: {"note": "なし"}'
+    assert _parse_candidates(text) == ["傷はNG", "{汚れ}はNG"]
+
+
+class _DecodingProvider(FakeProvider):
+    """送信画像を復号して赤を見分けるスタブ（縮小・JPEG でも判定できる）"""
+
+    def chat_vision(self, messages, **kwargs):
+        with self._lock:
+            self.vision_calls += 1
+        user = json.loads(messages[-1]["content"]["text"])
+        data = messages[-1]["content"]["image_url"].split(",", 1)[1]
+        red = Image.open(io.BytesIO(base64.b64decode(data))).convert("RGB").getpixel((0, 0))[0] > 200
+        verdict = "NG" if red and "厳密" in user["spec_text"] else "OK"
+        return {"json": {"verdict": verdict, "details": ""}, "usage": {"total_tokens": 10}}
+
+
+def test_candidates_keep_the_current_bundle_settings_and_reuse_its_cache():
+    provider = _DecodingProvider()
+    expected = {"red.png": "NG", "blue.png": "OK"}
+    bundle = build_prompt_bundle(
+        "元の仕様", preprocess={"crop": "threshold", "margin": 0.05}, image={"max_side": 2, "format": "JPEG", "quality": 75}
+    )
+    bundle["max_tokens"] = 300
+    cache = VerdictCache()
+    # ボタンBと同じく、元の仕様の結果をキャッシュに入れておく
+    for name, img in _samples():
+        cache.put(cache.key_for(provider, bundle, image_digest(img)), run_vision_eval(provider, bundle, img))
+    calls_before = provider.vision_calls
+
+    result = search_specs(provider, bundle, _samples(), expected, n_candidates=2, max_workers=1, cache=cache)
+    original = next(score for score in result.candidates if score.spec_text == "元の仕様")
+    assert original.bundle == bundle and original.cache_hits == 2
+    assert provider.vision_calls - calls_before == result.api_calls
+    best = result.best_bundle
+    assert best["user"]["spec_text"] == "赤い部品はNG（厳密）"
+    assert {key: value for key, value in best.items() if key != "user"} == {key: value for key, value in bundle.items() if key != "user"}
+    assert bundle["user"]["spec_text"] == "元の仕様"
+
+
+def test_candidate_bundle_rebuilds_checks_from_the_new_spec():
+    bundle = build_prompt_bundle("ネジがある\nラベルがある", decompose=True)
+    updated = candidate_bundle(bundle, "傷がない\n汚れがない\n欠けがない")
+    assert [check["text"] for check in updated["checks"]] == ["傷がない", "汚れがない", "欠けがない"]
+    single = candidate_bundle(bundle, "傷がないこと")
+    assert "checks" not in single and "check_system" not in single
+    assert [check["text"] for check in bundle["checks"]] == ["ネジがある", "ラベルがある"]
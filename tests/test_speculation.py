@@ -0,0 +1,93 @@
+import threading
+
+from PIL import Image
+
+from src.budget import BudgetGovernor, BudgetLimits
+from src.eval_cache import VerdictCache
+from src.llm_providers import LLMProvider
+from src.prompt_factory import build_prompt_bundle
+from src.speculation import SKIPPED_MESSAGE, SpeculativeRunner
+
+
+class _CountingProvider(LLMProvider):
+    def __init__(self, temperature=0.2):
+        super().__init__(provider_name="OpenAI", model="fake", temperature=temperature)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def chat_vision(self, messages, **kwargs):
+        with self._lock:
+            self.calls += 1
+        return {"json": {"verdict": "OK", "details": ""}}
+
+
+def _samples():
+    return [(f"{color}.png", Image.new("RGB", (4, 4), color)) for color in ("red", "green", "blue")]
+
+
+def test_precomputes_into_cache_and_restarts_when_settings_change():
+    cache = VerdictCache()
+    runner = SpeculativeRunner(cache, max_workers=2)
+    provider = _CountingProvider()
+    bundle = build_prompt_bundle("仕様")
+
+    runner.sync(provider, bundle, _samples())
+    assert runner.job.wait(5)
+    assert runner.status()["done"] == 3 and provider.calls == 3
+    assert len(cache) == 3
+
+    # 同じ内容なら何もしない
+    runner.sync(_CountingProvider(), bundle, _samples())
+    assert provider.calls == 3 and runner.status()["done"] == 3
+
+    # 仕様やモデル設定が変わったら古い結果は使わずに判定し直す（キャッシュ済みの組み合わせは呼ばない）
+    changed = _CountingProvider(temperature=0.7)
+    runner.sync(changed, build_prompt_bundle("別の仕様"), _samples())
+    assert runner.job.wait(5)
+    assert changed.calls == 3 and len(cache) == 6
+    runner.sync(provider, bundle, _samples())
+    assert runner.job.wait(5)
+    assert provider.calls == 3
+
+
+def test_skips_while_budget_is_degraded_and_resumes_after_limit_is_raised():
+    cache = VerdictCache()
+    runner = SpeculativeRunner(cache)
+    provider = _CountingProvider()
+    bundle = build_prompt_bundle("仕様")
+    governor = BudgetGovernor(BudgetLimits(max_tokens=0))
+
+    runner.sync(provider, bundle, _samples(), governor=governor)
+    assert runner.job.wait(5)
+    assert provider.calls == 0
+    assert all(item.error == SKIPPED_MESSAGE for item in runner.job.snapshot())
+
+    governor.update_limits(BudgetLimits())
+    runner.sync(provider, bundle, _samples(), governor=governor)
+    assert runner.job.wait(5)
+    assert provider.calls == 3 and runner.status()["done"] == 3
+
+
+def test_attaches_few_shots_per_image_and_restarts_when_examples_grow(tmp_path):
+    from src.eval_cache import image_digest
+    from src.fewshot import FewShotStore
+    from src.prompt_factory import attach_few_shots
+
+    cache = VerdictCache()
+    runner = SpeculativeRunner(cache)
+    provider = _CountingProvider()
+    bundle = build_prompt_bundle("仕様")
+    samples = _samples()
+    with FewShotStore(str(tmp_path / "few_shots.jsonl")) as store:
+        store.add_example(samples[0][1], {"spec_text": "仕様", "verdict": "NG", "human_feedback": "赤はNG"})
+        runner.sync(provider, bundle, samples, fewshot_store=store)
+        assert runner.job.wait(5)
+        # 本番の判定と同じく、画像ごとに似た例を添付したバンドルのキーで入る
+        for name, img in samples:
+            key = cache.key_for(provider, attach_few_shots(bundle, store, img), image_digest(img))
+            assert cache.peek(key) is not None
+
+        store.add_example(samples[1][1], {"spec_text": "仕様", "verdict": "OK", "human_feedback": "緑はOK"})
+        runner.sync(provider, bundle, samples, fewshot_store=store)
+        assert runner.job.wait(5)
+        assert provider.calls > 3
@@ -0,0 +1,59 @@
+from PIL import Image
+
+from src.eval_cache import spec_version
+from src.prompt_factory import build_prompt_bundle
+from src.token_budget import apply_token_budget, suggest_max_tokens
+from src.vision_eval import run_vision_eval
+
+
+class _TruncatingProvider:
+    """max_tokens が need 未満なら finish_reason=length で読めない応答を返すプロバイダ"""
+
+    provider_name = "OpenAI"
+    model = "fake"
+    max_tokens = 256
+
+    def __init__(self, need, answer):
+        self.need = need
+        self.answer = answer
+        self.calls = []
+
+    @staticmethod
+    def pil_to_datauri(img):
+        return "data:image/png;base64,"
+
+    def chat_vision(self, messages, schema="verdict", max_tokens=None):
+        limit = max_tokens or self.max_tokens
+        self.calls.append((schema, limit))
+        usage = {"completion_tokens": min(limit, self.need), "total_tokens": min(limit, self.need)}
+        if limit < self.need:
+            return {"json": {"verdict": "ERROR", "details": "truncated", "checks": []}, "usage": usage, "finish_reason": "length"}
+        return {"json": dict(self.answer), "usage": usage, "finish_reason": "stop"}
+
+
+def test_suggest_uses_tail_of_distribution_with_margin():
+    assert suggest_max_tokens([40] * 5) is None
+    budget = suggest_max_tokens([30] * 98 + [100, 200])
+    assert budget == 192  # p99=100 → 130 → 64単位に切り上げ
+    bundle = build_prompt_bundle("仕様")
+    version = spec_version(bundle)
+    apply_token_budget(bundle, [30] * 20)
+    assert bundle["max_tokens"] == 64
+    # 調整値は仕様バージョンを変えない
+    assert spec_version(bundle) == version
+
+
+def test_line_mode_is_expanded_and_truncation_escalates_max_tokens():
+    bundle = build_prompt_bundle("仕様", output_mode="line")
+    bundle["max_tokens"] = 64
+    provider = _TruncatingProvider(need=200, answer={"v": "NG", "r": "ネジ欠け"})
+
+    decision = run_vision_eval(provider, bundle, Image.new("RGB", (4, 4)))
+
+    assert provider.calls == [("line", 64), ("line", 128), ("line", 256)]
+    assert decision["verdict"] == "NG"
+    assert decision["details"] == "ネジ欠け"
+    assert decision["checks"] == []
+    assert decision["max_tokens_escalated"] == 256
+    assert decision["usage"]["completion_tokens"] == 64 + 128 + 200
+    assert "fallback_verdict" not in decision
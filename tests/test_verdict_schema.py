@@ -0,0 +1,103 @@
+import json
+
+import pytest
+from PIL import Image
+
+from src import llm_providers
+from src.llm_providers import LLMProvider
+from src.prompt_factory import build_prompt_bundle
+from src.verdict_schema import PARSE_STATS, parse_verdict
+from src.vision_eval import run_vision_eval
+
+
+class _Response:
+    def __init__(self, status, payload):
+        self.status_code = status
+        self._payload = payload
+        self.text = json.dumps(payload)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise llm_providers.requests.HTTPError(self.text)
+
+    def json(self):
+        return self._payload
+
+
+def _openai_reply(text):
+    return _Response(200, {"choices": [{"message": {"content": text}, "finish_reason": "stop"}], "usage": {"total_tokens": 10}})
+
+
+@pytest.fixture
+def fake_post(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    replies = []
+    sent = []
+
+    def post(url, headers=None, json=None, timeout=None):
+        sent.append(__import__("copy").deepcopy(json))
+        return replies.pop(0)
+
+    monkeypatch.setattr(llm_providers.requests, "post", post)
+    return replies, sent
+
+
+MESSAGES = [{"role": "system", "content": "sys"}, {"role": "user", "content": {"text": "spec"}}]
+
+
+def test_repairs_common_defects_without_another_call():
+    before = PARSE_STATS.snapshot()
+    parsed, error = parse_verdict('```json\n{"verdict": "ng", "details": "傷", "checks": [{"result": "ng", "reason": "a"},], "extra": 1}\n```')
+    assert error == ""
+    assert parsed == {"verdict": "NG", "details": "傷", "checks": [{"result": "NG", "reason": "a"}]}
+    assert PARSE_STATS.snapshot()["repaired"] == before["repaired"] + 1
+
+
+def test_invalid_output_is_retried_once_with_correction(fake_post):
+    replies, sent = fake_post
+    replies.extend([_openai_reply("判定はOKです"), _openai_reply('{"verdict": "OK", "details": "", "checks": []}')])
+    before = PARSE_STATS.snapshot()
+
+    resp = LLMProvider("OpenAI", "gpt-test").chat_vision(MESSAGES)
+
+    assert resp["json"]["verdict"] == "OK"
+    assert resp["usage"]["total_tokens"] == 20
+    assert sent[0]["response_format"]["type"] == "json_schema"
+    assert sent[1]["messages"][-2] == {"role": "assistant", "content": "判定はOKです"}
+    assert PARSE_STATS.snapshot()["retried"] == before["retried"] + 1
+
+
+def test_second_invalid_output_is_reported_as_error_not_ng(fake_post):
+    replies, _ = fake_post
+    replies.extend([_openai_reply("???"), _openai_reply('{"verdict": "MAYBE"}')])
+    before = PARSE_STATS.snapshot()
+
+    resp = LLMProvider("OpenAI", "gpt-test").chat_vision(MESSAGES)
+
+    assert resp["json"]["verdict"] == "ERROR"
+    assert resp["json"]["parse_error"] is True
+    assert PARSE_STATS.snapshot()["failed"] == before["failed"] + 1
+
+
+def test_falls_back_to_json_mode_when_schema_is_unsupported(fake_post):
+    replies, sent = fake_post
+    replies.extend([
+        _Response(400, {"error": {"message": "Invalid parameter: 'response_format' of type 'json_schema' is not supported with this model."}}),
+        _openai_reply('{"verdict": "NG", "details": "欠け", "checks": []}'),
+    ])
+
+    resp = LLMProvider("OpenAI", "gpt-test").chat_vision(MESSAGES)
+
+    assert resp["json"]["verdict"] == "NG"
+    assert sent[1]["response_format"] == {"type": "json_object"}
+
+
+def test_run_vision_eval_keeps_parse_failure_as_error(fake_post):
+    replies, _ = fake_post
+    replies.extend([_openai_reply("???"), _openai_reply("まだ???")])
+
+    decision = run_vision_eval(LLMProvider("OpenAI", "gpt-test"), build_prompt_bundle("仕様"), Image.new("RGB", (4, 4)))
+
+    # 誤った不合格（NG）として表示・記録しない
+    assert decision["verdict"] == "ERROR"
+    assert decision["fallback_verdict"] is True